@@ -0,0 +1,122 @@
+"""Process many PDF files at once.
+
+Files are hashed in a pool of processes, skipping files whose hash is
+cached, and looked up in the catalog by a bounded pool of threads that
+share one session. A `ResumeJournal` records each file as it is done,
+so that an interrupted run can pick up where it stopped.
+"""
+
+import json
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
+
+from .compat import to_native
+from .metadata import by_filehash, file_sha1, hash_cache
+
+
+def find_pdfs(directory):
+    """Return the paths of the PDF files under ``directory``, sorted."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(".pdf"):
+                found.append(os.path.join(dirpath, filename))
+    return found
+
+
+def _hash(path):
+    return path, file_sha1(path)
+
+
+def hash_files(paths, processes=None, cache=hash_cache):
+    """Yield ``(path, sha1)`` for each path, in order.
+
+    Hashes are taken from ``cache`` where they are current; the other
+    files are hashed in a pool of ``processes`` worker processes and
+    their hashes are added to the cache.
+    """
+    stats = dict((path, os.stat(path)) for path in paths)
+    hashes = {}
+    if cache is not None:
+        hashes = cache.get_many([(path, stats[path]) for path in paths])
+    stale = [path for path in paths if path not in hashes]
+
+    if processes is None:
+        processes = min(len(stale), multiprocessing.cpu_count())
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            hashes.update(pool.imap_unordered(_hash, stale, chunksize=4))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        hashes.update([_hash(path) for path in stale])
+    if cache is not None and stale:
+        cache.update([(path, hashes[path], stats[path]) for path in stale])
+
+    for path in paths:
+        yield path, hashes[path]
+
+
+def lookup_files(hashed, session, workers=8):
+    """Look up ``(path, sha1)`` pairs in the catalog.
+
+    Yields ``(path, sha1, document)`` as lookups complete, where the
+    document is None if the file is not in the catalog. At most
+    ``workers`` lookups run at a time, all through ``session``.
+    """
+    def lookup(item):
+        path, sha1 = item
+        return path, sha1, by_filehash(session, sha1)
+
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(lookup, hashed):
+            yield result
+    finally:
+        # stops the lookups still queued if the caller stops early
+        pool.terminate()
+        pool.join()
+
+
+class ResumeJournal(object):
+    """A record of the files a bulk operation has finished with.
+
+    Each line of the file at ``path`` is a JSON object with the ``path``
+    and ``sha1`` of a finished file and, if it was renamed, its
+    ``newpath``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done_paths = set()
+        self.done_hashes = set()
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn by an interruption
+                    self._remember(record)
+
+    def _remember(self, record):
+        for field in ('path', 'newpath'):
+            if record.get(field):
+                self.done_paths.add(os.path.abspath(to_native(record[field])))
+        self.done_hashes.add(to_native(record['sha1']))
+
+    def is_done(self, path):
+        return os.path.abspath(path) in self.done_paths
+
+    def record(self, **record):
+        with open(self.path, 'a') as fp:
+            fp.write(json.dumps(record, sort_keys=True) + "\n")
+        self._remember(record)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
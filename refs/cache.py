@@ -0,0 +1,55 @@
+"""Bibliographies kept in memory and up to date with their files.
+
+A long-running process, such as `refs serve`, gets bibliographies from a
+`BibliographyCache` instead of loading them. When a file has changed,
+its bibliography is reloaded incrementally, parsing only the entries
+whose text changed.
+"""
+
+import os
+
+from .core import Bibliography
+from .locator import stamp
+
+
+class BibliographyCache(object):
+    """Parsed bibliography files, keyed by their absolute paths."""
+
+    def __init__(self):
+        # path -> (stamp of the files, bibliography)
+        self.bibs = {}
+
+    def _files(self, path, journal):
+        return [path] if journal is None else [path, journal.path]
+
+    def get(self, path, journal=None):
+        """Return the bibliography of the file ``path``.
+
+        With a `.Journal`, its edits are replayed on the bibliography.
+        The bibliography is shared between callers, who must not modify
+        it.
+        """
+        path = os.path.abspath(path)
+        current = stamp(self._files(path, journal))
+        cached = self.bibs.get(path)
+        if cached is not None and cached[0] == current:
+            return cached[1]
+        if cached is not None and os.path.exists(path):
+            bib = cached[1]
+            bib.reload_bibtex(path)
+        else:
+            bib = Bibliography()
+            if os.path.exists(path):
+                bib.load_bibtex(path)
+        if journal is not None:
+            journal.replay(bib)
+        self.bibs[path] = (current, bib)
+        return bib
+
+    def refresh(self, path, journal=None):
+        """Reload the bibliography of ``path`` if it is cached."""
+        if os.path.abspath(path) in self.bibs:
+            self.get(path, journal)
+
+    def forget(self, path):
+        self.bibs.pop(os.path.abspath(path), None)
@@ -0,0 +1,143 @@
+"""Run refs commands in a `refs serve` process when one is running.
+
+This is the ``refs`` command. It only imports the standard library and
+the refs configuration, so it starts quickly, and sends the command line
+to the server over a Unix socket. If no server is running, the server
+does not serve the command, or it does not start the command within the
+``timeout`` of the ``[server]`` section of refsrc, the command runs in
+this process instead.
+
+A request is one line of JSON with ``argv`` and ``cwd``. A response is
+a series of lines of JSON: ``{"fallback": true}`` alone, or
+``{"served": true}`` when the command starts, then ``{"stdout": n}`` or
+``{"stderr": n}``, each followed by ``n`` bytes of output, as the
+command writes them, and finally the exit ``{"status": n}``.
+"""
+
+import errno
+import json
+import os
+import socket
+import sys
+
+from . import paths
+from .rc import rc
+
+
+class ServerError(Exception):
+    """The server stopped before the command it started finished."""
+
+
+def socket_path():
+    path = rc.get('server', 'socket')
+    if path:
+        return os.path.expanduser(path)
+    return os.path.join(paths.config_dir, "refs.sock")
+
+
+def recv_all(sock, bufsize=1 << 16):
+    chunks = []
+    while True:
+        chunk = sock.recv(bufsize)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def frame(header, data=b""):
+    """Return a response line with ``header``, followed by ``data``."""
+    return (json.dumps(header) + "\n").encode('utf-8') + data
+
+
+def request(argv, path=None, timeout=None, stdout=None, stderr=None):
+    """Run ``argv`` in the server at the socket ``path``.
+
+    The output is written to the ``stdout`` and ``stderr`` files as it
+    arrives. Returns the exit status, or None if the server did not
+    start the command. Raises `socket.error` if no server is listening
+    or it does not start the command within ``timeout`` seconds, and
+    `ServerError` if, once it started the command, it stops or sends a
+    response that cannot be read before the command finished.
+    """
+    if path is None:
+        path = socket_path()
+    if timeout is None:
+        timeout = rc.getfloat('server', 'timeout')
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    fp = None
+    try:
+        sock.connect(path)
+        line = json.dumps({'argv': argv, 'cwd': os.getcwd()}) + "\n"
+        sock.sendall(line.encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        fp = sock.makefile('rb')
+        try:
+            response = json.loads(fp.readline().decode('utf-8'))
+        except ValueError:
+            # not a refs server
+            return None
+        if not isinstance(response, dict) or not response.get('served'):
+            return None
+        # the command is running; it takes as long as it takes
+        sock.settimeout(None)
+        try:
+            return _relay(fp, stdout, stderr)
+        except (socket.error, ValueError, KeyError, TypeError) as e:
+            # the command may have written output or changed files, so
+            # it must not be run again here
+            raise ServerError("Bad response from the server: %s" % e)
+    finally:
+        if fp is not None:
+            fp.close()
+        sock.close()
+
+
+def _relay(fp, stdout, stderr):
+    """Copy the output of a served command; return its exit status."""
+    while True:
+        line = fp.readline()
+        if not line:
+            raise ServerError("The server stopped.")
+        response = json.loads(line.decode('utf-8'))
+        if 'status' in response:
+            return response['status']
+        for name, stream in (('stdout', stdout), ('stderr', stderr)):
+            if name in response:
+                if not _write(stream, fp.read(response[name])):
+                    # the reader is gone, e.g., output piped to head
+                    return 0
+
+
+def _write(stream, data):
+    """Write ``data`` to ``stream``; return False if its reader is gone."""
+    stream = getattr(stream, 'buffer', stream)
+    try:
+        stream.write(data)
+        stream.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        return False
+    return True
+
+
+def main():
+    try:
+        status = request(sys.argv[1:])
+    except socket.error:
+        status = None
+    except ServerError as e:
+        sys.stderr.write("refs: %s\n" % e)
+        sys.exit(1)
+    if status is None:
+        from .main import main as run
+        run(prog_name="refs")
+        return
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
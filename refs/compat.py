@@ -4,7 +4,10 @@ import sys
 PY2 = sys.version_info[0] == 2
 
 if PY2:
+    from collections import Iterable
     import ConfigParser as configparser
+    import cPickle as pickle
+    from cgi import escape as _escape
     string_types = (str, unicode)
     int_types = (int, long)
     range = xrange
@@ -12,8 +15,14 @@ if PY2:
     # No iterkeys; use ``for key in dict:`` instead
     iteritems = lambda d: d.iteritems()
     itervalues = lambda d: d.itervalues()
+
+    # text from JSON and the like is unicode; Entry fields are UTF-8 str
+    to_native = lambda s: s.encode('utf-8') if isinstance(s, unicode) else s
 else:
+    from collections.abc import Iterable
     import configparser
+    import pickle
+    from html import escape as _escape
     string_types = (str,)
     int_types = (int,)
     range = range
@@ -22,13 +31,19 @@ else:
     iteritems = lambda d: iter(d.items())
     itervalues = lambda d: iter(d.values())
 
+    to_native = lambda s: s
+
+
+def html_escape(s):
+    return _escape(s, True)
+
 
 def is_integer(obj):
     return isinstance(obj, int_types)
 
 
 def is_iterable(obj):
-    return isinstance(obj, collections.Iterable)
+    return isinstance(obj, Iterable)
 
 
 def is_string(obj):
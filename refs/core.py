@@ -14,6 +14,7 @@
 # TODO add __enter__ and __exit__ to make a context manager
 
 import logging
+import multiprocessing
 import re
 import os.path
 import string
@@ -23,7 +24,8 @@ import urlparse
 import warnings
 
 from .compat import is_integer, is_iterable, is_string, range
-from .utils import english_join, fuzzymatch, mogrify
+from .files import atomic_open, copy_range, locked
+from .utils import collate, english_join, fuzzymatch, mogrify, name_tokens
 
 
 # lists of required and optional fields for each reference type
@@ -134,6 +136,13 @@ class Entry(object):
         self.key = key
         self.fieldDict = {}
         self.bibliography = bib
+        # the text this entry was parsed from, if any; while the entry is
+        # not dirty, the source is written out instead of re-serializing.
+        # Code that modifies fieldDict directly must set dirty itself.
+        self.source = None
+        self.dirty = True
+        # offsets of the source text in the file it was loaded from
+        self.span = None
         logging.debug("New entry %s", key)
 
     def __str__(self):
@@ -162,16 +171,20 @@ class Entry(object):
     def brief(self):
         print(self)
 
-    def display(self):
-        r = "%12s: %s\n" % ("CiteKey", self.key)
+    def format_display(self):
+        """Return the entry as readable text, one field per line."""
+        r = ["%12s: %s\n" % ("CiteKey", self.key)]
         for k in self.fieldDict:
             if k[0] == '_':
                 continue
             if k == 'Author':
-                r += "%12s: %s\n" % (k, self.authors)
+                r.append("%12s: %s\n" % (k, self.authors))
             else:
-                r += "%12s: %s\n" % (k, self.fieldDict[k])
-        print(r)
+                r.append("%12s: %s\n" % (k, self.fieldDict[k]))
+        return "".join(r)
+
+    def display(self):
+        print(self.format_display())
 
     def __getitem__(self, i):
         if is_string(i):
@@ -179,6 +192,19 @@ class Entry(object):
         else:
             raise KeyError
 
+    @property
+    def key(self):
+        return self._key
+
+    @key.setter
+    def key(self, value):
+        old = getattr(self, '_key', None)
+        self._key = value
+        self.dirty = True
+        bib = getattr(self, 'bibliography', None)
+        if bib is not None and old is not None and old != value:
+            bib._rekey(self, old)
+
     def check(self):
         keys = list(self.fieldDict)
         missing = []
@@ -191,11 +217,34 @@ class Entry(object):
                 missing.append(k)
         return missing
 
+    def resolve_abbrev(self, abbrevs):
+        """Replace field values that are abbreviations by their values."""
+        for field, v in list(self.fieldDict.items()):
+            if field[0] == '_' or field == 'Type' or not is_string(v):
+                continue
+            if abbrevs.get(v):
+                self.fieldDict[field] = abbrevs[v]
+                self.dirty = True
+
     def get(self, field, default=None):
         if field in self.fieldDict:
             return self.fieldDict[field]
         return default
 
+    def value(self, field, default=""):
+        """Return the text of a field, whether stored as 'field' or 'Field'.
+        """
+        for k in (field.lower(), field.capitalize()):
+            if k in self.fieldDict:
+                v = self.fieldDict[k]
+                return " and ".join(v) if isinstance(v, list) else v
+        return default
+
+    def names(self, field='author'):
+        """Return the list of names in an author or editor field."""
+        v = self.value(field)
+        return [name.strip() for name in v.split(" and ")] if v else []
+
     @property
     def title(self):
         if 'Title' in self.fieldDict:
@@ -306,16 +355,22 @@ class Entry(object):
     def year(self):
         return self.get('_year', -1)
 
+    def _field_key(self, field):
+        """Return the key of ``field``: as it was loaded, or capitalized."""
+        return field if field in self.fieldDict else field.capitalize()
+
     @year.setter
     def year(self, value):
-        self.fieldDict['Year'] = value
+        self.fieldDict[self._field_key('year')] = value
         # remove all text like "to appear", just leave the digits
         year = ''.join([c for c in value if c.isdigit()])
         try:
             self.fieldDict['_year'] = int(year)
         except ValueError:
-            warnings.warn("[%s] cannot parse year; got '%s'", self.key, value)
+            warnings.warn("[%s] cannot parse year; got '%s'" % (
+                self.key, value))
             self.fieldDict['_year'] = -1
+        self.dirty = True
 
     @property
     def month(self):
@@ -327,13 +382,17 @@ class Entry(object):
         # the Month entry has the original string from the file if it is of
         # nonstandard form, else is None.
         # the hidden entry _month has the ordinal number
-        self.fieldDict['Month'] = value
+        self.fieldDict[self._field_key('month')] = value
         month = mogrify(value)
         for monthname in self.months:
             if (month.lower() in monthname.lower()
                     or month.find(monthname) >= 0):
                 self.fieldDict['_month'] = self.months.index(monthname) + 1
-            warnings.warn("[%s] cannot parse month; got '%s'", self.key, value)
+                break
+        else:
+            warnings.warn("[%s] cannot parse month; got '%s'" % (
+                self.key, value))
+        self.dirty = True
 
     @property
     def month_name(self):
@@ -354,6 +413,7 @@ class Entry(object):
             raise AttributeError("[%s] Bad reference type '%s'" % (
                 self.key, value))
         self.fieldDict['Type'] = value
+        self.dirty = True
 
     def set(self, key, value):
         def _strip(s):
@@ -378,45 +438,45 @@ class Entry(object):
             self.month = month
         else:
             self.fieldDict[key] = value
+        self.dirty = True
 
-    def write_bibtex(self, fp=sys.stdout):
-        """Write a BibTex format entry."""
-        fp.write("@%s{%s,\n"  % (self.reftype, self.key))
+    def dumps_bibtex(self):
+        """Return the BibTeX format entry as a string."""
+        if self.bibliography is not None:
+            abbrevs = self.bibliography.abbrevs
+        else:
+            abbrevs = ()
+        nfields = len(self.fieldDict)
+
+        out = ["@%s{%s,\n" % (self.reftype, self.key)]
         count = 0
-        for rk in self.fieldDict:
+        for rk, value in self.fieldDict.items():
             count += 1
             # skip internally used fields
-            if rk[0] == '_':
-                continue
-            if rk == 'Type':
+            if rk[0] == '_' or rk == 'Type':
                 continue
 
             # generate the entry
-            value = self.fieldDict[rk]
-            fp.write("  %s=" % rk)
-
-            if rk in ['Author', 'Editor']:
-                fp.write("{%s}" % " and ".join(value))
+            if rk in ('Author', 'Editor'):
+                out.append("  %s={%s}" % (rk, " and ".join(value)))
             elif rk == 'Month':
                 if value:
-                    fp.write("{%s}" % value)
+                    out.append("  %s={%s}" % (rk, value))
                 else:
-                    value = self.month_name
-                    fp.write("%s" % value[:3].lower())
+                    out.append("  %s=%s" % (rk, self.month_name[:3].lower()))
+            elif value in abbrevs:
+                out.append("  %s=%s" % (rk, value))
             else:
-                # is it an abbrev?
-                if (self.bibliography is not None
-                    and value in self.bibliography.abbrevs):
-                    fp.write("%s" % value)
-                else:
-                    fp.write("{%s}" % value)
+                out.append("  %s={%s}" % (rk, value))
 
             # add comma to all but last fields
-            if count < len(self.fieldDict):
-                fp.write(",\n")
-            else:
-                fp.write("\n")
-        fp.write("}\n")
+            out.append(",\n" if count < nfields else "\n")
+        out.append("}\n")
+        return "".join(out)
+
+    def write_bibtex(self, fp=sys.stdout):
+        """Write a BibTex format entry."""
+        fp.write(self.dumps_bibtex())
 
     def search(self, target, field="all", ignorecase=True):
         def _search(field):
@@ -424,12 +484,11 @@ class Entry(object):
                 warnings.warn("Field '%s' not present." % field)
                 return False
             s = self.fieldDict[field]
-            if is_iterable(s):
+            if is_iterable(s) and not is_string(s):
                 s = ' '.join(s)
             if s:
-                args = (target, s) + (re.IGNORECASE,) if ignorecase else ()
-                m = re.search(*args)
-                if m:
+                flags = re.IGNORECASE if ignorecase else 0
+                if re.search(target, s, flags):
                     return True
 
         if field.lower() == 'all':
@@ -559,11 +618,378 @@ class Entry(object):
         return True
 
 
+class BibLexer(object):
+    """Lexical analyzer for bibtex format files."""
+    def __init__(self, s):
+        self.in_str = s  # the string to parse
+        self.linenum = 1
+        self.pos = 0
+
+    def next(self):
+        """Iterator for the class, return next character."""
+        if self.pos >= len(self.in_str):
+            raise StopIteration
+        c = self.in_str[self.pos]
+        if c == '\n':
+            self.linenum += 1
+        self.pos += 1
+        return c
+
+    def __iter__(self):
+        return self
+
+    def peek(self):
+        """Peek at the next character."""
+        return self.in_str[self.pos]
+
+    def pushback(self, c):
+        """Push a character back onto the input."""
+        self.pos -= 1
+        if c == '\n':
+            self.linenum -= 1
+
+    def skipwhite(self):
+        """Eat whitepsace characters and comments."""
+        for c in self:
+            if c == '%':
+                for c in self:
+                    if c == '\n':
+                        break
+            elif not c.isspace():
+                self.pushback(c)
+                break
+
+    def show(self):
+        print >> sys.stderr, "[%c]%s" % (
+            self.in_str[0], self.in_str[1:10])
+
+    def nextword(self):
+        """Get the next word from the input stream.
+
+        A word can be:
+        - [alpha][alnum$_-]
+        - "...."
+        - {....}
+        """
+        word = ""
+        c = self.peek()
+
+        if c == '"':
+            # quote delimited string
+            word = self.next()
+            cp = None  # prev char
+            for c in self:
+                word += c
+                if c == '"' and cp != '\\':
+                    break
+                cp = c
+        elif c == '{':
+            # brace delimited string
+            count = 0
+            for c in self:
+                if c == '{':
+                    count += 1
+                if c == '}':
+                    count -= 1
+
+                word += c
+                if count == 0:
+                    break
+        else:
+            # undelimited string
+            for c in self:
+                if c.isalnum():
+                    word += c
+                elif c in ".+-_$:'":
+                    word += c
+                else:
+                    self.pushback(c)
+                    break
+        return word
+
+class Token(object):
+    ENTRY = 1
+    DELIM_L = 2
+    DELIM_R = 3
+    STRING = 5
+    EQUAL = 6
+    COMMA = 7
+
+    def __init__(self, val=None, typ=None):
+        self.val = val
+        self.typ = typ
+
+    def __repr__(self):
+        if self.is_entry():
+            return "@ %s" % self.val
+        elif self.is_delim_r():
+            return "  }"
+        elif self.is_string():
+            return "<%s>" % self.val
+        elif self.is_equal():
+            return "  EQUAL"
+        elif self.is_comma():
+            return "  COMMA"
+        else:
+            return "BAD TOKEN (%d) <%s>" % (self.typ, self.val)
+
+    def is_string(self):
+        return self.typ == self.STRING
+
+    def is_abbrev(self):
+        return self.is_string() and self.val.isalnum()
+
+    def is_comma(self):
+        return self.typ == self.COMMA
+
+    def is_equal(self):
+        return self.typ == self.EQUAL
+
+    def is_entry(self):
+        return self.typ == self.ENTRY
+
+    def is_delim_r(self):
+        return self.typ == self.DELIM_R
+
+    def is_delim_l(self):
+        return self.typ == self.DELIM_L
+
+class BibTokenizer(object):
+    """Tokenizer for bibtex format files."""
+
+    def __init__(self, s):
+        self.lex = BibLexer(s)
+
+    def __iter__(self):
+        """Setup an iterator for the next token."""
+        return self
+
+    def next(self):
+        """Return next token."""
+        self.lex.skipwhite()
+        c = self.lex.next()
+        t = Token()
+
+        if c == '@':
+            t.typ = t.ENTRY
+            self.lex.skipwhite()
+            t.val = self.lex.nextword()
+            self.lex.skipwhite()
+            c = self.lex.next()
+            if not (c == '{' or c == '('):
+                raise ValueError("BAD START OF ENTRY")
+        elif c == ',':
+            t.typ = t.COMMA
+        elif c == '=':
+            t.typ = t.EQUAL
+        elif (c == '}') or (c == ')'):
+            t.typ = t.DELIM_R
+        else:
+            self.lex.pushback(c)
+            t.typ = t.STRING
+            t.val = self.lex.nextword()
+        return t
+
+class BibParser(object):
+    def __init__(self, s, bt):
+        self.tok = BibTokenizer(s)
+        self.bibtex = bt
+
+    def __iter__(self):
+        """Set up an iterator for the next entry."""
+        return self
+
+    def next(self):
+        """Return next entry."""
+
+        def _strip(s):
+            if s[0] in '"{':
+                return s[1:-1]
+            else:
+                return s
+
+        self.tok.lex.skipwhite()
+        start = self.tok.lex.pos
+        t = self.tok.next()
+        if not t.is_entry():
+            raise SyntaxError(self.tok.lex.linenum)
+        if t.val.lower() == 'string':
+            tn = self.tok.next()
+            if not tn.is_string():
+                raise SyntaxError(self.tok.lex.linenum)
+            t = self.tok.next()
+            if not t.is_equal():
+                raise SyntaxError(self.tok.lex.linenum)
+            tv = self.tok.next()
+            if not tv.is_string():
+                raise SyntaxError(self.tok.lex.linenum)
+            # insert string into the string table
+            self.bibtex.insert_abbrev(tn.val, _strip(tv.val))
+            t = self.tok.next()
+            if not t.is_delim_r():
+                raise SyntaxError(self.tok.lex.linenum)
+        elif t.val.lower() == 'preamble':
+            # kept verbatim, as BibTeX copies it into its output
+            lex = self.tok.lex
+            close = '}' if lex.in_str[lex.pos - 1] == '{' else ')'
+            depth = 0
+            for c in lex:
+                if c == close and depth == 0:
+                    break
+                if c == '{':
+                    depth += 1
+                elif c == '}':
+                    depth -= 1
+            self.bibtex.preambles.append(lex.in_str[start:lex.pos])
+        elif t.val.lower() == 'comment':
+            depth = 0
+            while True:
+                tn = self.tok.next()
+                if t.is_delim_l():
+                    depth += 1
+                if t.is_delim_r():
+                    depth -= 1
+                    if depth == 0:
+                        break
+        else:
+            # NOT A STRING or COMMENT ENTRY
+            # assume a normal reference type
+
+            # get the cite key
+            ck = self.tok.next()
+            if not ck.is_string():
+                raise SyntaxError(self.tok.lex.linenum)
+
+            entry = Entry(ck.val, self.bibtex)
+            entry.reftype = t.val
+
+            # get the comma
+            ck = self.tok.next()
+            if not ck.is_comma():
+                raise SyntaxError(self.tok.lex.linenum)
+
+            # get the field value pairs
+            for tf in self.tok:
+                # allow for poor syntax with comma before end brace
+                if tf.is_delim_r():
+                    break
+                if not tf.is_string():
+                    raise SyntaxError(self.tok.lex.linenum)
+                t = self.tok.next()
+                if not t.is_equal():
+                    raise SyntaxError(self.tok.lex.linenum)
+                ts = self.tok.next()
+                if not ts.is_string():
+                    raise SyntaxError(self.tok.lex.linenum)
+                entry.set(tf.val, _strip(ts.val))
+
+                # if it was an abbrev in the file, put it in the
+                # abbrevDict so it gets written as an abbrev
+                if (ts.is_abbrev()
+                        and ts.val not in self.bibtex.abbrevs):
+                    self.bibtex.insert_abbrev(ts.val, None)
+
+                t = self.tok.next()
+                if t.is_comma():
+                    continue
+                elif t.is_delim_r():
+                    break
+                else:
+                    raise SyntaxError(self.tok.lex.linenum)
+
+            # keep the original text for byte-preserving writes
+            entry.source = self.tok.lex.in_str[start:self.tok.lex.pos]
+            entry.span = (start, self.tok.lex.pos)
+            entry.dirty = False
+            self.bibtex.insert_entry(entry)
+        return
+
+
+def _year_key(entry):
+    year = "".join([c for c in entry.value('year') if c.isdigit()])
+    return (0, int(year)) if year else (1, 0)
+
+
+def _month_key(entry):
+    month = entry.value('month').strip().lower()
+    if month.isdigit():
+        return (0, int(month))
+    for i, name in enumerate(Entry.months):
+        if month and name.lower().startswith(month[:3]):
+            return (0, i + 1)
+    return (1, 0)
+
+
+def _author_key(entry):
+    names = entry.names('author') or entry.names('editor')
+    if not names:
+        return (1, "")
+    name = names[0]
+    if "," in name:
+        surname = name.split(",")[0]
+    else:
+        # an empty name, e.g., from a stray "and", has no surname
+        tokens = name_tokens(name)
+        if not tokens:
+            return (1, "")
+        surname = tokens[-1]
+    return (0, collate(surname))
+
+
+def _title_key(entry):
+    title = collate(entry.value('title'))
+    return (0 if title else 1, title)
+
+
+# functions computing the sort key for each field that can be sorted on
+sort_fields = {
+    'key': lambda entry: entry.key,
+    'year': _year_key,
+    'month': _month_key,
+    'author': _author_key,
+    'title': _title_key,
+    'reftype': lambda entry: entry.reftype,
+}
+
+
+def sort_key(by=('key',)):
+    """Return a function computing the sort key of an entry.
+
+    ``by`` is a sequence of names from `.sort_fields`. Text is collated
+    with `.utils.collate`; entries missing a field sort after entries
+    that have it.
+    """
+    for field in by:
+        if field not in sort_fields:
+            raise ValueError("Cannot sort by '%s'; choose from %s." % (
+                field, ", ".join(sorted(sort_fields))))
+    keyfuncs = [sort_fields[field] for field in by]
+    if len(keyfuncs) == 1:
+        return keyfuncs[0]
+    return lambda entry: tuple([f(entry) for f in keyfuncs])
+
+
+class FileChangedError(IOError):
+    """A file changed on disk in a way that conflicts with the changes
+    being saved to it."""
+
+
 class Bibliography(object):
     def __init__(self):
         self.bibentries = []
+        # citekey -> entry, for the entries in bibentries
+        self._index = {}
         self.abbrevs = {}
         self.stringDict = {}
+        # the text of the @preamble blocks
+        self.preambles = []
+        # the file this bibliography was loaded from, its state when it
+        # was read, and the entries it contained; used by save_bibtex
+        self.path = None
+        self._stat = None
+        self._loaded = []
+        # the abbreviations defined in that file
+        self._file_abbrevs = set()
 
     def open(self, path_or_url):
         if path_or_url == '-':
@@ -594,26 +1020,78 @@ class Bibliography(object):
     def resolve_abbrev(self):
         """Resolve all abbreviations found in value fields."""
         for entry in self:
-            for field in entry:
-                v = entry.get(f)
-                if is_string(v):
-                    if v in self.abbrevs:
-                        if self.abbrevs[v]:
-                            entry.setField(f, self.abbrevs[v])
+            entry.resolve_abbrev(self.abbrevs)
+
+    def _rekey(self, entry, old):
+        """Move ``entry`` in the index after its key changed from ``old``."""
+        if self._index.get(old) is not entry:
+            return
+        if entry.key in self._index:
+            entry._key = old
+            raise ValueError(
+                "key %s already exists. Please change the key." % entry.key)
+        del self._index[old]
+        self._index[entry.key] = entry
 
     def insert_entry(self, entry):
         if not isinstance(entry, Entry):
             raise TypeError("Can only insert Entry instances.")
-        if entry.key in self.keys:
+        if entry.key in self._index:
             raise ValueError(
                 "key %s already exists. Please change the key." % entry.key)
         self.bibentries.append(entry)
+        self._index[entry.key] = entry
+
+    def insert_entries(self, entries):
+        """Insert several entries.
+
+        Either all of the entries are inserted or, if one of them is
+        invalid, none of them.
+        """
+        new = {}
+        ordered = []
+        for entry in entries:
+            if not isinstance(entry, Entry):
+                raise TypeError("Can only insert Entry instances.")
+            if entry.key in self._index or entry.key in new:
+                raise ValueError(
+                    "key %s already exists. Please change the key."
+                    % entry.key)
+            new[entry.key] = entry
+            ordered.append(entry)
+        self.bibentries.extend(ordered)
+        self._index.update(new)
+
+    def remove_entry(self, key):
+        """Remove and return the entry with citekey ``key``."""
+        entry = self[key]
+        self.bibentries.remove(entry)
+        del self._index[key]
+        return entry
 
     def insert_abbrev(self, abbrev, value):
-        if abbrev in self.abbrevs:
+        # abbreviations used before they are defined are stored as None
+        if self.abbrevs.get(abbrev) is not None:
             raise ValueError("abbrev %s already exists." % abbrev)
         self.abbrevs[abbrev] = value
 
+    def copy_abbrevs(self, entry, abbrevs):
+        """Define the abbreviations of ``abbrevs`` that ``entry`` uses.
+
+        Used when ``entry`` is copied here from another bibliography, so
+        that its fields do not refer to undefined abbreviations.
+        """
+        for field, value in entry.fieldDict.items():
+            if field[0] == '_' or field == 'Type' or not is_string(value):
+                continue
+            if (abbrevs.get(value) is not None
+                    and self.abbrevs.get(value) is None):
+                self.abbrevs[value] = abbrevs[value]
+
+    def _defined_abbrevs(self):
+        return set(abbrev for abbrev, value in self.abbrevs.items()
+                   if value is not None)
+
     def brief(self):
         for entry in self:
             entry.brief()
@@ -623,21 +1101,30 @@ class Bibliography(object):
             entry.display()
 
     def __contains__(self, key):
-        return key in self.keys
+        return key in self._index
 
     def __getitem__(self, idx):
         if is_string(idx):
-            return self.bibentries[self.keys.index(idx)]
+            try:
+                return self._index[idx]
+            except KeyError:
+                raise ValueError("%s is not in the bibliography." % idx)
         elif is_integer(idx):
             return self.bibentries[idx]
         raise KeyError("Can only index in with strings or integers.")
 
+    def __iter__(self):
+        return iter(self.bibentries)
+
     def __len__(self):
         return len(self.bibentries)
 
-    def sort(self):
-        """Sort entries by key."""
-        self.bibentries.sort(key=lambda be: be.key)
+    def sort(self, by=('key',), reverse=False):
+        """Sort entries by one or more of the fields in `.sort_fields`.
+
+        Sort keys are computed once per entry; see `.sort_key`.
+        """
+        self.bibentries.sort(key=sort_key(by), reverse=reverse)
 
     def search(self, key, target, reftype="all", ignorecase=True):
         if target == '*':
@@ -646,288 +1133,131 @@ class Bibliography(object):
         result = []
         for entry in self:
             if ((reftype.lower() == 'all' or entry.reftype == reftype)
-                    and entry.search(key, target, ignorecase)):
+                    and entry.search(target, key, ignorecase)):
                 result.append(entry)
         return result
 
-    def load_bibtex(self, path_or_url=None, ignore=False):
-        if path_or_url == None:
+    def iter_bibtex(self, path_or_url=None):
+        """Parse entries lazily, yielding each one as soon as it is read.
+
+        ``path_or_url`` may also be an open file. Entries are not added to
+        the bibliography, so memory use does not grow with the size of
+        the input, but abbreviations are collected as usual. Parsing
+        stops as soon as the caller stops iterating.
+
+        A file is read as it was when it was opened, under a shared
+        lock that is released before the first entry is yielded:
+        writers replace the file, or append to it, so the text it had
+        then stays the same.
+        """
+        size = None
+        if path_or_url is None:
             fp = sys.stdin
+        elif is_string(path_or_url):
+            path = path_or_url if os.path.isfile(path_or_url) else None
+            with locked(path):
+                fp = self.open(path_or_url)
+                if path is not None:
+                    size = os.fstat(fp.fileno()).st_size
         else:
-            fp = self.open(path_or_url)
+            fp = path_or_url
 
-        # get the file into one huge string
-        nbib = 0
-        s = fp.read()
-        return self.loads_bibtex(s, ignore=ignore)
-
-    def loads_bibtex(self, s, ignore=False):
-        class BibLexer(object):
-            """Lexical analyzer for bibtex format files."""
-            def __init__(self, s):
-                self.in_str = s  # the string to parse
-                self.linenum = 1
-                self.pos = 0
-
-            def next(self):
-                """Iterator for the class, return next character."""
-                if self.pos >= len(self.in_str):
-                    raise StopIteration
-                c = self.in_str[self.pos]
-                if c == '\n':
-                    self.linenum += 1
-                self.pos += 1
-                return c
-
-            def __iter__(self):
-                return self
-
-            def peek(self):
-                """Peek at the next character."""
-                return self.in_str[self.pos]
-
-            def pushback(self, c):
-                """Push a character back onto the input."""
-                self.pos -= 1
-                if c == '\n':
-                    self.linenum -= 1
-
-            def skipwhite(self):
-                """Eat whitepsace characters and comments."""
-                for c in self:
-                    if c == '%':
-                        for c in self:
-                            if c == '\n':
-                                break
-                    elif not c.isspace():
-                        self.pushback(c)
-                        break
+        try:
+            lines = fp if size is None else _read_lines(fp, size)
+            for block in iter_bibtex_blocks(lines):
+                if _comment_re.match(block):
+                    continue
+                n = len(self.bibentries)
+                self.loads_bibtex(block)
+                new = self.bibentries[n:]
+                del self.bibentries[n:]
+                for entry in new:
+                    del self._index[entry.key]
+                for entry in new:
+                    yield entry
+        finally:
+            if fp is not path_or_url and fp is not sys.stdin:
+                self.close(fp)
 
-            def show(self):
-                print >> sys.stderr, "[%c]%s" % (
-                    self.in_str[0], self.in_str[1:10])
-
-            def nextword(self):
-                """Get the next word from the input stream.
-
-                A word can be:
-                - [alpha][alnum$_-]
-                - "...."
-                - {....}
-                """
-                word = ""
-                c = self.peek()
-
-                if c == '"':
-                    # quote delimited string
-                    word = self.next()
-                    cp = None  # prev char
-                    for c in self:
-                        word += c
-                        if c == '"' and cp != '\\':
-                            break
-                        cp = c
-                elif c == '{':
-                    # brace delimited string
-                    count = 0
-                    for c in self:
-                        if c == '{':
-                            count += 1
-                        if c == '}':
-                            count -= 1
-
-                        word += c
-                        if count == 0:
-                            break
-                else:
-                    # undelimited string
-                    for c in self:
-                        if c.isalnum():
-                            word += c
-                        elif c in ".+-_$:'":
-                            word += c
-                        else:
-                            self.pushback(c)
-                            break
-                return word
-
-        class Token(object):
-            ENTRY = 1
-            DELIM_L = 2
-            DELIM_R = 3
-            STRING = 5
-            EQUAL = 6
-            COMMA = 7
-
-            def __init__(self, val=None, typ=None):
-                self.val = val
-                self.typ = typ
-
-            def __repr__(self):
-                if self.is_entry():
-                    return "@ %s" % self.val
-                elif self.is_delim_r():
-                    return "  }"
-                elif self.is_string():
-                    return "<%s>" % self.val
-                elif self.is_equal():
-                    return "  EQUAL"
-                elif self.is_comma():
-                    return "  COMMA"
-                else:
-                    return "BAD TOKEN (%d) <%s>" % (self.typ, self.val)
-
-            def is_string(self):
-                return self.typ == self.STRING
-
-            def is_abbrev(self):
-                return self.is_string() and self.val.isalnum()
-
-            def is_comma(self):
-                return self.typ == self.COMMA
-
-            def is_equal(self):
-                return self.typ == self.EQUAL
-
-            def is_entry(self):
-                return self.typ == self.ENTRY
-
-            def is_delim_r(self):
-                return self.typ == self.DELIM_R
-
-            def is_delim_l(self):
-                return self.typ == self.DELIM_L
-
-        class BibTokenizer(object):
-            """Tokenizer for bibtex format files."""
-
-            def __init__(self, s):
-                self.lex = BibLexer(s)
-
-            def __iter__(self):
-                """Setup an iterator for the next token."""
-                return self
-
-            def next(self):
-                """Return next token."""
-                self.lex.skipwhite()
-                c = self.lex.next()
-                t = Token()
-
-                if c == '@':
-                    t.typ = t.ENTRY
-                    self.lex.skipwhite()
-                    t.val = self.lex.nextword()
-                    self.lex.skipwhite()
-                    c = self.lex.next()
-                    if not (c == '{' or c == '('):
-                        raise ValueError("BAD START OF ENTRY")
-                elif c == ',':
-                    t.typ = t.COMMA
-                elif c == '=':
-                    t.typ = t.EQUAL
-                elif (c == '}') or (c == ')'):
-                    t.typ = t.DELIM_R
-                else:
-                    self.lex.pushback(c)
-                    t.typ = t.STRING
-                    t.val = self.lex.nextword()
-                return t
-
-        class BibParser(object):
-            def __init__(self, s, bt):
-                self.tok = BibTokenizer(s)
-                self.bibtex = bt
-
-            def __iter__(self):
-                """Set up an iterator for the next entry."""
-                return self
-
-            def next(self):
-                """Return next entry."""
-
-                def _strip(s):
-                    if s[0] in '"{':
-                        return s[1:-1]
-                    else:
-                        return s
+    def load_bibtex(self, path_or_url=None, ignore=False):
+        is_file = path_or_url is not None and os.path.isfile(path_or_url)
+        # a shared lock keeps writers out while the file is read
+        with locked(path_or_url if is_file else None):
+            if path_or_url == None:
+                fp = sys.stdin
+            else:
+                fp = self.open(path_or_url)
+
+            # get the file into one huge string
+            nbib = 0
+            s = fp.read()
+            stat = self._file_stat(path_or_url) if is_file else None
+            if fp is not sys.stdin:
+                self.close(fp)
+
+        n = len(self.bibentries)
+        bibcount = self.loads_bibtex(s, ignore=ignore)
+
+        if self.path is None and not self._loaded and is_file:
+            self.path = os.path.abspath(path_or_url)
+            self._stat = stat
+            self._loaded = self.bibentries[n:]
+            self._file_abbrevs = self._defined_abbrevs()
+        else:
+            # entries come from several sources; spans are ambiguous
+            self.path = None
+            self._loaded = []
+        return bibcount
 
-                t = self.tok.next()
-                if not t.is_entry():
-                    raise SyntaxError(self.tok.lex.linenum)
-                if t.val.lower() == 'string':
-                    tn = self.tok.next()
-                    if not tn.is_string():
-                        raise SyntaxError(self.tok.lex.linenum)
-                    t = self.tok.next()
-                    if not t.isequal():
-                        raise SyntaxError(self.tok.lex.linenum)
-                    tv = self.tok.next()
-                    if not tv.isstring():
-                        raise SyntaxError(self.tok.lex.linenum)
-                    # insert string into the string table
-                    self.bibtex.insert_abbrev(tn.val, _strip(tv.val))
-                    t = self.tok.next()
-                    if not t.is_delim_r():
-                        raise SyntaxError(self.tok.lex.linenum)
-                elif t.val.lower() == 'comment':
-                    depth = 0
-                    while True:
-                        tn = self.tok.next()
-                        if t.is_delim_l():
-                            depth += 1
-                        if t.is_delim_r():
-                            depth -= 1
-                            if depth == 0:
-                                break
-                else:
-                    # NOT A STRING or COMMENT ENTRY
-                    # assume a normal reference type
-
-                    # get the cite key
-                    ck = self.tok.next()
-                    if not ck.is_string():
-                        raise SyntaxError(self.tok.lex.linenum)
-
-                    entry = Entry(ck.val, self.bibtex)
-                    entry.reftype = t.val
-
-                    # get the comma
-                    ck = self.tok.next()
-                    if not ck.is_comma():
-                        raise SyntaxError(self.tok.lex.linenum)
-
-                    # get the field value pairs
-                    for tf in self.tok:
-                        # allow for poor syntax with comma before end brace
-                        if tf.is_delim_r():
-                            break
-                        if not tf.is_string():
-                            raise SyntaxError(self.tok.lex.linenum)
-                        t = self.tok.next()
-                        if not t.is_equal():
-                            raise SyntaxError(self.tok.lex.linenum)
-                        ts = self.tok.next()
-                        if not ts.is_string():
-                            raise SyntaxError(self.tok.lex.linenum)
-                        entry.set(tf.val, _strip(ts.val))
-
-                        # if it was an abbrev in the file, put it in the
-                        # abbrevDict so it gets written as an abbrev
-                        if ts.is_abbrev():
-                            self.bibtex.insert_abbrev(ts.val, None)
-
-                        t = self.tok.next()
-                        if t.is_comma():
-                            continue
-                        elif t.is_delim_r():
-                            break
-                        else:
-                            raise SyntaxError(self.tok.lex.linenum)
-
-                    self.bibtex.insert_entry(entry)
-                return
+    def reload_bibtex(self, path=None):
+        """Bring the bibliography up to date with its file after it changed.
+
+        Entries whose text did not change are kept as they are, so only
+        new and edited entries are parsed. Changes made in memory since
+        loading are discarded. Returns the number of entries parsed.
+        """
+        path = os.path.abspath(self.path if path is None else path)
+        with locked(path):
+            with open(path, 'r') as fp:
+                s = fp.read()
+            stat = self._file_stat(path)
+
+        unchanged = {}
+        for entry in self.bibentries:
+            if not entry.dirty and entry.source is not None:
+                unchanged[entry.source] = entry
+        # kept entries may use abbreviations; @string blocks are parsed
+        # again and give them their values
+        self.abbrevs = dict((abbrev, None) for abbrev in self.abbrevs)
+        self.preambles = []
+        self.bibentries = []
+        self._index = {}
+
+        parsed = 0
+        pos = 0
+        for block in iter_bibtex_blocks(s.splitlines(True)):
+            start = s.find(block, pos)
+            pos = start + len(block)
+            entry = unchanged.pop(block, None)
+            if entry is not None:
+                entry.span = (start, pos)
+                self.insert_entry(entry)
+                continue
+            if _comment_re.match(block):
+                continue
+            n = len(self.bibentries)
+            self.loads_bibtex(block)
+            for entry in self.bibentries[n:]:
+                entry.span = (start + entry.span[0], start + entry.span[1])
+                parsed += 1
+
+        self.path = path
+        self._stat = stat
+        self._loaded = self.bibentries[:]
+        self._file_abbrevs = self._defined_abbrevs()
+        return parsed
 
+    def loads_bibtex(self, s, ignore=False):
         bibparser = BibParser(s, self)
         bibcount = 0
         try:
@@ -940,13 +1270,257 @@ class Bibliography(object):
         return bibcount
 
 
-    def write_bibtex(self, file=sys.stdout):
+    def dumps_strings(self):
+        """Return the @preamble blocks and @string definitions in BibTeX
+        format, for writing before the entries that use them."""
+        return ("".join([preamble + "\n" for preamble in self.preambles])
+                + self._dumps_abbrevs())
+
+    def _dumps_abbrevs(self, skip=()):
+        return "".join(["@string{%s = {%s}}\n" % (abbrev, self.abbrevs[abbrev])
+                        for abbrev in sorted(self.abbrevs)
+                        if self.abbrevs[abbrev] is not None
+                        and abbrev not in skip])
+
+    @staticmethod
+    def _dumps_entry(entry, passthrough):
+        if passthrough and not entry.dirty and entry.source is not None:
+            return entry.source + "\n"
+        return entry.dumps_bibtex()
+
+    def dumps_bibtex(self, passthrough=True):
+        """Return all entries in BibTeX format as a single string.
+
+        If ``passthrough`` is True, entries that have not been modified
+        since they were parsed are emitted exactly as they appeared in
+        the source; only modified entries are re-serialized.
+        """
+        return "".join([self._dumps_entry(entry, passthrough)
+                        for entry in self])
+
+    def write_bibtex(self, file=sys.stdout, bufsize=1 << 20, passthrough=True):
+        """Write all entries in BibTeX format.
+
+        Entries are rendered into a buffer that is flushed to ``file``
+        in blocks of roughly ``bufsize`` characters, so that large
+        bibliographies are written with few ``write`` calls.
+        See `.dumps_bibtex` for ``passthrough``.
+        """
+        chunk = []
+        size = 0
         for entry in self:
-            entry.write_bibtex(file)
+            s = self._dumps_entry(entry, passthrough)
+            chunk.append(s)
+            size += len(s)
+            if size >= bufsize:
+                file.write("".join(chunk))
+                chunk = []
+                size = 0
+        if chunk:
+            file.write("".join(chunk))
+
+    @staticmethod
+    def _file_stat(path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime)
+
+    def _write_tracked(self, fp, entries, offset):
+        """Write entries to ``fp`` starting at ``offset``, recording spans.
+
+        Written entries become clean, with their written text as source.
+        Returns the offset after the last entry.
+        """
+        for entry in entries:
+            s = self._dumps_entry(entry, True)
+            fp.write(s)
+            entry.source = s[:-1]
+            entry.span = (offset, offset + len(s) - 1)
+            entry.dirty = False
+            offset += len(s)
+        return offset
+
+    def _remember_file(self, path):
+        self.path = path
+        self._stat = self._file_stat(path)
+        self._loaded = sorted(self.bibentries, key=lambda e: e.span[0])
+        self._file_abbrevs = self._defined_abbrevs()
+
+    def save_bibtex(self, path=None):
+        """Write changes back to the file this bibliography was loaded from.
+
+        Only entries that were added, removed or modified since loading
+        are written. If the only changes are new entries, they are
+        appended to the file. Otherwise the unchanged byte ranges of the
+        file are copied, with removed and modified entries spliced out or
+        in, to a temporary file that atomically replaces the original.
+
+        Abbreviations defined since loading are written as @string
+        definitions before the entries that were added or, if entries
+        are spliced, at the start of the file.
+
+        If the file has changed on disk since it was loaded, the changes
+        are carried over to it as it is now; see `_rebase`. If the
+        bibliography was not loaded from ``path``, the whole bibliography
+        is written instead. ``path`` must be given if the bibliography
+        was loaded from several files or none.
+        """
+        if path is None and self.path is None:
+            raise ValueError("This bibliography was not loaded from one "
+                             "file; give the path to save it to.")
+        path = os.path.abspath(self.path if path is None else path)
+        # writers wait for readers, and readers never see a partial append
+        with locked(path, exclusive=True):
+            self._save_bibtex(path)
+
+    def _rebase(self, path):
+        """Carry the changes made since loading over to the file as it is.
+
+        Another writer changed the file after it was loaded. It is parsed
+        again, and the entries added, modified or removed here replace
+        its own; its other entries, and the text between entries, are
+        kept. Raises `FileChangedError` if an entry changed here was also
+        changed there.
+        """
+        def conflict(key):
+            raise FileChangedError(
+                "%s changed on disk since it was loaded, and so did '%s'; "
+                "load it again and redo the changes." % (path, key))
+
+        current = set(id(entry) for entry in self.bibentries)
+        loaded = set(id(entry) for entry in self._loaded)
+        fresh = Bibliography()
+        fresh.load_bibtex(path)
+
+        # ids of entries of the file -> the entries here that replace them
+        replaced = {}
+        removed = set()
+        for entry in self._loaded:
+            if id(entry) in current and not entry.dirty:
+                continue
+            key = _source_key(entry.source)
+            theirs = fresh._index.get(key)
+            if theirs is None and id(entry) not in current:
+                continue  # removed there too
+            if theirs is None or theirs.source != entry.source:
+                conflict(key)
+            if id(entry) in current:
+                entry.span = theirs.span
+                replaced[id(theirs)] = entry
+            else:
+                removed.add(id(theirs))
+
+        bibentries = []
+        self._loaded = []
+        for theirs in fresh.bibentries:
+            entry = replaced.get(id(theirs), theirs)
+            entry.bibliography = self
+            self._loaded.append(entry)
+            if id(theirs) not in removed:
+                bibentries.append(entry)
+        bibentries.extend([entry for entry in self.bibentries
+                           if id(entry) not in loaded])
+        index = {}
+        for entry in bibentries:
+            if entry.key in index:
+                conflict(entry.key)
+            index[entry.key] = entry
+        self.bibentries = bibentries
+        self._index = index
+        # abbreviations defined here since loading are still to be written
+        for abbrev in self._defined_abbrevs() - self._file_abbrevs:
+            if fresh.abbrevs.get(abbrev) is None:
+                fresh.abbrevs[abbrev] = self.abbrevs[abbrev]
+        self.abbrevs = fresh.abbrevs
+        self._stat = fresh._stat
+        self._file_abbrevs = fresh._file_abbrevs
+
+    def _save_bibtex(self, path):
+        if path != self.path or not os.path.exists(path):
+            with atomic_open(path, 'wb') as fp:
+                strings = self.dumps_strings()
+                fp.write(strings)
+                self._write_tracked(fp, self.bibentries, len(strings))
+            self._remember_file(path)
+            return
+        if self._file_stat(path) != self._stat:
+            self._rebase(path)
+
+        current = set(id(entry) for entry in self.bibentries)
+        loaded = set(id(entry) for entry in self._loaded)
+        changed = [entry for entry in self._loaded
+                   if id(entry) not in current or entry.dirty]
+        added = [entry for entry in self.bibentries
+                 if id(entry) not in loaded]
+        strings = self._dumps_abbrevs(skip=self._file_abbrevs)
+        if not changed and not added and not strings:
+            return
+
+        size = self._stat[0]
+        if not changed:
+            # cheapest case: new entries go at the end of the file
+            with open(path, 'r+b') as fp:
+                offset = size
+                if size > 0:
+                    fp.seek(size - 1)
+                    if fp.read(1) != "\n":
+                        offset += 1
+                fp.seek(size)
+                if offset > size:
+                    fp.write("\n")
+                fp.write(strings)
+                self._write_tracked(fp, added, offset + len(strings))
+                fp.flush()
+                os.fsync(fp.fileno())
+            self._remember_file(path)
+            return
+
+        def copy(src, dst, start, end):
+            if end <= start:
+                return None
+            copy_range(src, dst, start, end)
+            src.seek(end - 1)
+            return src.read(1)
+
+        with open(path, 'rb') as src:
+            with atomic_open(path, 'wb') as dst:
+                # modified entries may use the new abbreviations
+                dst.write(strings)
+                pos = 0
+                delta = len(strings)
+                last = strings[-1] if strings else None
+                for entry in self._loaded:
+                    start, end = entry.span
+                    if id(entry) not in current:
+                        # drop the entry along with its line ending
+                        src.seek(end)
+                        if src.read(1) == "\n":
+                            end += 1
+                        last = copy(src, dst, pos, start) or last
+                        delta -= end - start
+                        pos = end
+                    elif entry.dirty:
+                        last = copy(src, dst, pos, start) or last
+                        s = entry.dumps_bibtex()[:-1]
+                        dst.write(s)
+                        last = s[-1]
+                        entry.source = s
+                        entry.span = (start + delta, start + delta + len(s))
+                        entry.dirty = False
+                        delta += len(s) - (end - start)
+                        pos = end
+                    else:
+                        entry.span = (start + delta, end + delta)
+                last = copy(src, dst, pos, size) or last
+                offset = size + delta
+                if added:
+                    if last is not None and last != "\n":
+                        dst.write("\n")
+                        offset += 1
+                    self._write_tracked(dst, added, offset)
+        self._remember_file(path)
 
     def write_strings(self, file=sys.stdout):
-        for abbrev, value in self.abbrevDict.items():
-            file.write("@string{ %s = {%s} }\n" % (abbrev, value) )
+        file.write(self.dumps_strings())
 
     # resolve BibTeX's cross reference capability
     def resolve_crossref(self):
@@ -959,3 +1533,105 @@ class Bibliography(object):
             for f in xref:
                 if f not in entry:
                     entry.set(f, xref.get(f))
+
+
+def _load_bibtex_file(path):
+    bib = Bibliography()
+    bib.load_bibtex(path)
+    return bib
+
+
+def load_bibtex_files(paths, processes=None):
+    """Load several bibliographies concurrently.
+
+    Files are parsed in a pool of ``processes`` worker processes
+    (by default, one per file up to the number of CPUs). Bibliographies
+    are yielded in the order of ``paths``, each as soon as it and all
+    of the ones before it have been loaded.
+    """
+    paths = list(paths)
+    if processes is None:
+        processes = min(len(paths), multiprocessing.cpu_count())
+    if processes <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield _load_bibtex_file(path)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for bib in pool.imap(_load_bibtex_file, paths):
+            yield bib
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+_bibtex_delims = re.compile(r"[{}()]")
+_comment_re = re.compile(r"@\s*comment\b", re.IGNORECASE)
+_source_key_re = re.compile(r"@\s*\w+\s*[{(]\s*([^,\s]+)")
+
+
+def _source_key(source):
+    """Return the citekey in the BibTeX text of an entry."""
+    m = _source_key_re.match(source)
+    return m.group(1) if m else None
+
+
+def _read_lines(fp, size):
+    """Yield the lines of the first ``size`` bytes of ``fp``."""
+    while size > 0:
+        line = fp.readline(size)
+        if not line:
+            break
+        size -= len(line)
+        yield line
+
+
+def iter_bibtex_blocks(fp):
+    """Yield the text of each ``@`` block in a BibTeX file, one at a time.
+
+    Each block runs from its ``@`` to its closing delimiter, exactly as it
+    appears in ``fp``. Text between blocks is skipped, as are lines
+    commented out with ``%``. Only the current block is held in memory.
+    """
+    pieces = None
+    for line in fp:
+        pos = 0
+        while True:
+            if pieces is None:
+                # between blocks; find the start of the next one
+                at = line.find('@', pos)
+                if at < 0 or line.find('%', pos, at) >= 0:
+                    break
+                pieces = []
+                start = at
+                pos = at + 1
+                close = None
+                depth = 0
+            for m in _bibtex_delims.finditer(line, pos):
+                c = m.group()
+                if close is None:
+                    if c == '{' or c == '(':
+                        close = '}' if c == '{' else ')'
+                        depth = 1
+                    continue
+                if c == '{':
+                    depth += 1
+                elif c == '}':
+                    depth -= 1
+                elif c == close and depth == 1:
+                    depth = 0
+                if depth == 0:
+                    pos = m.end()
+                    pieces.append(line[start:pos])
+                    yield "".join(pieces)
+                    pieces = None
+                    break
+            else:
+                if pieces is not None:
+                    pieces.append(line[start:])
+                    start = 0
+                break
+    if pieces:
+        # unterminated block; let the parser report it
+        yield "".join(pieces)
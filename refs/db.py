@@ -0,0 +1,407 @@
+"""Store bibliographies in SQLite databases."""
+
+import os
+import sqlite3
+
+from .compat import is_integer, is_string
+from .core import Bibliography, Entry
+from .files import atomic_open, atomic_path, locked
+
+schema = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    reftype TEXT NOT NULL,
+    year INTEGER,
+    doi TEXT,
+    source TEXT
+);
+CREATE TABLE IF NOT EXISTS fields (
+    entry_id INTEGER NOT NULL REFERENCES entries(id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS authors (
+    entry_id INTEGER NOT NULL REFERENCES entries(id),
+    role TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS abbrevs (
+    abbrev TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# created after the bulk insert, which is faster than updating them
+indexes = """
+CREATE UNIQUE INDEX IF NOT EXISTS entries_key ON entries(key);
+CREATE INDEX IF NOT EXISTS entries_reftype ON entries(reftype);
+CREATE INDEX IF NOT EXISTS entries_year ON entries(year);
+CREATE INDEX IF NOT EXISTS entries_doi ON entries(doi);
+CREATE INDEX IF NOT EXISTS fields_entry ON fields(entry_id, position);
+CREATE INDEX IF NOT EXISTS fields_name_value ON fields(name, value);
+CREATE INDEX IF NOT EXISTS authors_entry ON authors(entry_id, role, position);
+CREATE INDEX IF NOT EXISTS authors_name ON authors(name);
+"""
+
+# fields that Entry stores as lists of names
+list_fields = ('Author', 'Editor')
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    # store and return text as str, whatever its encoding
+    conn.text_factory = str
+    return conn
+
+
+def _entry_row(entry_id, entry):
+    year = "".join([c for c in entry.value('year') if c.isdigit()])
+    doi = entry.value('doi').strip().lower()
+    source = None if entry.dirty else entry.source
+    return (entry_id, entry.key, entry.reftype, int(year) if year else None,
+            doi or None, source)
+
+
+def _field_rows(entry_id, entry):
+    fields, authors = [], []
+    position = 0
+    for name, value in entry.fieldDict.items():
+        # Type is stored in entries; fields starting with _ are derived
+        if name == 'Type' or name[0] == '_':
+            continue
+        if name in list_fields:
+            value = " and ".join(value)
+        fields.append((entry_id, position, name, value))
+        position += 1
+    for role in ('author', 'editor'):
+        for position, name in enumerate(entry.names(role)):
+            authors.append((entry_id, role, position, name))
+    return fields, authors
+
+
+def _rows(bib):
+    """Return rows for the entries, fields and authors tables."""
+    entries, fields, authors = [], [], []
+    for entry_id, entry in enumerate(bib, 1):
+        entries.append(_entry_row(entry_id, entry))
+        f, a = _field_rows(entry_id, entry)
+        fields.extend(f)
+        authors.extend(a)
+    return entries, fields, authors
+
+
+def dump_sqlite(bib, path):
+    """Export ``bib`` to a new SQLite database at ``path``.
+
+    All rows are inserted in a single transaction with ``executemany``
+    and indexed afterwards. The database is built in a temporary file
+    that replaces ``path`` when complete.
+    """
+    with atomic_path(path) as tmppath:
+        conn = connect(tmppath)
+        try:
+            conn.executescript(schema)
+            entries, fields, authors = _rows(bib)
+            with conn:
+                conn.executemany(
+                    "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", entries)
+                conn.executemany(
+                    "INSERT INTO fields VALUES (?, ?, ?, ?)", fields)
+                conn.executemany(
+                    "INSERT INTO authors VALUES (?, ?, ?, ?)", authors)
+                conn.executemany(
+                    "INSERT INTO abbrevs VALUES (?, ?)",
+                    sorted(bib.abbrevs.items()))
+            conn.executescript(indexes)
+        finally:
+            conn.close()
+
+
+def _entry(bib, key, reftype, source):
+    entry = Entry(key, bib)
+    entry.fieldDict['Type'] = reftype
+    entry.source = source
+    entry.dirty = source is None
+    return entry
+
+
+def _set_field(entry, name, value):
+    if name in list_fields:
+        value = value.split(" and ")
+    entry.fieldDict[name] = value
+    if name.lower() == 'year':
+        # loading the year does not modify the entry
+        dirty = entry.dirty
+        entry.year = value
+        entry.dirty = dirty
+
+
+def load_sqlite(path, bib=None):
+    """Load a bibliography exported with `.dump_sqlite`.
+
+    Entries are built directly from the database rows, without parsing
+    any BibTeX. Entries that were unmodified when exported keep their
+    original source text. Returns the bibliography.
+    """
+    if bib is None:
+        bib = Bibliography()
+    conn = connect(path)
+    try:
+        entries = {}
+        for entry_id, key, reftype, source in conn.execute(
+                "SELECT id, key, reftype, source FROM entries ORDER BY id"):
+            entries[entry_id] = _entry(bib, key, reftype, source)
+        for entry_id, name, value in conn.execute(
+                "SELECT entry_id, name, value FROM fields "
+                "ORDER BY entry_id, position"):
+            _set_field(entries[entry_id], name, value)
+        for abbrev, value in conn.execute("SELECT abbrev, value FROM abbrevs"):
+            if bib.abbrevs.get(abbrev) is None:
+                bib.abbrevs[abbrev] = value
+    finally:
+        conn.close()
+
+    bib.insert_entries([entries[entry_id] for entry_id in sorted(entries)])
+    return bib
+
+
+class SQLiteBibliography(Bibliography):
+    """A bibliography stored in a SQLite database rather than in memory.
+
+    Nothing is parsed when it is opened. Entries are read from the
+    database when they are looked up or iterated over, and looking up,
+    inserting or removing one entry uses the indexes, so it takes
+    O(log n) time. Changes are committed as they are made.
+
+    Entries are copies of what is in the database: after modifying one,
+    call `update_entry` to store the changes. Use `load_bibtex` to
+    import a BibTeX file and `save_bibtex` to export one.
+    """
+
+    # entries are read from the database this many at a time
+    batch_size = 500
+
+    def __init__(self, path):
+        # not Bibliography.__init__: bibentries is a property here
+        self.db_path = os.path.abspath(path)
+        self.stringDict = {}
+        # @preamble blocks are not stored
+        self.preambles = []
+        self.path = None
+        self._stat = None
+        self._loaded = []
+        self.conn = connect(self.db_path)
+        self.conn.executescript(schema + indexes)
+        self.abbrevs = dict(self.conn.execute(
+            "SELECT abbrev, value FROM abbrevs"))
+
+    def close(self, fp=None):
+        if fp is not None:
+            fp.close()
+        else:
+            self.conn.close()
+
+    def _entries(self, where="", params=()):
+        """Yield the entries selected by ``where``, in insertion order."""
+        cursor = self.conn.execute(
+            "SELECT id, key, reftype, source FROM entries %s ORDER BY id"
+            % where, params)
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            entries = {}
+            for entry_id, key, reftype, source in rows:
+                entry = _entry(self, key, reftype, source)
+                entry._db_id = entry_id
+                entries[entry_id] = entry
+            ids = sorted(entries)
+            for entry_id, name, value in self.conn.execute(
+                    "SELECT entry_id, name, value FROM fields "
+                    "WHERE entry_id IN (%s) ORDER BY entry_id, position"
+                    % ", ".join(["?"] * len(ids)), ids):
+                _set_field(entries[entry_id], name, value)
+            for entry_id in ids:
+                yield entries[entry_id]
+
+    def __iter__(self):
+        return self._entries()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __contains__(self, key):
+        return self.conn.execute("SELECT 1 FROM entries WHERE key = ?",
+                                 (key,)).fetchone() is not None
+
+    def __getitem__(self, idx):
+        if is_string(idx):
+            for entry in self._entries("WHERE key = ?", (idx,)):
+                return entry
+            raise ValueError("%s is not in the bibliography." % idx)
+        elif is_integer(idx):
+            n = idx if idx >= 0 else len(self) + idx
+            if n < 0:
+                # SQLite would take a negative OFFSET as 0
+                raise IndexError("bibliography index out of range")
+            for entry in self._entries(
+                    "WHERE id = (SELECT id FROM entries ORDER BY id "
+                    "LIMIT 1 OFFSET ?)", (n,)):
+                return entry
+            raise IndexError("bibliography index out of range")
+        raise KeyError("Can only index in with strings or integers.")
+
+    @property
+    def bibentries(self):
+        return list(self)
+
+    @property
+    def keys(self):
+        return [key for key, in self.conn.execute(
+            "SELECT key FROM entries ORDER BY id")]
+
+    def _rekey(self, entry, old):
+        # stored by update_entry, like any other change
+        pass
+
+    def _insert(self, entry):
+        try:
+            cursor = self.conn.execute(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                _entry_row(None, entry))
+        except sqlite3.IntegrityError:
+            raise ValueError(
+                "key %s already exists. Please change the key." % entry.key)
+        entry._db_id = cursor.lastrowid
+        fields, authors = _field_rows(entry._db_id, entry)
+        self.conn.executemany("INSERT INTO fields VALUES (?, ?, ?, ?)",
+                              fields)
+        self.conn.executemany("INSERT INTO authors VALUES (?, ?, ?, ?)",
+                              authors)
+        entry.bibliography = self
+
+    def insert_entry(self, entry):
+        self.insert_entries([entry])
+
+    def insert_entries(self, entries):
+        """Insert several entries in one transaction.
+
+        Either all of the entries are inserted or, if one of them is
+        invalid, none of them.
+        """
+        with self.conn:
+            for entry in entries:
+                if not isinstance(entry, Entry):
+                    raise TypeError("Can only insert Entry instances.")
+                self._insert(entry)
+
+    def _delete_fields(self, entry_id):
+        self.conn.execute("DELETE FROM fields WHERE entry_id = ?",
+                          (entry_id,))
+        self.conn.execute("DELETE FROM authors WHERE entry_id = ?",
+                          (entry_id,))
+
+    def update_entry(self, entry):
+        """Store the changes made to ``entry``, including a new key."""
+        with self.conn:
+            row = _entry_row(entry._db_id, entry)
+            try:
+                self.conn.execute(
+                    "UPDATE entries SET key = ?, reftype = ?, year = ?, "
+                    "doi = ?, source = ? WHERE id = ?", row[1:] + row[:1])
+            except sqlite3.IntegrityError:
+                raise ValueError(
+                    "key %s already exists. Please change the key."
+                    % entry.key)
+            self._delete_fields(entry._db_id)
+            fields, authors = _field_rows(entry._db_id, entry)
+            self.conn.executemany("INSERT INTO fields VALUES (?, ?, ?, ?)",
+                                  fields)
+            self.conn.executemany("INSERT INTO authors VALUES (?, ?, ?, ?)",
+                                  authors)
+
+    def remove_entry(self, key):
+        """Remove and return the entry with citekey ``key``."""
+        entry = self[key]
+        with self.conn:
+            self._delete_fields(entry._db_id)
+            self.conn.execute("DELETE FROM entries WHERE id = ?",
+                              (entry._db_id,))
+        return entry
+
+    def insert_abbrev(self, abbrev, value):
+        Bibliography.insert_abbrev(self, abbrev, value)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO abbrevs VALUES (?, ?)",
+                              (abbrev, value))
+
+    def sort(self, by=('key',), reverse=False):
+        raise TypeError("A SQLite bibliography is kept in insertion order; "
+                        "use sorted() instead.")
+
+    def select(self, reftype=None, year=None, author=None, doi=None):
+        """Return the entries matching all of the given values.
+
+        Each value is looked up in an index. ``author`` is a name, as it
+        appears in the author or editor field.
+        """
+        where, params = [], []
+        if reftype is not None:
+            where.append("reftype = ?")
+            params.append(reftype.lower())
+        if year is not None:
+            where.append("year = ?")
+            params.append(int(year))
+        if doi is not None:
+            where.append("doi = ?")
+            params.append(doi.strip().lower())
+        if author is not None:
+            where.append("id IN (SELECT entry_id FROM authors "
+                         "WHERE name = ?)")
+            params.append(author)
+        where = "WHERE " + " AND ".join(where) if where else ""
+        return list(self._entries(where, tuple(params)))
+
+    def search(self, key, target, reftype="all", ignorecase=True):
+        if target == '*':
+            return self.bibentries
+        if reftype.lower() == 'all':
+            entries = self._entries()
+        else:
+            entries = self._entries("WHERE reftype = ?", (reftype,))
+        return [entry for entry in entries
+                if entry.search(target, key, ignorecase)]
+
+    def load_bibtex(self, path_or_url=None, ignore=False):
+        """Import the entries and abbreviations of a BibTeX file."""
+        bib = Bibliography()
+        count = bib.load_bibtex(path_or_url, ignore=ignore)
+        with self.conn:
+            for entry in bib:
+                self._insert(entry)
+            for abbrev, value in bib.abbrevs.items():
+                if self.abbrevs.get(abbrev) is None:
+                    self.abbrevs[abbrev] = value
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO abbrevs VALUES (?, ?)",
+                        (abbrev, value))
+        return count
+
+    def loads_bibtex(self, s, ignore=False):
+        bib = Bibliography()
+        count = bib.loads_bibtex(s, ignore=ignore)
+        self.insert_entries(list(bib))
+        return count
+
+    def save_bibtex(self, path=None):
+        """Export all entries to the BibTeX file ``path``."""
+        if path is None:
+            raise ValueError("A SQLite bibliography must be exported to a "
+                             "path.")
+        with locked(path, exclusive=True):
+            with atomic_open(path, 'wb') as fp:
+                fp.write(self.dumps_strings())
+                self.write_bibtex(fp)
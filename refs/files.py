@@ -0,0 +1,146 @@
+"""Helpers for safely reading and rewriting bibliography files."""
+
+import contextlib
+import errno
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks on this platform
+    fcntl = None
+
+# (lock file path, thread) -> (descriptor, exclusive) of the locks held
+_held = {}
+_held_lock = threading.Lock()
+
+
+def _new_file_mode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+@contextlib.contextmanager
+def atomic_path(path, permissions=None):
+    """Yield a temporary path that replaces ``path`` when done.
+
+    The temporary file is created in the same directory as ``path`` and
+    renamed over it only if the ``with`` block exits without an error,
+    so readers never see a partially written file. It gets
+    ``permissions`` if given, and otherwise those of ``path`` if that
+    exists. It is readable only by the user until it is renamed.
+    """
+    path = os.path.abspath(path)
+    fd, tmppath = tempfile.mkstemp(
+        prefix=".%s." % os.path.basename(path), dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        yield tmppath
+        if permissions is not None:
+            os.chmod(tmppath, permissions)
+        elif os.path.exists(path):
+            os.chmod(tmppath, os.stat(path).st_mode & 0o7777)
+        else:
+            os.chmod(tmppath, _new_file_mode())
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w', permissions=None):
+    """Open a temporary file that replaces ``path`` when closed.
+
+    See `.atomic_path`.
+    """
+    with atomic_path(path, permissions) as tmppath:
+        with open(tmppath, mode) as fp:
+            yield fp
+            fp.flush()
+            os.fsync(fp.fileno())
+
+
+def lock_path(path):
+    """Return the path of the lock file of ``path``."""
+    path = os.path.abspath(path)
+    return os.path.join(os.path.dirname(path),
+                        ".%s.lock" % os.path.basename(path))
+
+
+def _open_lock(lockpath, create):
+    flags = os.O_RDWR | os.O_CREAT if create else os.O_RDONLY
+    try:
+        return os.open(lockpath, flags, 0o666)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.EACCES, errno.EPERM, errno.EROFS):
+            return None
+        raise
+
+
+@contextlib.contextmanager
+def locked(path, exclusive=False):
+    """Hold an advisory lock on the file ``path`` in the ``with`` block.
+
+    Readers take a shared lock, so that they never block each other, and
+    writers an exclusive one, which waits for the readers and writers
+    before it. The lock is taken on a lock file next to ``path``, since
+    writers replace ``path`` itself. Only writers create the lock file,
+    so reading a file in a read-only directory works, unlocked. Locks
+    are reentrant within a thread, and a shared lock that is held is
+    upgraded for an exclusive block. Other threads take the lock on
+    their own descriptor, so they wait for it like other processes.
+    Nothing is locked if ``path`` is None or the platform has no
+    `fcntl.flock`.
+    """
+    if path is None or fcntl is None:
+        yield
+        return
+    key = (lock_path(path), threading.current_thread().ident)
+    with _held_lock:
+        held = _held.get(key)
+    if held is not None:
+        fd, was_exclusive = held
+        upgrade = exclusive and not was_exclusive
+        if upgrade:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with _held_lock:
+                _held[key] = (fd, True)
+        try:
+            yield
+        finally:
+            if upgrade:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                with _held_lock:
+                    _held[key] = (fd, False)
+        return
+
+    fd = _open_lock(key[0], exclusive)
+    if fd is None:
+        yield
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        with _held_lock:
+            _held[key] = (fd, exclusive)
+        yield
+    finally:
+        with _held_lock:
+            _held.pop(key, None)
+        os.close(fd)
+
+
+def copy_range(src, dst, start, end, bufsize=1 << 20):
+    """Copy bytes ``[start, end)`` of the open file ``src`` to ``dst``."""
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        buf = src.read(min(bufsize, remaining))
+        if not buf:
+            break
+        dst.write(buf)
+        remaining -= len(buf)
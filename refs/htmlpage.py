@@ -0,0 +1,301 @@
+"""Render bibliographies as HTML pages."""
+
+import json
+import os
+import re
+import string
+import time
+
+from . import paths
+from .compat import PY2, html_escape
+from .core import Entry
+from .files import atomic_open
+from .utils import collate, detex, digest, english_join
+
+# Templates are compiled once; values are escaped before substitution.
+page_header = string.Template("""<html>
+<head>
+  <title>$title</title>
+  <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+</head>
+<body>
+""")
+
+page_footer = string.Template("""<hr>
+<p>Generated by refs at $time.</p>
+</body>
+</html>
+""")
+
+entry_template = string.Template(
+    """<p id="$key">$title$authors$details ($key)</p>\n""")
+linked_title = string.Template("""<a href="$url"><i>"$title"</i></a>, """)
+plain_title = string.Template("""<i>"$title"</i>, """)
+highlight_template = """<font color="ff0000">%s</font>"""
+
+# fields listed after the title and authors, in order
+detail_fields = ('journal', 'volume', 'number', 'booktitle', 'address',
+                 'institution')
+
+# pages of a site have no timestamp, so they only change with their entries
+site_footer = string.Template("""<hr>
+<p>Generated by refs.</p>
+</body>
+</html>
+""")
+index_link = string.Template(
+    """<li><a href="$href">$name</a> ($count)</li>\n""")
+
+# changes whenever the templates do, invalidating cached fragments
+template_version = digest("\0".join([
+    page_header.template, entry_template.template, linked_title.template,
+    plain_title.template, highlight_template, repr(detail_fields),
+    site_footer.template, index_link.template,
+]))
+
+
+class HTMLRenderer(object):
+    """Renders entries as HTML fragments.
+
+    LaTeX markup is removed from each field and the text is escaped once.
+    If ``highlight`` is given, occurrences of it in each field are marked.
+    """
+
+    def __init__(self, highlight=None):
+        self.highlight = None
+        if highlight:
+            self.highlight = re.compile(re.escape(html_escape(highlight)))
+
+    def text(self, s):
+        s = html_escape(detex(s))
+        if self.highlight is not None:
+            s = self.highlight.sub(
+                lambda mo: highlight_template % mo.group(0), s)
+        return s
+
+    def month(self, entry):
+        month = detex(entry.value('month'))
+        if month.isdigit() and 1 <= int(month) <= 12:
+            return Entry.months[int(month) - 1]
+        for name in Entry.months:
+            if len(month) >= 3 and name.lower().startswith(month.lower()):
+                return name
+        return self.text(month)
+
+    def entry(self, entry):
+        """Return the HTML fragment for one entry."""
+        url = entry.value('url')
+        template = linked_title if url else plain_title
+        title = template.substitute(url=html_escape(url),
+                                    title=self.text(entry.value('title')))
+
+        authors = entry.names('author')
+        authors = self.text(english_join(authors)) + ".  " if authors else ""
+
+        details = []
+        for field in detail_fields:
+            v = entry.value(field)
+            if v:
+                details.append(self.text(v.strip('"')) + ", ")
+        editors = entry.names('editor')
+        if editors:
+            details.append("eds. %s, " % self.text(english_join(editors)))
+        month = self.month(entry)
+        year = self.text(entry.value('year'))
+        if month:
+            details.append(month)
+            if year:
+                details.append(" " + year)
+        elif year:
+            details.append(year)
+
+        return entry_template.substitute(key=html_escape(entry.key),
+                                         title=title,
+                                         authors=authors,
+                                         details="".join(details))
+
+    def iter_page(self, entries, title="Bibliography"):
+        """Yield the HTML page for ``entries`` in pieces.
+
+        ``entries`` can be any iterable, such as
+        `.Bibliography.iter_bibtex`, so that entries are rendered as
+        they are parsed.
+        """
+        yield page_header.substitute(title=html_escape(title))
+        for entry in entries:
+            yield self.entry(entry)
+        yield page_footer.substitute(time=time.asctime())
+
+
+def write_html(entries, fp, title="Bibliography", highlight=None,
+               bufsize=1 << 16):
+    """Write an HTML page for ``entries`` to ``fp`` in large blocks."""
+    renderer = HTMLRenderer(highlight=highlight)
+    chunk = []
+    size = 0
+    for s in renderer.iter_page(entries, title=title):
+        chunk.append(s)
+        size += len(s)
+        if size >= bufsize:
+            fp.write("".join(chunk))
+            chunk = []
+            size = 0
+    fp.write("".join(chunk))
+
+
+def _year_pages(entry):
+    year = "".join([c for c in entry.value('year') if c.isdigit()])
+    return [year or "unknown"]
+
+
+def _author_pages(entry):
+    pages = []
+    for name in entry.names('author') or ["unknown"]:
+        if "," in name:
+            surname = name.split(",")[0]
+        else:
+            # an empty name, e.g., from a stray "and", has no surname
+            tokens = name.split()
+            surname = tokens[-1] if tokens else ""
+        pages.append(re.sub(r"[^a-z0-9]+", "-", collate(surname)).strip("-")
+                     or "unknown")
+    return pages
+
+
+# functions giving the pages that an entry appears on
+site_splits = {'year': _year_pages, 'author': _author_pages}
+
+
+# fragments are byte strings on Python 2; Latin-1 maps each byte to one
+# character, so they go through JSON unchanged whatever their encoding
+def _to_json(s):
+    return s.decode('latin-1') if PY2 and isinstance(s, str) else s
+
+
+def _from_json(s):
+    return s.encode('latin-1') if PY2 else s
+
+
+def fingerprint(entry):
+    """Return a hash of the content of ``entry``."""
+    return digest(repr((entry.key, sorted(entry.fieldDict.items()))))
+
+
+class Site(object):
+    """An HTML site with one page per year or per author.
+
+    The rendered fragment of each entry is cached, keyed by the entry's
+    `.fingerprint`, the highlighted word and the `.template_version`, so
+    that only new or changed entries are rendered. A page is only
+    rewritten if its content changed, and pages that no longer have any
+    entries are removed. The cache is JSON, kept in ``cache_dir`` rather
+    than published with the site.
+    """
+
+    # the pickled cache of earlier versions, kept in outdir
+    legacy_cache_name = ".refs-html-cache"
+
+    def __init__(self, outdir, split='year', highlight=None,
+                 cache_dir=None):
+        if split not in site_splits:
+            raise ValueError("Cannot split by '%s'; choose from %s." % (
+                split, ", ".join(sorted(site_splits))))
+        self.outdir = outdir
+        self.split = split
+        self.renderer = HTMLRenderer(highlight=highlight)
+        self.salt = "%s\0%s\0" % (template_version, highlight)
+        if cache_dir is None:
+            cache_dir = os.path.join(paths.config_dir, "html-cache")
+        self.cache_path = os.path.join(
+            cache_dir, digest(os.path.abspath(outdir)) + ".json")
+        self.fragments = {}
+        self.pages = {}
+        self._load_cache()
+        self.rendered = 0
+        self.written = 0
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path) as fp:
+                cache = json.load(fp)
+            fragments = cache['fragments']
+            pages = cache['pages']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            # a missing or unusable cache only means rendering again
+            return
+        self.fragments = dict((str(key), _from_json(fragment))
+                              for key, fragment in fragments.items())
+        self.pages = dict((str(name), str(checksum))
+                          for name, checksum in pages.items())
+
+    def _save_cache(self):
+        directory = os.path.dirname(self.cache_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fragments = dict((key, _to_json(fragment))
+                         for key, fragment in self.fragments.items())
+        with atomic_open(self.cache_path) as fp:
+            json.dump({'fragments': fragments, 'pages': self.pages}, fp)
+
+    def fragment(self, entry, fragments):
+        key = digest(self.salt + fingerprint(entry))
+        if key in self.fragments:
+            fragment = self.fragments[key]
+        else:
+            fragment = self.renderer.entry(entry)
+            self.rendered += 1
+        fragments[key] = fragment
+        return fragment
+
+    def write_page(self, name, content, pages):
+        checksum = digest(content)
+        path = os.path.join(self.outdir, name)
+        pages[name] = checksum
+        if self.pages.get(name) != checksum or not os.path.exists(path):
+            with atomic_open(path) as fp:
+                fp.write(content)
+            self.written += 1
+
+    def build(self, entries, title="Bibliography"):
+        """Render ``entries`` into the site, writing only what changed."""
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+
+        groups = {}
+        fragments = {}
+        for entry in entries:
+            fragment = self.fragment(entry, fragments)
+            for page in site_splits[self.split](entry):
+                groups.setdefault(page, []).append(fragment)
+
+        pages = {}
+        links = []
+        reverse = self.split == 'year'  # newest years first
+        for page in sorted(groups, reverse=reverse):
+            name = "%s-%s.html" % (self.split, page)
+            content = "".join(
+                [page_header.substitute(title=html_escape(
+                    "%s: %s" % (title, page)))]
+                + groups[page]
+                + [site_footer.substitute()])
+            self.write_page(name, content, pages)
+            links.append(index_link.substitute(
+                href=name, name=html_escape(page), count=len(groups[page])))
+
+        index = "".join([page_header.substitute(title=html_escape(title)),
+                         "<ul>\n"] + links + ["</ul>\n",
+                                              site_footer.substitute()])
+        self.write_page("index.html", index, pages)
+
+        for name in self.pages:
+            if name not in pages:
+                path = os.path.join(self.outdir, name)
+                if os.path.exists(path):
+                    os.remove(path)
+
+        self.fragments = fragments
+        self.pages = pages
+        self._save_cache()
+        legacy = os.path.join(self.outdir, self.legacy_cache_name)
+        if os.path.exists(legacy):
+            os.remove(legacy)
@@ -0,0 +1,211 @@
+"""Record edits to a bibliography in a journal instead of rewriting it.
+
+The journal is a file of JSON lines next to the bibliography, one edit
+per line:
+
+``{"op": "add", "bibtex": "@article{...}"}``
+    add an entry, or replace the entry with the same citekey
+``{"op": "rm", "key": "..."}``
+    remove an entry
+``{"op": "set", "key": "...", "field": "...", "value": "..."}``
+    set a field, or remove it if the value is null
+
+Saving appends the edits made since loading, so its cost depends on
+the number of edits rather than the size of the bibliography. Loading
+replays the journal on top of the bibliography file, and `compact`
+folds the journal back into the file.
+"""
+
+import json
+import os
+
+from .compat import is_string, to_native
+from .core import Bibliography
+from .files import atomic_open, locked
+
+
+def _native(value):
+    if is_string(value):
+        return to_native(value)
+    if isinstance(value, list):
+        return [to_native(v) for v in value]
+    return value
+
+
+def _bibtex(entry):
+    # unmodified entries keep the text they were parsed from
+    return Bibliography._dumps_entry(entry, True)
+
+
+def _fields(entry):
+    return dict((k, v) for k, v in entry.fieldDict.items() if k[0] != '_')
+
+
+class Journal(object):
+    """The journal of edits to the bibliography file at ``path``."""
+
+    def __init__(self, path):
+        self.bib_path = os.path.abspath(path)
+        self.path = self.bib_path + ".journal"
+        # (id(entry), key, fields) of the entries when last synchronized
+        self._baseline = {}
+
+    def size(self):
+        """Return the size of the journal in bytes."""
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def _read(self):
+        """Return the edits in the journal and the number of bytes they
+        take up; a last line without a line ending is left unread."""
+        if not os.path.exists(self.path):
+            return [], 0
+        with open(self.path, 'rb') as fp:
+            data = fp.read()
+        end = data.rfind(b"\n") + 1
+        ops = []
+        for line in data[:end].splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                ops.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                # an edit torn by a crash; skip it
+                continue
+        return ops, end
+
+    def replay(self, bib):
+        """Apply the edits in the journal to ``bib``.
+
+        Replaying is idempotent, so edits that were already folded into
+        the file by an interrupted `compact` do no harm. Returns the
+        number of bytes of the journal replayed.
+        """
+        ops, end = self._read()
+        for op in ops:
+            kind = op.get('op')
+            if kind == 'add':
+                new = Bibliography()
+                new.loads_bibtex(to_native(op['bibtex']))
+                for entry in list(new):
+                    new.remove_entry(entry.key)
+                    if entry.key in bib:
+                        old = bib[entry.key]
+                        old.fieldDict = entry.fieldDict
+                        old.dirty = True
+                    else:
+                        entry.bibliography = bib
+                        bib.insert_entry(entry)
+            elif kind == 'rm':
+                if op['key'] in bib:
+                    bib.remove_entry(to_native(op['key']))
+            elif kind == 'set':
+                if op['key'] not in bib:
+                    continue
+                entry = bib[to_native(op['key'])]
+                field = to_native(op['field'])
+                if op.get('value') is None:
+                    entry.fieldDict.pop(field, None)
+                else:
+                    entry.fieldDict[field] = _native(op['value'])
+                entry.dirty = True
+        self.mark(bib)
+        return end
+
+    def mark(self, bib):
+        """Remember the state of ``bib`` that later edits are relative to."""
+        self._baseline = dict((id(entry), (entry.key, _fields(entry)))
+                              for entry in bib)
+
+    def changes(self, bib):
+        """Return the edits made to ``bib`` since `mark`."""
+        ops = []
+        current = set()
+        for entry in bib:
+            current.add(id(entry))
+            if id(entry) not in self._baseline:
+                ops.append({'op': 'add', 'bibtex': _bibtex(entry)})
+                continue
+            key, fields = self._baseline[id(entry)]
+            if key != entry.key:
+                ops.append({'op': 'rm', 'key': key})
+                ops.append({'op': 'add', 'bibtex': _bibtex(entry)})
+                continue
+            new = _fields(entry)
+            for field in sorted(set(fields) | set(new)):
+                if fields.get(field) != new.get(field):
+                    ops.append({'op': 'set', 'key': key, 'field': field,
+                                'value': new.get(field)})
+        for entry_id, (key, _) in self._baseline.items():
+            if entry_id not in current:
+                ops.insert(0, {'op': 'rm', 'key': key})
+        return ops
+
+    def record(self, bib):
+        """Append the edits made to ``bib`` since `mark` to the journal.
+
+        Returns the number of edits written.
+        """
+        ops = self.changes(bib)
+        if ops:
+            data = "".join([json.dumps(op, sort_keys=True) + "\n"
+                            for op in ops])
+            # the journal is part of the bibliography and shares its lock
+            with locked(self.bib_path, exclusive=True):
+                with open(self.path, 'a') as fp:
+                    fp.write(data)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+        self.mark(bib)
+        return len(ops)
+
+    def clear(self, upto=None):
+        """Remove the first ``upto`` bytes of the journal, or all of it."""
+        if not os.path.exists(self.path):
+            return
+        if upto is None or upto >= self.size():
+            os.remove(self.path)
+            return
+        with open(self.path, 'rb') as fp:
+            fp.seek(upto)
+            rest = fp.read()
+        with atomic_open(self.path, 'wb') as fp:
+            fp.write(rest)
+
+
+def load(path, journal=None):
+    """Load the bibliography at ``path`` with its journal replayed."""
+    if journal is None:
+        journal = Journal(path)
+    bib = Bibliography()
+    with locked(path):
+        if os.path.exists(path):
+            bib.load_bibtex(path)
+        journal.replay(bib)
+    return bib
+
+
+def compact(path, bib=None, journal=None):
+    """Fold the journal of the bibliography at ``path`` into the file.
+
+    Returns the bibliography as written. The file and journal are read
+    again while the exclusive lock is held, so the edits other processes
+    recorded are folded in too, and the file is written before the
+    edits replayed are removed from the journal, so an interruption
+    loses none. ``bib``, if given, is a bibliography whose edits were
+    all recorded; later ones are recorded relative to it.
+    """
+    if journal is None:
+        journal = Journal(path)
+    with locked(path, exclusive=True):
+        fresh = Bibliography()
+        if os.path.exists(path):
+            fresh.load_bibtex(path)
+        replayed = journal.replay(fresh)
+        fresh.save_bibtex(path)
+        journal.clear(replayed)
+    journal.mark(bib if bib is not None else fresh)
+    return fresh
@@ -0,0 +1,225 @@
+"""Read and write bibliographies as JSON Lines and CSL-JSON.
+
+Writers take any iterable of entries, such as
+`.Bibliography.iter_bibtex`, and produce output one entry at a time,
+so that memory use does not grow with the size of the bibliography.
+Readers build `.Entry` objects directly from the JSON.
+"""
+
+import json
+
+from .compat import iteritems, to_native
+from .core import Bibliography, Entry
+from .utils import detex, name_tokens
+
+# BibTeX reference types and the CSL types they correspond to
+type2csl = {
+    'article': 'article-journal',
+    'book': 'book',
+    'booklet': 'pamphlet',
+    'inbook': 'chapter',
+    'incollection': 'chapter',
+    'inproceedings': 'paper-conference',
+    'manual': 'book',
+    'mastersthesis': 'thesis',
+    'misc': 'article',
+    'phdthesis': 'thesis',
+    'proceedings': 'book',
+    'techreport': 'report',
+    'unpublished': 'manuscript',
+}
+
+csl2type = {
+    'article-journal': 'article',
+    'article-magazine': 'article',
+    'article-newspaper': 'article',
+    'book': 'book',
+    'chapter': 'incollection',
+    'manuscript': 'unpublished',
+    'pamphlet': 'booklet',
+    'paper-conference': 'inproceedings',
+    'report': 'techreport',
+    'thesis': 'phdthesis',
+}
+
+# BibTeX fields and the CSL variables they correspond to
+field2csl = {
+    'abstract': 'abstract',
+    'address': 'publisher-place',
+    'chapter': 'chapter-number',
+    'doi': 'DOI',
+    'edition': 'edition',
+    'note': 'note',
+    'number': 'issue',
+    'pages': 'page',
+    'publisher': 'publisher',
+    'series': 'collection-title',
+    'title': 'title',
+    'url': 'URL',
+    'volume': 'volume',
+}
+
+csl2field = dict((v, k) for k, v in iteritems(field2csl))
+
+# fields holding the name of the container or the publisher, by type
+container_fields = ('journal', 'booktitle')
+publisher_fields = ('publisher', 'institution', 'school', 'organization')
+
+# -- JSON Lines
+
+def entry2json(entry):
+    """Return a JSON-serializable dict holding all fields of ``entry``.
+
+    Field names are lower case, as in BibTeX, and names in author and
+    editor fields are joined with " and ".
+    """
+    fields = {}
+    for name, value in entry.fieldDict.items():
+        if name == 'Type' or name[0] == '_':
+            continue
+        fields[name.lower()] = (" and ".join(value)
+                                if isinstance(value, list) else value)
+    return {'key': entry.key, 'type': entry.reftype, 'fields': fields}
+
+
+def json2entry(obj, bib=None):
+    """Return the `.Entry` for a dict made by `.entry2json`."""
+    entry = Entry(to_native(obj['key']), bib)
+    entry.reftype = to_native(obj['type'])
+    for name, value in iteritems(obj['fields']):
+        entry.fieldDict[to_native(name)] = to_native(value)
+    return entry
+
+
+def jsonl_lines(entries):
+    """Yield one line of JSON per entry."""
+    for entry in entries:
+        yield json.dumps(entry2json(entry), sort_keys=True) + "\n"
+
+
+def iter_jsonl(fp, bib=None):
+    """Yield the entries in a JSON Lines file, one at a time."""
+    for line in fp:
+        if line.strip():
+            yield json2entry(json.loads(line), bib)
+
+
+def load_jsonl(path, bib=None):
+    """Load a JSON Lines file made with `.jsonl_lines`."""
+    if bib is None:
+        bib = Bibliography()
+    with open(path, 'r') as fp:
+        bib.insert_entries(iter_jsonl(fp, bib))
+    return bib
+
+
+# -- CSL-JSON
+
+def _csl_name(name):
+    tokens = name_tokens(name)
+    if len(tokens) == 1 and tokens[0].startswith("{"):
+        # a braced name, like {World Health Organization}, is kept whole
+        return {'literal': detex(name)}
+    if "," in name:
+        family, given = name.split(",", 1)
+        return {'family': detex(family), 'given': detex(given)}
+    if len(tokens) == 1:
+        return {'family': detex(name)}
+    return {'family': detex(tokens[-1]), 'given': detex(" ".join(tokens[:-1]))}
+
+
+def _bibtex_name(name):
+    if 'literal' in name:
+        return "{%s}" % to_native(name['literal'])
+    family = to_native(name.get('family', ""))
+    if 'given' in name:
+        return "%s, %s" % (family, to_native(name['given']))
+    return family
+
+
+def entry2csl(entry):
+    """Return the CSL-JSON item for ``entry``."""
+    item = {'id': entry.key, 'type': type2csl.get(entry.reftype, 'article')}
+    for field, variable in iteritems(field2csl):
+        value = entry.value(field)
+        if value:
+            item[variable] = detex(value)
+    for field in container_fields:
+        value = entry.value(field)
+        if value:
+            item['container-title'] = detex(value)
+            break
+    if 'publisher' not in item:
+        for field in publisher_fields:
+            value = entry.value(field)
+            if value:
+                item['publisher'] = detex(value)
+                break
+    for role in ('author', 'editor'):
+        names = entry.names(role)
+        if names:
+            item[role] = [_csl_name(name) for name in names]
+    year = "".join([c for c in entry.value('year') if c.isdigit()])
+    if year:
+        date = [int(year)]
+        month = entry.value('month').strip().lower()
+        if month.isdigit() and 1 <= int(month) <= 12:
+            date.append(int(month))
+        elif month:
+            for i, name in enumerate(Entry.months):
+                if name.lower().startswith(month[:3]):
+                    date.append(i + 1)
+                    break
+        item['issued'] = {'date-parts': [date]}
+    return item
+
+
+def csl2entry(item, bib=None):
+    """Return the `.Entry` for a CSL-JSON item."""
+    # ids may be numbers, but citekeys are strings
+    entry = Entry(to_native("%s" % item['id']), bib)
+    entry.reftype = csl2type.get(item.get('type'), 'misc')
+    fields = entry.fieldDict
+    for variable, field in iteritems(csl2field):
+        if variable in item:
+            fields[field] = to_native("%s" % item[variable])
+    if 'container-title' in item:
+        container = ('journal' if entry.reftype == 'article'
+                     else 'booktitle')
+        fields[container] = to_native(item['container-title'])
+    for role in ('author', 'editor'):
+        if item.get(role):
+            fields[role] = " and ".join(
+                [_bibtex_name(name) for name in item[role]])
+    parts = item.get('issued', {}).get('date-parts')
+    if parts and parts[0]:
+        fields['year'] = "%s" % parts[0][0]
+        if len(parts[0]) > 1:
+            try:
+                month = int(parts[0][1])
+            except (TypeError, ValueError):
+                month = 0
+            # seasons are 21 to 24, which BibTeX has no month for
+            if 1 <= month <= 12:
+                fields['month'] = Entry.months[month - 1][:3].lower()
+    return entry
+
+
+def csl_json_chunks(entries):
+    """Yield a CSL-JSON array of ``entries`` in pieces, one per entry."""
+    yield "["
+    sep = "\n"
+    for entry in entries:
+        yield sep + json.dumps(entry2csl(entry), sort_keys=True)
+        sep = ",\n"
+    yield "\n]\n"
+
+
+def load_csl_json(path, bib=None):
+    """Load a CSL-JSON file."""
+    if bib is None:
+        bib = Bibliography()
+    with open(path, 'r') as fp:
+        items = json.load(fp)
+    bib.insert_entries([csl2entry(item, bib) for item in items])
+    return bib
@@ -0,0 +1,181 @@
+"""An index from citekeys to where their papers can be found.
+
+The locator maps each citekey of the master bibliography to the path of
+its stored PDF, its DOI and its URL, in an SQLite database in the
+configuration directory, so that `refs open` finds a paper with one
+indexed lookup instead of loading the master. Whenever the master is
+saved, the records of the citekeys that changed are brought up to date.
+Its stamp records the state of the master and of the PDF store that it
+was made from; a different stamp means that they were changed behind
+its back and that it must be rebuilt.
+"""
+
+import os
+import sqlite3
+
+from . import paths
+from .db import connect
+
+schema = """
+CREATE TABLE IF NOT EXISTS places (
+    key TEXT PRIMARY KEY,
+    pdf TEXT,
+    doi TEXT,
+    url TEXT
+);
+CREATE TABLE IF NOT EXISTS stamp (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    value TEXT
+);
+"""
+
+columns = ('pdf', 'doi', 'url')
+
+
+def stamp(files):
+    """Return a string that changes when any of ``files`` changes."""
+    parts = []
+    for path in files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            parts.append("-")
+            continue
+        parts.append("%d:%d:%r" % (st.st_ino, st.st_size, st.st_mtime))
+    return " ".join(parts)
+
+
+def record(entry, pdf=None):
+    """Return the locator record of ``entry``, whose PDF is at ``pdf``."""
+    place = {}
+    if pdf:
+        place['pdf'] = pdf
+    for field in ('doi', 'url'):
+        value = entry.value(field).strip()
+        if value:
+            place[field] = value
+    return place
+
+
+def target(place):
+    """Return the file or URL to open for a locator record, or None."""
+    if place.get('pdf'):
+        return place['pdf']
+    if place.get('doi'):
+        return "https://doi.org/%s" % place['doi']
+    return place.get('url')
+
+
+class Locator(object):
+    """The locator index in the SQLite database at ``path``."""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(paths.config_dir, "locator.sqlite")
+        self.path = path
+
+    def lookup(self, citekey):
+        """Return the record of ``citekey`` and the stamp of the index.
+
+        The record is None if ``citekey`` is not in the index, and the
+        stamp is None if there is no index.
+        """
+        if not os.path.exists(self.path):
+            return None, None
+        conn = connect(self.path)
+        try:
+            row = conn.execute(
+                "SELECT pdf, doi, url FROM places WHERE key = ?",
+                (citekey,)).fetchone()
+            current = conn.execute(
+                "SELECT value FROM stamp WHERE id = 0").fetchone()
+        except sqlite3.DatabaseError:
+            # an unusable index is rebuilt from the master
+            return None, None
+        finally:
+            conn.close()
+        place = None
+        if row is not None:
+            place = dict((c, v) for c, v in zip(columns, row) if v)
+        return place, current[0] if current else None
+
+    def current(self):
+        """Return the stamp of the index, or None if there is none."""
+        if not os.path.exists(self.path):
+            return None
+        conn = connect(self.path)
+        try:
+            row = conn.execute(
+                "SELECT value FROM stamp WHERE id = 0").fetchone()
+        except sqlite3.DatabaseError:
+            return None
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def update(self, entries, removed, pdfs, new_stamp, old_stamp):
+        """Update the records of ``entries`` and remove those of the
+        ``removed`` citekeys, then set the stamp.
+
+        ``old_stamp`` is the stamp of the master files before the
+        changes were saved. If the stamp of the index does not start
+        with it, the index was not up to date; nothing is changed and
+        False is returned, so that it can be rebuilt with `sync`.
+        """
+        if not os.path.exists(self.path):
+            return False
+        conn = connect(self.path)
+        try:
+            with conn:
+                # taken before reading the stamp, so that no other
+                # update comes in between
+                conn.execute("BEGIN IMMEDIATE")
+                current = conn.execute(
+                    "SELECT value FROM stamp WHERE id = 0").fetchone()
+                if current is None or not (current[0] + " ").startswith(
+                        old_stamp + " "):
+                    return False
+                conn.executemany("DELETE FROM places WHERE key = ?",
+                                 [(key,) for key in removed])
+                conn.executemany(
+                    "INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?)",
+                    [(entry.key,) + tuple(
+                        record(entry, pdfs.get(entry.key)).get(c)
+                        for c in columns) for entry in entries])
+                conn.execute("INSERT OR REPLACE INTO stamp VALUES (0, ?)",
+                             (new_stamp,))
+        except sqlite3.DatabaseError:
+            return False
+        finally:
+            conn.close()
+        return True
+
+    def sync(self, entries, pdfs, new_stamp, keys=None):
+        """Update the records of ``entries`` and set the stamp.
+
+        ``pdfs`` maps citekeys to the paths of their PDFs. If ``keys``,
+        the citekeys of the whole master, is given, the records of other
+        citekeys are removed.
+        """
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        conn = connect(self.path)
+        try:
+            conn.executescript(schema)
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?)",
+                    [(entry.key,) + tuple(
+                        record(entry, pdfs.get(entry.key)).get(c)
+                        for c in columns) for entry in entries])
+                if keys is not None:
+                    stale = [(key,) for (key,) in
+                             conn.execute("SELECT key FROM places")
+                             if key not in keys]
+                    conn.executemany("DELETE FROM places WHERE key = ?",
+                                     stale)
+                conn.execute("INSERT OR REPLACE INTO stamp VALUES (0, ?)",
+                             (new_stamp,))
+        finally:
+            conn.close()
@@ -1,25 +1,182 @@
+import errno
+import itertools
 import os
 import sys
 
 import click
-import mendeley.resources.catalog
 
-from .compat import iteritems, range
-from .core import Bibliography
-from .metadata import doc2bib
+from . import journal, locator
+from .compat import iteritems, range, to_native
+from .core import Bibliography, Entry, load_bibtex_files, sort_fields
+from .db import SQLiteBibliography, dump_sqlite
+from .bulk import ResumeJournal, find_pdfs, hash_files, lookup_files
+from .files import atomic_open, locked
+from .htmlpage import HTMLRenderer, Site, site_splits, write_html
+from .journal import Journal
+from .jsonio import csl_json_chunks, jsonl_lines
+from .locator import Locator
+from .metadata import connect, doc2bib, search_many, sha1hash
 from .metadata import search as _search
 from .rc import rc
+from .render import render as _render
+from .shards import ShardedBibliography
+from .sorting import external_sort
+from .store import PDFStore
+from .style import format_entries, markups, styles
 
 
 class Refs(object):
+    # set by `refs serve` to a BibliographyCache holding the master
+    master_cache = None
+
     def __init__(self, master='', m_id='', m_secret=''):
         if master == '':
             master = rc.get('general', 'master')
         self.master = os.path.abspath(master)
+        self.store = rc.get('general', 'store')
+        if self.store not in ('bibtex', 'sqlite', 'sharded'):
+            raise click.UsageError("Unknown master store '%s' in refsrc; "
+                                   "use bibtex, sqlite or sharded."
+                                   % self.store)
+        master_db = rc.get('general', 'master_db')
+        self.master_db = (os.path.abspath(os.path.expanduser(master_db))
+                          if master_db
+                          else os.path.splitext(self.master)[0] + ".sqlite")
+        shard_dir = rc.get('general', 'shard_dir')
+        self.shard_dir = (os.path.abspath(os.path.expanduser(shard_dir))
+                          if shard_dir
+                          else os.path.splitext(self.master)[0] + ".shards")
+        self.journal = None
+        if self.store == 'bibtex' and rc.getboolean('general', 'journal'):
+            self.journal = Journal(self.master)
+        self.locator = Locator()
+        self.loaded_stamp = None
         self.m_id = m_id if m_id != '' else rc.get('mendeley', 'client_id')
         self.m_secret = (m_secret if m_secret != ''
                          else rc.get('mendeley', 'client_secret'))
 
+    def load_master(self):
+        """Return the master bibliography from the configured store.
+
+        The first time the sqlite or sharded store is used, the master
+        file is imported into it.
+        """
+        # taken before loading: the sqlite store commits changes as they
+        # are made, before the master is saved
+        self.loaded_stamp = locator.stamp(self.master_files())
+        if self.store == 'sqlite':
+            if (not os.path.exists(self.master_db)
+                    and os.path.exists(self.master)):
+                with locked(self.master_db, exclusive=True):
+                    # built aside and renamed into place, so that a
+                    # failed import leaves no database behind
+                    if not os.path.exists(self.master_db):
+                        bib = Bibliography()
+                        bib.load_bibtex(self.master)
+                        dump_sqlite(bib, self.master_db)
+            return SQLiteBibliography(self.master_db)
+        if self.store == 'sharded':
+            new = not os.path.exists(self.shard_dir)
+            master = ShardedBibliography(
+                self.shard_dir, by=rc.get('general', 'shard_by'),
+                prefix_length=rc.getint('general', 'shard_prefix'))
+            if new and os.path.exists(self.master):
+                master.load_bibtex(self.master)
+                master.save()
+            return master
+        if self.master_cache is not None:
+            return self.master_cache.get(self.master, self.journal)
+        if self.journal is not None:
+            return journal.load(self.master, self.journal)
+        master = Bibliography()
+        if os.path.exists(self.master):
+            master.load_bibtex(self.master)
+        return master
+
+    def save_master(self, master, changed=None, removed=None):
+        """Store the changes made to the master bibliography.
+
+        With a journal, the changes are appended to it, and the journal
+        is compacted once it is larger than the journal_limit setting.
+        If the citekeys that were added or modified (``changed``) or
+        removed are given, only their records in the locator index are
+        updated.
+        """
+        if self.store == 'sqlite':
+            # changes are committed as they are made
+            master.conn.commit()
+        elif self.store == 'sharded':
+            master.save()
+        elif self.journal is not None:
+            self.journal.record(master)
+            if self.journal.size() > rc.getint('general', 'journal_limit'):
+                journal.compact(self.master, master, self.journal)
+        else:
+            master.save_bibtex(self.master)
+        before, self.loaded_stamp = (self.loaded_stamp,
+                                     locator.stamp(self.master_files()))
+        if changed is None and removed is None or before is None:
+            self.update_locator(master)
+            return
+        changed = changed or []
+        if not self.locator.update(
+                [master[key] for key in changed], removed or [],
+                PDFStore().paths(set(changed)), self.stamp(), before):
+            self.update_locator(master)
+
+    def master_files(self):
+        """Return the files that change whenever the master changes."""
+        if self.store == 'sqlite':
+            return [self.master_db]
+        if self.store == 'sharded':
+            return [os.path.join(self.shard_dir, "manifest.json")]
+        if self.journal is not None:
+            return [self.master, self.journal.path]
+        return [self.master]
+
+    def stamp(self):
+        """Return a string that changes when the master or PDFs change."""
+        return locator.stamp(self.master_files() + [PDFStore().index_path])
+
+    def update_locator(self, master, full=False):
+        """Bring the locator index up to date with ``master``.
+
+        Only the loaded shards of a sharded master are visited, unless
+        ``full``; the others have not changed.
+        """
+        if self.store == 'sharded':
+            if full:
+                master.load_all()
+            entries = [entry for name in sorted(master.shards)
+                       for entry in master.shards[name]]
+            keys = master.manifest
+        else:
+            entries = [entry for entry in master]
+            keys = set([to_native(entry.key) for entry in entries])
+        self.locator.sync(entries, PDFStore().paths(), self.stamp(), keys)
+
+    def check_locator(self):
+        """Rebuild the locator index if the master changed behind its back.
+
+        Returns True if it was rebuilt.
+        """
+        if self.locator.current() == self.stamp():
+            return False
+        self.update_locator(self.load_master(), full=True)
+        return True
+
+    def locate(self, citekey):
+        """Return the locator record of ``citekey``, or None if it is not
+        in the master.
+
+        The index is rebuilt first if the master changed behind its back.
+        """
+        place, current = self.locator.lookup(citekey)
+        if current != self.stamp():
+            self.update_locator(self.load_master(), full=True)
+            place, _ = self.locator.lookup(citekey)
+        return place
+
 
 @click.group()
 @click.option('--master', default='')
@@ -30,6 +187,35 @@ def main(ctx, master, mendeley_id, mendeley_secret):
     ctx.obj = Refs(master, mendeley_id, mendeley_secret)
 
 
+def write_stream(chunks, bufsize=1 << 16):
+    """Write text chunks to stdout in large blocks as they are produced.
+
+    The first chunk is written immediately so that output starts without
+    delay. If the reader closes the pipe (e.g., output piped to ``head``),
+    writing stops quietly and the rest of ``chunks`` is never produced.
+    """
+    out = sys.stdout
+    buf = []
+    size = 0
+    try:
+        for i, chunk in enumerate(chunks):
+            buf.append(chunk)
+            size += len(chunk)
+            if i == 0 or size >= bufsize:
+                out.write("".join(buf))
+                out.flush()
+                buf = []
+                size = 0
+        out.write("".join(buf))
+        out.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        # keep the interpreter from failing to flush stdout at exit
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, out.fileno())
+
+
 @main.command()
 @click.option('--brief', is_flag=True,
               help="brief listing (one line per entry)")
@@ -37,47 +223,624 @@ def main(ctx, master, mendeley_id, mendeley_secret):
               help="resolve abbreviations from defined strings")
 @click.option('--resolve', is_flag=True,
               help="resolve cross reference entries")
-@click.argument('bibliography')
+@click.option('--offset', default=0, help="skip this many entries")
+@click.option('--limit', default=None, type=int,
+              help="list at most this many entries")
+@click.option('--unique', is_flag=True,
+              help="list only the first entry with each citekey")
+@click.option('--jobs', default=None, type=int,
+              help="number of bibliographies to load in parallel")
+@click.argument('bibliographies', nargs=-1, required=True)
 @click.pass_obj
-def list(refs, bibliography, brief, abbrev, resolve):
-    """Print bibliography in readable format."""
-    # TODO handle multiple bibs?
-    bib = Bibliography()
-    bib.load_bibtex(bibliography)
+def list(refs, bibliographies, brief, abbrev, resolve, offset, limit,
+         unique, jobs):
+    """Print bibliographies in readable format.
+
+    Entries are listed in the order of the given files.
+    """
+    def load_all():
+        for bib in load_bibtex_files(bibliographies, processes=jobs):
+            if resolve:
+                bib.resolve_crossref()
+            for bibentry in bib:
+                yield bibentry
+
+    def dedupe(entries):
+        seen = set()
+        for bibentry in entries:
+            if bibentry.key not in seen:
+                seen.add(bibentry.key)
+                yield bibentry
+
+    if len(bibliographies) == 1 and not resolve:
+        entries = Bibliography().iter_bibtex(bibliographies[0])
+    else:
+        # cross references can point anywhere, so load whole files first
+        entries = load_all()
+    if unique:
+        entries = dedupe(entries)
+    stop = None if limit is None else offset + limit
+    entries = itertools.islice(entries, offset, stop)
+
+    def readable(entries):
+        for bibentry in entries:
+            if abbrev:
+                bibentry.resolve_abbrev(bibentry.bibliography.abbrevs)
+            if brief:
+                yield "%s\n\n" % bibentry
+            else:
+                yield "%s\n\n" % bibentry.format_display()
+
+    write_stream(readable(entries))
 
-    if abbrev:
-        bib.resolve_abbrev()
-    if resolve:
-        bib.resolve_crossref()
 
-    # output the readable text
-    for bibentry in bib:
-        if brief:
-            bibentry.brief()
+@main.command()
+@click.option('--highlight', default=None,
+              help="highlight the specified word in the output")
+@click.option('--output', '-o', default=None,
+              help="write to this file instead of stdout")
+@click.option('--outdir', default=None,
+              help="write a site with one page per year or author to "
+                   "this directory, updating only pages that changed")
+@click.option('--split', default='year', show_default=True,
+              type=click.Choice(sorted(site_splits)),
+              help="how to split the entries into pages with --outdir")
+@click.argument('bibliographies', nargs=-1, required=True)
+@click.pass_obj
+def html(refs, bibliographies, highlight, output, outdir, split):
+    """Export bibliographies as an HTML page or site."""
+    def entries():
+        for path in bibliographies:
+            bib = Bibliography()
+            for entry in bib.iter_bibtex(path):
+                entry.resolve_abbrev(bib.abbrevs)
+                yield entry
+
+    title = "Bibliography %s" % bibliographies[0]
+    if outdir is not None:
+        site = Site(outdir, split=split, highlight=highlight)
+        site.build(entries(), title=title)
+        click.echo("%d entries rendered, %d pages written." % (
+            site.rendered, site.written), err=True)
+    elif output is None:
+        renderer = HTMLRenderer(highlight=highlight)
+        write_stream(renderer.iter_page(entries(), title=title))
+    else:
+        with atomic_open(output) as fp:
+            write_html(entries(), fp, title=title, highlight=highlight)
+
+
+@main.command(name='format')
+@click.option('--style', default='plain', show_default=True,
+              type=click.Choice(sorted(styles)), help="citation style")
+@click.option('--to', default='text', show_default=True,
+              type=click.Choice(sorted(markups)), help="output format")
+@click.option('--output', '-o', default=None,
+              help="write to this file instead of stdout")
+@click.argument('bibliographies', nargs=-1, required=True)
+@click.pass_obj
+def format_(refs, bibliographies, style, to, output):
+    """Format references without running LaTeX or BibTeX."""
+    def entries():
+        for path in bibliographies:
+            bib = Bibliography()
+            for entry in bib.iter_bibtex(path):
+                entry.resolve_abbrev(bib.abbrevs)
+                yield entry
+
+    chunks = format_entries(entries(), style=style, to=to)
+    if output is None:
+        write_stream(chunks)
+    else:
+        with atomic_open(output) as fp:
+            fp.writelines(chunks)
+
+
+@main.command()
+@click.option('--style', default=None,
+              help="BibTeX style, or a .bst file without the extension "
+                   "(default: from refsrc)")
+@click.option('--template', type=click.File('r'), default=None,
+              help="LaTeX template with $style and $bibliography")
+@click.option('--outdir', default='.', show_default=True,
+              help="directory for the LaTeX files and output")
+@click.option('--timeout', default=None, type=float,
+              help="seconds to allow each TeX tool (default: from refsrc)")
+@click.option('--force', is_flag=True, help="build even if up to date")
+@click.option('--jobs', default=None, type=int,
+              help="number of bibliographies to build in parallel")
+@click.argument('bibliographies', nargs=-1, required=True)
+@click.pass_obj
+def render(refs, bibliographies, style, template, outdir, timeout, force,
+           jobs):
+    """Typeset bibliographies with LaTeX and BibTeX.
+
+    Bibliographies whose output is up to date are skipped.
+    """
+    if style is None:
+        style = rc.get('render', 'style')
+    if timeout is None:
+        timeout = rc.getfloat('render', 'timeout')
+    if template is not None:
+        template = template.read()
+
+    failed = 0
+    try:
+        for path, built, error in _render(bibliographies, outdir, style,
+                                          template, timeout, force, jobs):
+            if error is not None:
+                failed += 1
+                click.echo("%s: %s" % (path, error), err=True)
+            else:
+                click.echo("%s: %s" % (path, "built" if built
+                                       else "up to date"), err=True)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if failed:
+        raise click.ClickException("%d of %d builds failed." % (
+            failed, len(bibliographies)))
+
+
+@main.command()
+@click.option('--format', 'fmt', default='sqlite', show_default=True,
+              type=click.Choice(['sqlite', 'jsonl', 'csl-json', 'bibtex']),
+              help="output format")
+@click.option('--output', '-o', default=None,
+              help="file to write (default: standard output, except for "
+                   "sqlite)")
+@click.argument('bibliography', required=False)
+@click.pass_obj
+def export(refs, bibliography, fmt, output):
+    """Export a bibliography to another format.
+
+    Without BIBLIOGRAPHY, the master is exported. Other formats than
+    sqlite are written one entry at a time, as the bibliography is
+    parsed.
+    """
+    if fmt == 'sqlite':
+        if output is None:
+            raise click.UsageError("--output is required for sqlite.")
+        if bibliography is None:
+            bib = refs.load_master()
         else:
-            bibentry.display()
-        print
+            bib = Bibliography()
+            bib.load_bibtex(bibliography)
+        dump_sqlite(bib, output)
+        return
+
+    if bibliography is None:
+        bib = refs.load_master()
+        entries = iter(bib)
+    else:
+        bib = Bibliography()
+        entries = bib.iter_bibtex(bibliography)
+
+    def resolved():
+        for entry in entries:
+            entry.resolve_abbrev(bib.abbrevs)
+            yield entry
+
+    if fmt == 'bibtex':
+        # keep abbreviations; entries that were not modified are copied
+        chunks = (bib._dumps_entry(entry, True) for entry in entries)
+        if bibliography is None:
+            chunks = itertools.chain([bib.dumps_strings()], chunks)
+    elif fmt == 'jsonl':
+        chunks = jsonl_lines(resolved())
+    else:
+        chunks = csl_json_chunks(resolved())
+    if output is None:
+        write_stream(chunks)
+    else:
+        with locked(output, exclusive=True):
+            with atomic_open(output) as fp:
+                fp.writelines(chunks)
 
 
 @main.command()
 @click.option('--overwrite', is_flag=True,
               help="overwrite bibliography with sorted version")
+@click.option('--external', is_flag=True,
+              help="sort using temporary files instead of loading the "
+                   "whole bibliography into memory")
+@click.option('--buffer-size', default=64, show_default=True,
+              help="memory to use for --external, in megabytes")
+@click.option('--by', default='key', show_default=True,
+              help="comma-separated fields to sort by, from: %s" % (
+                  ", ".join(sorted(sort_fields))))
+@click.option('--reverse', is_flag=True, help="sort in descending order")
 @click.argument('bibliography')
 @click.pass_obj
-def sort(refs, bibliography, overwrite):
-    """Sort bibliography by citekey."""
+def sort(refs, bibliography, overwrite, external, buffer_size, by, reverse):
+    """Sort bibliography (by citekey by default)."""
+    by = tuple([field.strip() for field in by.split(",")])
+    for field in by:
+        if field not in sort_fields:
+            raise click.BadParameter("cannot sort by '%s'." % field,
+                                     param_hint="--by")
+
+    # overwriting holds an exclusive lock from reading to replacing the
+    # file, so that concurrent edits are not lost or interleaved
+    with locked(bibliography, exclusive=overwrite):
+        if external:
+            with open(bibliography, 'r') as infp:
+                if overwrite:
+                    with atomic_open(bibliography) as outfp:
+                        external_sort(infp, outfp, by=by, reverse=reverse,
+                                      buffer_size=buffer_size << 20)
+                else:
+                    external_sort(infp, sys.stdout, by=by, reverse=reverse,
+                                  buffer_size=buffer_size << 20)
+            return
+
+        bib = Bibliography()
+        bib.load_bibtex(bibliography)
+        bib.sort(by=by, reverse=reverse)
+
+        if overwrite:
+            with atomic_open(bibliography) as fp:
+                bib.write_strings(fp)
+                bib.write_bibtex(fp)
+        else:
+            bib.write_strings(sys.stdout)
+            bib.write_bibtex(sys.stdout)
+
+
+def unique_key(base, bib):
+    """Return ``base``, or ``base`` with a letter added, not in ``bib``."""
+    if base not in bib:
+        return base
+    for letter in "abcdefghijklmnopqrstuvwxyz":
+        if base + letter not in bib:
+            return base + letter
+    raise click.ClickException("Too many citekeys like '%s'." % base)
+
+
+def pdf_entry(refs, pdf):
+    """Look up the metadata of ``pdf``, prompting if it is not found."""
+    import mendeley.exception
+    import requests
+    try:
+        return doc2bib(ensure_result(_search(pdf, refs.m_id, refs.m_secret)))
+    except (NotImplementedError, mendeley.exception.MendeleyException,
+            requests.RequestException) as e:
+        click.echo("%s was not found in the catalog: %s" % (pdf, e),
+                   err=True)
+    title = click.prompt("Title")
+    authors = click.prompt("Authors (separated by 'and')")
+    year = click.prompt("Year")
+    first = authors.split(" and ")[0].strip()
+    surname = first.split(",")[0] if "," in first else first.split()[-1]
+    entry = Entry("%s%s" % (surname.lower(), year), None)
+    entry.reftype = 'misc'
+    entry.fieldDict['title'] = title
+    entry.fieldDict['author'] = authors
+    entry.fieldDict['year'] = year
+    return entry
+
+
+def add_pdf(refs, pdf, citekey=None, bibliography=None):
+    """Store ``pdf`` and add its reference to the master."""
+    if not os.path.isfile(pdf):
+        raise click.BadParameter("%s does not exist." % pdf)
+    store = PDFStore()
+    filehash = sha1hash(pdf)
+    if citekey is None:
+        citekey = store.citekey(filehash)
+    master = refs.load_master()
+    if citekey is None or citekey not in master:
+        entry = pdf_entry(refs, pdf)
+        entry.key = citekey or unique_key(entry.key, master)
+        master.insert_entry(entry)
+        citekey = entry.key
+    entry = master[citekey]
+    # stored first, so that saving the master indexes the PDF
+    store.add(pdf, entry.key, filehash)
+    refs.save_master(master, [entry.key])
+    click.echo("Stored %s as %s." % (pdf, entry.key), err=True)
+
+    if bibliography is not None:
+        bib = Bibliography()
+        if os.path.exists(bibliography):
+            bib.load_bibtex(bibliography)
+        if entry.key not in bib:
+            bib.insert_entry(entry)
+            bib.copy_abbrevs(entry, master.abbrevs)
+        bib.save_bibtex(bibliography)
+
+
+def bulk_files(refs, directory, journal_name, jobs, workers):
+    """Hash and look up the PDFs under ``directory`` not yet done.
+
+    Returns the `ResumeJournal` of the run and a generator of
+    ``(path, sha1, document)``.
+    """
+    resume = ResumeJournal(os.path.join(directory, journal_name))
+    pdfs = [p for p in find_pdfs(directory) if not resume.is_done(p)]
+    hashed = [(path, sha1) for path, sha1 in hash_files(pdfs, jobs)
+              if sha1 not in resume.done_hashes]
+    if resume.done_paths:
+        click.echo("Resuming: %d files already done." % len(
+            resume.done_hashes), err=True)
+    if not hashed:
+        return resume, iter(())
+    session = connect(refs.m_id, refs.m_secret)
+    return resume, lookup_files(hashed, session, workers)
+
+
+def catalog_entry(path, doc):
+    """Return the entry for the catalog document ``doc`` of ``path``.
+
+    Returns None, after reporting it, if the file was not found in the
+    catalog or its metadata is incomplete.
+    """
+    if doc is None:
+        click.echo("%s was not found in the catalog." % path, err=True)
+        return None
+    try:
+        return doc2bib(doc)
+    except (IndexError, KeyError, TypeError) as e:
+        # a document without authors, year or known type
+        click.echo("%s has incomplete catalog metadata (%s)." % (path, e),
+                   err=True)
+        return None
+
+
+def add_directory(refs, directory, bibliography, jobs, workers,
+                  batch_size=50):
+    """Store the PDFs under ``directory`` and add them to the master.
+
+    Files that are not in the catalog, or whose catalog metadata is
+    incomplete, are reported and skipped. The
+    master is saved every ``batch_size`` files, before those files are
+    recorded as done, so an interrupted run can be resumed.
+    """
+    resume, found = bulk_files(refs, directory, ".refs-add.journal",
+                               jobs, workers)
+    store = PDFStore()
+    master = refs.load_master()
+    added, missing, pending = [], [], []
+    changed = []  # citekeys stored since the last save
+
+    def flush():
+        refs.save_master(master, changed)
+        for record in pending:
+            resume.record(**record)
+        del pending[:]
+        del changed[:]
+
+    for path, sha1, doc in found:
+        pending.append({'path': path, 'sha1': sha1})
+        citekey = store.citekey(sha1)
+        if citekey is None or citekey not in master:
+            entry = catalog_entry(path, doc)
+            if entry is None:
+                missing.append(path)
+                continue
+            entry.key = unique_key(entry.key, master)
+            master.insert_entry(entry)
+            citekey = entry.key
+        store.add(path, citekey, sha1)
+        added.append(citekey)
+        changed.append(citekey)
+        click.echo("Stored %s as %s." % (path, citekey), err=True)
+        if len(pending) >= batch_size:
+            flush()
+    flush()
+    resume.remove()
+
+    if bibliography is not None and added:
+        bib = Bibliography()
+        if os.path.exists(bibliography):
+            bib.load_bibtex(bibliography)
+        for citekey in added:
+            if citekey not in bib:
+                bib.insert_entry(master[citekey])
+                bib.copy_abbrevs(master[citekey], master.abbrevs)
+        bib.save_bibtex(bibliography)
+    click.echo("Added %d files; %d were not found." % (
+        len(added), len(missing)), err=True)
+
+
+@main.command()
+@click.option('--jobs', type=int, default=None,
+              help='Processes hashing files in a directory.')
+@click.option('--workers', type=int, default=8,
+              help='Concurrent catalog lookups for a directory.')
+@click.argument('args', nargs=-1, required=True)
+@click.pass_obj
+def add(refs, jobs, workers, args):
+    """Add citations from the master to a bibliography, or add PDFs.
+
+    Usage: refs add CITEKEY... BIBLIOGRAPHY
+    or:    refs add PDFFILE [CITEKEY] [BIBLIOGRAPHY]
+    or:    refs add DIRECTORY [BIBLIOGRAPHY]
+
+    A PDF is stored by its content in the refs configuration directory,
+    and its reference is added to the master if it is not there yet.
+    Every PDF under a directory is added; an interrupted run resumes
+    where it stopped when run again.
+    """
+    if os.path.isdir(args[0]):
+        if len(args) > 2:
+            raise click.UsageError(
+                "Usage: refs add DIRECTORY [BIBLIOGRAPHY]")
+        add_directory(refs, args[0], args[1] if len(args) > 1 else None,
+                      jobs, workers)
+        return
+    if args[0].lower().endswith(".pdf"):
+        rest, bibliography = args[1:], None
+        if rest and rest[-1].endswith(".bib"):
+            rest, bibliography = rest[:-1], rest[-1]
+        if len(rest) > 1:
+            raise click.UsageError(
+                "Usage: refs add PDFFILE [CITEKEY] [BIBLIOGRAPHY]")
+        add_pdf(refs, args[0], rest[0] if rest else None, bibliography)
+        return
+    if len(args) < 2:
+        raise click.UsageError("Specify one or more citekeys and a "
+                               "bibliography.")
+    citekeys, bibliography = args[:-1], args[-1]
+
+    master = refs.load_master()
     bib = Bibliography()
-    bib.load_bibtex(bibliography)
-    bib.sort()
+    if os.path.exists(bibliography):
+        bib.load_bibtex(bibliography)
+    for citekey in citekeys:
+        if citekey not in master:
+            raise click.BadParameter("'%s' not in the master bibliography."
+                                     % citekey)
+        if citekey not in bib:
+            bib.insert_entry(master[citekey])
+            bib.copy_abbrevs(master[citekey], master.abbrevs)
+    bib.save_bibtex(bibliography)
 
-    if overwrite:
-        with open(bibliography, 'w') as fp:
-            bib.write_bibtex(fp)
+
+@main.command()
+@click.argument('citekeys', nargs=-1, required=True)
+@click.pass_obj
+def show(refs, citekeys):
+    """Print entries of the master bibliography as BibTeX."""
+    master = refs.load_master()
+    for citekey in citekeys:
+        if citekey not in master:
+            raise click.BadParameter("'%s' not in the master bibliography."
+                                     % citekey)
+    write_stream(master._dumps_entry(master[citekey], True) + "\n"
+                 for citekey in citekeys)
+
+
+@main.command()
+@click.argument('args', nargs=-1, required=True)
+@click.pass_obj
+def rm(refs, args):
+    """Remove citations from a bibliography.
+
+    Usage: refs rm CITEKEY... [BIBLIOGRAPHY]
+
+    If no bibliography is given, the citations are removed from the master.
+    """
+    to_master = not (len(args) > 1 and os.path.isfile(args[-1]))
+    if to_master:
+        citekeys, bibliography = args, "the master bibliography"
+        bib = refs.load_master()
+    else:
+        citekeys, bibliography = args[:-1], args[-1]
+        bib = Bibliography()
+        bib.load_bibtex(bibliography)
+
+    for citekey in citekeys:
+        if citekey not in bib:
+            raise click.BadParameter("'%s' not in %s." % (
+                citekey, bibliography))
+    for citekey in citekeys:
+        bib.remove_entry(citekey)
+    if to_master:
+        refs.save_master(bib, removed=citekeys)
     else:
-        bib.write_bibtex(sys.stdout)
+        bib.save_bibtex()
+
+
+@main.command()
+@click.pass_obj
+def compact(refs):
+    """Fold the journal of edits into the master bibliography."""
+    if refs.store != 'bibtex':
+        raise click.UsageError("The %s store has no journal." % refs.store)
+    refs.update_locator(journal.compact(refs.master))
+
+
+@main.command()
+@click.option('--rebuild', is_flag=True,
+              help="Rebuild the index even if it is up to date.")
+@click.pass_obj
+def index(refs, rebuild):
+    """Bring the locator index used by refs open up to date.
+
+    The records of changed citekeys are updated whenever the master is
+    saved, and the whole index is rebuilt when the master was changed
+    behind its back.
+    """
+    if rebuild and os.path.exists(refs.locator.path):
+        os.remove(refs.locator.path)
+    refs.check_locator()
+
+
+@main.command()
+@click.option('--socket', 'socket_path', default=None,
+              help="Unix socket to listen on (default: from refsrc)")
+@click.pass_obj
+def serve(refs, socket_path):
+    """Serve commands from a resident process.
+
+    The master is kept in memory, and reloaded incrementally when its
+    file changes. While the server runs, the refs command sends the
+    commands that only read bibliographies to it over a Unix socket.
+    Like refs watch, the server also keeps the locator index used by
+    refs open up to date.
+    """
+    from .client import socket_path as default_socket_path
+    from .server import Server
+
+    path = os.path.abspath(socket_path or default_socket_path())
+
+    def load(server):
+        Refs.master_cache = server.cache
+        try:
+            refs.load_master()
+            # from the master just loaded, rather than parsing it again
+            refs.check_locator()
+        finally:
+            Refs.master_cache = None
+
+    def warm(server):
+        load(server)
+        # reload as soon as the master changes, not at the next request
+        server.watch(refs.master_files() + [PDFStore().index_path],
+                     lambda changed: load(server))
+        click.echo("Serving on %s." % path, err=True)
+
+    try:
+        Server(path).serve_forever(warm)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+
+@main.command()
+@click.option('--interval', default=1.0, show_default=True,
+              help="seconds between checks when inotify is not available")
+@click.pass_obj
+def watch(refs, interval):
+    """Keep the locator index up to date as the master changes.
+
+    The index used by refs open is kept on disk, so the first refs open
+    after the master was edited by hand does not have to rebuild it.
+    To also keep the parsed master in memory for the commands that read
+    it, run refs serve instead.
+    """
+    from .watch import Watcher
+
+    # the locator also records the stored PDFs
+    watcher = Watcher(sorted(set(
+        [os.path.abspath(f) for f in
+         refs.master_files() + [PDFStore().index_path]])),
+        interval=interval)
+    refs.check_locator()
+    click.echo("Watching %d files with %s." % (
+        len(watcher.files), watcher.method), err=True)
+    try:
+        for changed in watcher:
+            if refs.check_locator():
+                click.echo("Updated the index for %s." % ", ".join(changed),
+                           err=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
 
 def ensure_result(result):
+    import mendeley.resources.catalog
 
     if isinstance(result, mendeley.resources.catalog.CatalogSearch):
 
@@ -100,13 +863,89 @@ def ensure_result(result):
 
 
 
+def batch_queries(path):
+    """Return the queries in the file ``path``, and the citekeys of the
+    ones taken from a bibliography.
+
+    The file has a query on each line, or is a .bib file, whose entries
+    are looked up by DOI or, failing that, by title.
+    """
+    if not path.endswith(".bib"):
+        with click.open_file(path) as fp:
+            queries = [line.strip() for line in fp]
+        return [q for q in queries if q and not q.startswith("#")], {}
+    bib = Bibliography()
+    bib.load_bibtex(path)
+    queries = []
+    keys = {}
+    for entry in bib:
+        query = entry.value('doi') or entry.value('title')
+        query = query.replace("{", "").replace("}", "").strip()
+        if query:
+            queries.append(query)
+            keys[query] = entry.key
+    return queries, keys
+
+
+def search_batch(refs, path, abstract, workers, rate):
+    """Look up the queries in ``path`` and print the entries found."""
+    queries, keys = batch_queries(path)
+    written = set()
+    missing = failed = 0
+    for query, entry, error in search_many(queries, refs.m_id,
+                                           refs.m_secret, workers=workers,
+                                           rate=rate):
+        if error is not None:
+            click.echo("%s: %s" % (query, error), err=True)
+            failed += 1
+            continue
+        if entry is None:
+            click.echo("%s was not found in the catalog." % query, err=True)
+            missing += 1
+            continue
+        try:
+            entry.key = unique_key(keys.get(query, entry.key), written)
+        except click.ClickException as e:
+            click.echo("%s: %s" % (query, e.format_message()), err=True)
+            failed += 1
+            continue
+        written.add(entry.key)
+        if not abstract and 'abstract' in entry.fieldDict:
+            del entry.fieldDict['abstract']
+        entry.write_bibtex(sys.stdout)
+        sys.stdout.flush()
+    click.echo("Found %d of %d; %d were not found, %d failed." % (
+        len(written), len(queries), missing, failed), err=True)
+
+
 @main.command()
 @click.option('--abstract', is_flag=True,
               help="include the abstract, if available.")
-@click.argument('query')
+@click.option('--batch', type=click.Path(exists=True, dir_okay=False,
+                                         allow_dash=True),
+              default=None,
+              help="Look up every query in this file, or '-' for stdin.")
+@click.option('--workers', type=int, default=8,
+              help='Concurrent lookups of a batch.')
+@click.option('--rate', type=float, default=None,
+              help='Most requests a second for a batch; 0 for no limit.')
+@click.argument('query', required=False)
 @click.pass_obj
-def search(refs, query, abstract):
-    """Search for a reference."""
+def search(refs, query, abstract, batch, workers, rate):
+    """Search for a reference.
+
+    QUERY is a DOI, a PDF file or words to search for. With --batch, the
+    queries are read from a file, one per line, or taken from the
+    entries of a .bib file, which keep their citekeys; they are looked
+    up concurrently and the entries found are printed as they arrive.
+    """
+    if batch is not None:
+        if query is not None:
+            raise click.UsageError("Give either QUERY or --batch.")
+        search_batch(refs, batch, abstract, workers, rate)
+        return
+    if query is None:
+        raise click.UsageError("Missing QUERY.")
 
     result = ensure_result(_search(query, refs.m_id, refs.m_secret))
 
@@ -116,12 +955,60 @@ def search(refs, query, abstract):
     entry.write_bibtex(sys.stdout)
 
 
+def unique_path(directory, name, ext=".pdf"):
+    """Return a path in ``directory`` for ``name``, adding a letter if
+    the file exists."""
+    path = os.path.join(directory, name + ext)
+    for letter in "abcdefghijklmnopqrstuvwxyz":
+        if not os.path.exists(path):
+            return path
+        path = os.path.join(directory, name + letter + ext)
+    raise click.ClickException("Too many files like '%s%s'." % (name, ext))
+
+
+def rename_directory(refs, directory, jobs, workers):
+    """Rename the PDFs under ``directory`` after their citekeys."""
+    resume, found = bulk_files(refs, directory, ".refs-rename.journal",
+                               jobs, workers)
+    renamed = missing = 0
+    for path, sha1, doc in found:
+        entry = catalog_entry(path, doc)
+        if entry is None:
+            resume.record(path=path, sha1=sha1)
+            missing += 1
+            continue
+        key = entry.key
+        dirname = os.path.dirname(path)
+        if os.path.basename(path) == key + ".pdf":
+            newpath = path
+        else:
+            newpath = unique_path(dirname, key)
+            click.echo("Renaming %s -> %s" % (path, newpath))
+            os.rename(path, newpath)
+            renamed += 1
+        resume.record(path=path, sha1=sha1, newpath=newpath)
+    resume.remove()
+    click.echo("Renamed %d files; %d were not found." % (renamed, missing),
+               err=True)
+
+
 @main.command()
+@click.option('--jobs', type=int, default=None,
+              help='Processes hashing files in a directory.')
+@click.option('--workers', type=int, default=8,
+              help='Concurrent catalog lookups for a directory.')
 @click.argument('query')
 @click.pass_obj
-def rename(refs, query):
-    """Rename a file according to Mendeley search results."""
+def rename(refs, jobs, workers, query):
+    """Rename a file according to Mendeley search results.
 
+    QUERY is a PDF file, or a directory whose PDFs are all renamed. An
+    interrupted run on a directory resumes where it stopped when run
+    again.
+    """
+    if os.path.isdir(query):
+        rename_directory(refs, query, jobs, workers)
+        return
     if not query.endswith(".pdf"):
         raise click.BadParameter("QUERY must be a PDF file.")
 
@@ -133,12 +1020,34 @@ def rename(refs, query):
     os.rename(query, outname)
 
 
-@main.command()
-@click.option('--bibliography', default=None)
+@main.command(name='open')
+@click.option('--bibliography', default=None,
+              help='Look the citekey up in this bibliography.')
 @click.argument('citekey')
 @click.pass_obj
-def open(refs, citekey, bibliograph):
-    """Open a paper using the system default viewer."""
+def open_(refs, citekey, bibliography):
+    """Open a paper using the system default viewer.
+
+    The stored PDF of the reference is opened or, if there is none, its
+    DOI or URL. Citekeys of the master are found in the locator index
+    without loading the master.
+    """
+    if bibliography is not None:
+        bib = Bibliography()
+        bib.load_bibtex(bibliography)
+        if citekey not in bib:
+            raise click.BadParameter("'%s' not in %s." % (citekey,
+                                                          bibliography))
+        place = locator.record(bib[citekey], PDFStore().path(citekey))
+    else:
+        place = refs.locate(citekey)
+        if place is None:
+            raise click.BadParameter("'%s' not in the master bibliography."
+                                     % citekey)
+    where = locator.target(place)
+    if where is None:
+        raise click.ClickException("%s has no PDF, DOI or URL." % citekey)
+    click.launch(where)
 
 
 if __name__ == '__main__':
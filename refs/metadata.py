@@ -1,25 +1,167 @@
 """Query databases for reference metadata."""
 
+import contextlib
 import hashlib
 import json
+import os
+import sqlite3
 import sys
+import threading
+import time
 import urllib
+from multiprocessing.pool import ThreadPool
 
-import mendeley.models.catalog
-import requests
-import requests.auth
-
+from . import db, paths
+from .compat import to_native
 from .core import Entry
+from .files import atomic_open
 from .rc import rc
 
-def search(query, m_id, m_secret):
-    mend = mendeley.Mendeley(m_id, m_secret)
-    session = mend.start_client_credentials_flow().authenticate()
+
+class TokenCache(object):
+    """Mendeley access tokens saved on disk until they expire.
+
+    Tokens are stored as JSON, readable only by the user, by API host
+    and client ID, so later invocations skip the OAuth round trip.
+    """
+
+    # seconds before it expires at which a token is no longer handed out
+    margin = 60
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(paths.config_dir, "mendeley-token.json")
+        self.path = path
+
+    @staticmethod
+    def _key(m_id, host):
+        return "%s %s" % (host, m_id)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                tokens = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return tokens if isinstance(tokens, dict) else {}
+
+    def get(self, m_id, host):
+        """Return the saved token, or None if it is missing or expiring."""
+        token = self._load().get(self._key(m_id, host))
+        if not isinstance(token, dict) or 'access_token' not in token:
+            return None
+        if token.get('expires_at', 0) < time.time() + self.margin:
+            return None
+        return token
+
+    def put(self, m_id, host, token):
+        tokens = self._load()
+        tokens[self._key(m_id, host)] = dict(token)
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with atomic_open(self.path, permissions=0o600) as f:
+                json.dump(tokens, f)
+        except (IOError, OSError):
+            # a token that is not saved only means authenticating again
+            pass
+
+token_cache = TokenCache()
+
+
+class _SavingRefresher(object):
+    """Refreshes expired tokens of a session once, and saves them."""
+
+    def __init__(self, refresher, save):
+        self.refresher = refresher
+        self.save = save
+        self.lock = threading.Lock()
+
+    def refresh(self, session):
+        token = session.token
+        with self.lock:
+            # another thread may have refreshed it while this one waited
+            if session.token is token:
+                self.refresher.refresh(session)
+                self.save(session.token)
+
+
+# (client ID, host) -> session, shared within this process
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def connect(m_id, m_secret, host=None, cache=token_cache, pool_size=16):
+    """Return an authenticated Mendeley session.
+
+    One session can be shared by many lookups, including lookups made
+    concurrently from up to ``pool_size`` threads, which reuse its HTTP
+    connections; it is made once per process. Its access token is kept
+    in ``cache`` and reused by later processes until it expires, and
+    fetched again only when it has. ``host`` is the API to talk to, the
+    ``[mendeley] host`` setting by default.
+    """
+    # imported here, as the client is slow to import and most commands
+    # never talk to Mendeley
+    import mendeley
+    from mendeley.auth import (MendeleyClientCredentialsAuthenticator,
+                               MendeleyClientCredentialsTokenRefresher)
+    from mendeley.session import MendeleySession
+    from requests.adapters import HTTPAdapter
+
+    if host is None:
+        host = rc.get('mendeley', 'host')
+    host = host.rstrip("/")
+    with _sessions_lock:
+        session = _sessions.get((m_id, host))
+        if session is not None:
+            return session
+
+        def save(token):
+            if cache is not None:
+                cache.put(m_id, host, token)
+        mend = mendeley.Mendeley(m_id, m_secret, host=host)
+        auth = MendeleyClientCredentialsAuthenticator(mend)
+        token = cache.get(m_id, host) if cache is not None else None
+        if token is None:
+            session = auth.authenticate()
+            save(session.token)
+        else:
+            # the client must be the authenticator's, which refreshing
+            # updates with the new token
+            session = MendeleySession(
+                mend, token, client=auth.client,
+                refresher=MendeleyClientCredentialsTokenRefresher(auth))
+        session.refresher = _SavingRefresher(session.refresher, save)
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sessions[(m_id, host)] = session
+    return session
+
+
+def by_filehash(session, filehash):
+    """Return the catalog document of the file with SHA-1 ``filehash``.
+
+    Returns None if the file is not in the catalog.
+    """
+    import mendeley.exception
+    try:
+        return session.catalog.by_identifier(filehash=filehash, view='bib')
+    except mendeley.exception.MendeleyException:
+        return None
+
+
+def search(query, m_id, m_secret, session=None):
+    if session is None:
+        session = connect(m_id, m_secret)
     if query.startswith("10.") and "/" in query:
         # Interpreting as a DOI
         return session.catalog.by_identifier(doi=query, view='bib')
     elif query.endswith(".pdf"):
         # Interpreting as a file
+        import mendeley.exception
         filehash = sha1hash(query)
         try:
             return session.catalog.by_identifier(filehash=filehash, view='bib')
@@ -33,15 +175,249 @@ def search(query, m_id, m_secret):
         return session.catalog.search(query, view='bib')
 
 
-def sha1hash(path):
+class RateLimiter(object):
+    """Spaces out requests so that at most ``rate`` start each second.
+
+    Shared by threads; a ``rate`` of 0 means no limit.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = 0.0
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next)
+            self.next = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+# host -> RateLimiter shared by the lookups of this process
+_limiters = {}
+
+
+def rate_limiter(host, rate):
+    """Return the `RateLimiter` of ``host``, now limited to ``rate``."""
+    with _sessions_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = RateLimiter(rate)
+        limiter.rate = rate
+    return limiter
+
+
+def lookup(session, query, limiter=None, retries=3):
+    """Return the catalog document for ``query``, or None.
+
+    ``query`` is a DOI, the path of a PDF file or a title, which gets
+    the first search result. Requests wait for ``limiter``; one the API
+    turns away for exceeding its rate limit is retried ``retries`` times,
+    backing off.
+    """
+    import mendeley.exception
+    query = query.strip()
+    if query.endswith(".pdf"):
+        filehash = sha1hash(query)
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            if query.startswith("10.") and "/" in query:
+                return session.catalog.by_identifier(doi=query, view='bib')
+            elif query.endswith(".pdf"):
+                return session.catalog.by_identifier(filehash=filehash,
+                                                     view='bib')
+            else:
+                results = session.catalog.search(query, view='bib')
+                return next(results.iter(page_size=1), None)
+        except mendeley.exception.MendeleyApiException as e:
+            if e.status == 404:
+                return None
+            if e.status != 429 or attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+        except mendeley.exception.MendeleyException:
+            # by_identifier found nothing
+            return None
+
+
+def search_many(queries, m_id, m_secret, session=None, workers=8,
+                rate=None):
+    """Look up many queries at once; see `lookup`.
+
+    Yields ``(query, entry, error)`` as lookups complete: the `.Entry`
+    converted from the document found, or None, and the exception that
+    stopped the lookup, if one did. At most ``workers`` lookups run at a
+    time, all through one session, and at most ``rate`` requests a
+    second are made to the API host, by default the ``[mendeley] rate``
+    setting.
+    """
+    import mendeley.exception
+    import requests
+    if session is None:
+        session = connect(m_id, m_secret, pool_size=workers)
+    if rate is None:
+        rate = rc.getfloat('mendeley', 'rate')
+    limiter = rate_limiter(session.host, rate)
+
+    def find(query):
+        try:
+            doc = lookup(session, query, limiter)
+            return query, doc2bib(doc) if doc is not None else None, None
+        except (mendeley.exception.MendeleyException,
+                requests.RequestException, EnvironmentError) as e:
+            return query, None, e
+        except (IndexError, KeyError, TypeError) as e:
+            # doc2bib on a document without authors, year or known type
+            return query, None, ValueError(
+                "incomplete catalog metadata (%s)" % e)
+
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(find, queries):
+            yield result
+    finally:
+        # stops the lookups still queued if the caller stops early
+        pool.terminate()
+        pool.join()
+
+
+def file_sha1(path, bufsize=1 << 20):
+    """Return the hex SHA-1 of the file at ``path``, read in chunks."""
+    sha1 = hashlib.sha1()
     with open(path, 'rb') as f:
-        sha1 = hashlib.sha1(f.read()).hexdigest()
+        while True:
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            sha1.update(buf)
+    return sha1.hexdigest()
+
+
+class HashCache(object):
+    """A persistent cache of file hashes.
+
+    Hashes are stored in an SQLite database by path, along with the
+    inode, size and modification time of the file when it was hashed; a
+    hash is reused only while all of these are unchanged. Many hashes
+    are looked up or stored with one connection by ``get_many`` and
+    ``update``, or by passing the connection of ``opened()`` around.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(paths.config_dir, "hashes.sqlite")
+        self.path = path
+
+    @staticmethod
+    def _key(path):
+        return to_native(os.path.abspath(path))
+
+    @staticmethod
+    def _stamp(st):
+        return "%d %d %r" % (st.st_ino, st.st_size, st.st_mtime)
+
+    @contextlib.contextmanager
+    def opened(self, create=False):
+        """Yield a connection to the cache, or None if it cannot be used.
+
+        A missing cache is created only with ``create``. Changes are
+        committed when the block ends.
+        """
+        conn = None
+        try:
+            directory = os.path.dirname(self.path)
+            if create and not os.path.isdir(directory):
+                os.makedirs(directory)
+            if create or os.path.exists(self.path):
+                conn = db.connect(self.path)
+                conn.execute("CREATE TABLE IF NOT EXISTS hashes "
+                             "(path TEXT PRIMARY KEY, stamp TEXT, sha1 TEXT)")
+        except (OSError, sqlite3.Error):
+            # a missing or unusable cache only means hashing again
+            if conn is not None:
+                conn.close()
+            conn = None
+        try:
+            yield conn
+            if conn is not None:
+                conn.commit()
+        except sqlite3.Error:
+            pass
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def lookup(self, conn, path, st):
+        """Return the hash of ``path`` in the open cache ``conn``."""
+        row = conn.execute("SELECT stamp, sha1 FROM hashes WHERE path = ?",
+                           (self._key(path),)).fetchone()
+        if row is None or row[0] != self._stamp(st):
+            return None
+        return row[1]
+
+    def get(self, path, st=None):
+        """Return the cached hash of ``path``, or None if it is stale."""
+        if st is None:
+            st = os.stat(path)
+        return self.get_many([(path, st)]).get(path)
+
+    def get_many(self, items):
+        """Return a dict of the current hashes of ``(path, stat)`` pairs."""
+        found = {}
+        with self.opened() as conn:
+            if conn is None:
+                return found
+            for path, st in items:
+                sha1 = self.lookup(conn, path, st)
+                if sha1 is not None:
+                    found[path] = sha1
+        return found
+
+    def put(self, path, sha1, st=None):
+        if st is None:
+            st = os.stat(path)
+        self.update([(path, sha1, st)])
+
+    def update(self, items):
+        """Cache many ``(path, sha1, stat)`` triples at once."""
+        with self.opened(create=True) as conn:
+            if conn is not None:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)",
+                    [(self._key(path), self._stamp(st), sha1)
+                     for path, sha1, st in items])
+
+
+hash_cache = HashCache()
+
+
+def sha1hash(path, cache=hash_cache):
+    """Return the hex SHA-1 of the file at ``path``.
+
+    The file is read in chunks, so memory use does not depend on its
+    size, and the hash is kept in ``cache`` so that an unchanged file is
+    not read again. Pass ``cache=None`` to always hash the file.
+    """
+    if cache is None:
+        return file_sha1(path)
+    st = os.stat(path)
+    sha1 = cache.get(path, st)
+    if sha1 is None:
+        sha1 = file_sha1(path)
+        cache.put(path, sha1, st)
     return sha1
 
 
 
 def doc2bib(mdoc, bib=None):
     """Converts a mendeley.CatalogBibView to an Entry."""
+    import mendeley.models.catalog
     assert isinstance(mdoc, mendeley.models.catalog.CatalogBibView)
 
     # Map from Mendeley type to BibTeX type
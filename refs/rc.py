@@ -9,11 +9,49 @@ from . import paths
 RC_DEFAULTS = {
     'general': {
         'master': os.path.expanduser(os.path.join("~", ".refs", "master.bib")),
+        # where the master is kept: 'bibtex' for the master file itself,
+        # 'sqlite' for a database or 'sharded' for a directory of shard
+        # files; the master file is exported from the last two
+        'store': 'bibtex',
+        # the database for the sqlite store; by default, the master file
+        # with a .sqlite extension
+        'master_db': '',
+        # with the bibtex store, append edits to master.bib.journal instead
+        # of rewriting the master, and fold them in when the journal grows
+        # beyond journal_limit bytes
+        'journal': 'false',
+        'journal_limit': 1 << 20,
+        # the directory for the sharded store; by default, the master file
+        # with a .shards extension. Entries are put in shards by the first
+        # shard_prefix characters of their citekey, or by year.
+        'shard_dir': '',
+        'shard_by': 'prefix',
+        'shard_prefix': 1,
     },
     'mendeley': {
         'client_id': '',
         'client_secret': '',
-    }
+        # the API to query; point it elsewhere to use a mirror or a
+        # stand-in server
+        'host': 'https://api.mendeley.com',
+        # the most requests a second that batch lookups make to the API
+        'rate': 10,
+    },
+    'server': {
+        # the Unix socket of `refs serve`; by default, refs.sock in the
+        # refs configuration directory
+        'socket': '',
+        # seconds to wait for the server to start a command before running
+        # it without the server
+        'timeout': 2,
+    },
+    'render': {
+        'latex': 'latex -interaction=nonstopmode -halt-on-error',
+        'bibtex': 'bibtex',
+        'output': 'dvi',
+        'style': 'ieeetr',
+        'timeout': 120,
+    },
 }
 
 # The RC files in the order in which they will be read.
@@ -0,0 +1,188 @@
+"""Typeset bibliographies with LaTeX and BibTeX.
+
+Each bibliography is built in its own job in the output directory. A
+build is skipped if a stamp file shows that its output was made from
+the same entries, style, template and tools. The TeX tools are run with
+a timeout and are set in the ``[render]`` section of the RC files.
+"""
+
+import os
+import shlex
+import signal
+import string
+import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .core import Bibliography
+from .files import atomic_open
+from .rc import rc
+from .utils import digest
+
+default_template = r"""\documentclass{article}
+\begin{document}
+\nocite{*}
+\bibliographystyle{$style}
+\bibliography{$bibliography}
+\end{document}
+"""
+
+
+class RenderError(RuntimeError):
+    pass
+
+
+def run(command, cwd, timeout=None):
+    """Run ``command`` in ``cwd``, killing it after ``timeout`` seconds.
+
+    Raises `RenderError` with the end of the output if the command fails
+    or times out.
+    """
+    # on POSIX the command gets its own process group, so that the
+    # programs it starts are killed with it
+    setsid = getattr(os, 'setsid', None)
+    with open(os.devnull) as devnull:
+        proc = subprocess.Popen(command, cwd=cwd, stdin=devnull,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, preexec_fn=setsid)
+    killed = []
+
+    def kill():
+        killed.append(True)
+        try:
+            if setsid is not None:
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except OSError:
+            pass  # it already exited
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        output = proc.communicate()[0]
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if killed:
+        raise RenderError("%s timed out after %g seconds." % (
+            command[0], timeout))
+    if proc.returncode != 0:
+        tail = "\n".join(output.decode('utf-8', 'replace')
+                         .splitlines()[-20:])
+        raise RenderError("%s failed with status %d:\n%s" % (
+            command[0], proc.returncode, tail))
+
+
+class Build(object):
+    """The build of one bibliography in ``outdir``.
+
+    The entries are written to ``<name>.refs.bib``, after the @preamble
+    and @string blocks they may need, and a LaTeX document
+    citing all of them to ``<name>.tex``, where name is the basename of
+    ``path``. The document is run through latex, bibtex and latex again.
+    """
+
+    def __init__(self, path, outdir, style='ieeetr', template=None,
+                 timeout=None):
+        self.path = path
+        self.outdir = outdir
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.style = style
+        self.template = template or default_template
+        self.timeout = timeout
+        self.latex = shlex.split(rc.get('render', 'latex'))
+        self.bibtex = shlex.split(rc.get('render', 'bibtex'))
+        self.output = os.path.join(
+            outdir, "%s.%s" % (self.name, rc.get('render', 'output')))
+        self.stamp_path = os.path.join(outdir, "%s.refs-stamp" % self.name)
+
+    def _style_text(self):
+        # a local .bst file is part of the input; installed styles are not
+        path = self.style + ".bst"
+        if os.path.exists(path):
+            with open(path, 'rb') as fp:
+                return fp.read()
+        return b""
+
+    def fingerprint(self, bibtex):
+        return digest("".join([digest(part) for part in (
+            bibtex, self.style, self._style_text(), self.template,
+            repr(self.latex), repr(self.bibtex))]))
+
+    def is_current(self, checksum):
+        if not (os.path.exists(self.output)
+                and os.path.exists(self.stamp_path)):
+            return False
+        with open(self.stamp_path) as fp:
+            return fp.read().strip() == checksum
+
+    def build(self, force=False):
+        """Build the output if it is out of date.
+
+        Returns True if it was built and False if it was current.
+        """
+        bib = Bibliography()
+        bib.load_bibtex(self.path)
+        bibtex = bib.dumps_strings() + bib.dumps_bibtex()
+        checksum = self.fingerprint(bibtex)
+        if not force and self.is_current(checksum):
+            return False
+
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+        jobname = os.path.join(self.outdir, self.name)
+        with atomic_open(jobname + ".refs.bib") as fp:
+            fp.write(bibtex)
+        style = os.path.splitext(os.path.abspath(self.style))[0] \
+            if os.path.exists(self.style + ".bst") else self.style
+        with atomic_open(jobname + ".tex") as fp:
+            fp.write(string.Template(self.template).substitute(
+                style=style, bibliography=self.name + ".refs"))
+        # a stale stamp must not survive a failed build
+        if os.path.exists(self.stamp_path):
+            os.remove(self.stamp_path)
+
+        tex = self.name + ".tex"
+        run(self.latex + [tex], self.outdir, self.timeout)
+        run(self.bibtex + [self.name], self.outdir, self.timeout)
+        run(self.latex + [tex], self.outdir, self.timeout)
+
+        with atomic_open(self.stamp_path) as fp:
+            fp.write(checksum + "\n")
+        return True
+
+
+def _build(args):
+    build, force = args
+    try:
+        return build.path, build.build(force), None
+    except (RenderError, EnvironmentError) as e:
+        return build.path, False, e
+
+
+def render(paths, outdir, style='ieeetr', template=None, timeout=None,
+           force=False, jobs=None):
+    """Build several bibliographies, ``jobs`` at a time.
+
+    Yields ``(path, built, error)`` for each bibliography in order, where
+    ``built`` is False if its output was current and ``error`` is the
+    exception if its build failed.
+    """
+    builds = [Build(path, outdir, style, template, timeout)
+              for path in paths]
+    names = [b.name for b in builds]
+    for name in names:
+        if names.count(name) > 1:
+            raise ValueError("Several bibliographies are named '%s'; "
+                             "render them into different directories."
+                             % name)
+    pool = ThreadPool(jobs or min(len(builds), 4) or 1)
+    try:
+        for result in pool.imap(_build, [(b, force) for b in builds]):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
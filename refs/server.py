@@ -0,0 +1,246 @@
+"""A resident process that runs refs commands sent by `.client`.
+
+The server keeps the master bibliography in a `.BibliographyCache`, so
+commands run without Python startup, imports or parsing the master,
+and the master is reloaded incrementally when its file changes. Only
+commands that do not change the master and do not read standard input
+are served; the client runs the others itself. Each request runs in a
+process forked from the server, in the working directory of the client,
+so requests do not wait for each other, and the output is sent to the
+client as it is written.
+"""
+
+import errno
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+from . import paths
+from .cache import BibliographyCache
+from .client import frame, recv_all
+from .compat import to_native
+
+# commands that only read the master or the files they are given
+served_commands = ('export', 'format', 'html', 'list', 'show')
+
+# options of the main command group that take a value
+_group_options = ('--master', '--mendeley_id', '--mendeley_secret')
+
+
+def command_name(argv):
+    """Return the name of the command in ``argv``, or None."""
+    args = iter(argv)
+    for arg in args:
+        if arg in _group_options:
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg
+    return None
+
+
+class Channel(object):
+    """A file whose writes are sent to the client as frames of ``name``.
+
+    Used as `sys.stdout` and `sys.stderr` of a served command.
+    """
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if data:
+            self.conn.sendall(frame({self.name: len(data)}, data))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class Server(object):
+    """Serves commands on the Unix socket at ``path``.
+
+    A client that sends no request within ``timeout`` seconds is
+    dropped.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.cache = BibliographyCache()
+        self.project_rc = paths.rc['project']
+        # held while the cache is refreshed, and while forking so that
+        # no request gets a cache that is half refreshed
+        self.lock = threading.Lock()
+        self.children = set()
+
+    def servable(self, argv, cwd):
+        if command_name(argv) not in served_commands or "-" in argv:
+            return False
+        # a project refsrc could configure the command differently
+        project_rc = os.path.join(cwd, "refsrc")
+        return (project_rc == self.project_rc
+                or not os.path.exists(project_rc))
+
+    def run(self, argv, cwd, conn):
+        """Run the command ``argv`` in ``cwd``, in this process.
+
+        Its output is sent to ``conn`` as it is written. Returns the
+        exit status.
+        """
+        from .main import Refs, main
+
+        os.chdir(cwd)
+        Refs.master_cache = self.cache
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = Channel(conn, 'stdout')
+        sys.stderr = Channel(conn, 'stderr')
+        try:
+            main.main(argv, prog_name="refs")
+            status = 0
+        except SystemExit as e:
+            status = e.code
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                sys.stderr.write("%s\n" % status)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        return status
+
+    def handle(self, conn):
+        """Read a request from ``conn`` and start serving it.
+
+        Returns the process id of the process serving it, or None.
+        """
+        conn.settimeout(self.timeout)
+        request = json.loads(recv_all(conn).decode('utf-8'))
+        argv = [to_native(arg) for arg in request['argv']]
+        cwd = to_native(request['cwd'])
+        if not self.servable(argv, cwd):
+            conn.sendall(frame({'fallback': True}))
+            return None
+        conn.settimeout(None)
+        with self.lock:
+            pid = os.fork()
+        if pid:
+            return pid
+        # the child serves the request and exits, whatever happens
+        status = 1
+        try:
+            self.listener.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # the command starts now: the client no longer falls back
+            conn.sendall(frame({'served': True}))
+            status = self.run(argv, cwd, conn)
+            conn.sendall(frame({'status': status}))
+        except socket.error as e:
+            if e.errno != errno.EPIPE:
+                traceback.print_exc()
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(status if isinstance(status, int) else 1)
+
+    def reap(self):
+        """Collect the processes that finished serving requests."""
+        for pid in list(self.children):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                done = pid
+            if done:
+                self.children.discard(pid)
+
+    def watch(self, files, refresh):
+        """Call ``refresh`` with the changed paths when ``files`` change.
+
+        The files are watched in a background thread.
+        """
+        from .watch import Watcher
+        watcher = Watcher(files)
+
+        def loop():
+            for changed in watcher:
+                with self.lock:
+                    try:
+                        refresh(changed)
+                    except Exception:
+                        traceback.print_exc()
+        thread = threading.Thread(target=loop, name="refs-watch")
+        thread.daemon = True
+        thread.start()
+        return watcher
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                # left behind by a server that did not exit cleanly
+                os.remove(self.path)
+            else:
+                raise RuntimeError("A server is already running on %s."
+                                   % self.path)
+            finally:
+                probe.close()
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        self.listener = sock
+        return sock
+
+    def serve_forever(self, warm=None):
+        """Serve requests until interrupted or terminated.
+
+        ``warm`` is called once the socket is listening, to load what
+        the first requests will need.
+        """
+        sock = self._listen()
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            if warm is not None:
+                warm(self)
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    pid = self.handle(conn)
+                    if pid:
+                        self.children.add(pid)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    conn.close()
+                self.reap()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            os.remove(self.path)
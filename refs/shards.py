@@ -0,0 +1,326 @@
+"""Keep a large bibliography as several shard files with a manifest.
+
+A sharded bibliography is a directory of BibTeX files, the shards, and
+``manifest.json``, which maps each citekey to the shard holding it and
+holds the @string definitions and @preamble blocks.
+Entries are assigned to shards by a prefix of their citekey or by their
+year. Looking up, adding or removing an entry loads only its shard,
+and saving writes only the shards that changed.
+"""
+
+import json
+import os
+import re
+
+from .compat import is_integer, iteritems, to_native
+from .core import Bibliography, load_bibtex_files
+from .files import atomic_open, locked
+
+manifest_name = "manifest.json"
+
+_unsafe_re = re.compile(r"""[^a-z0-9]""")
+
+
+def _prefix_shard(entry, length=1):
+    prefix = _unsafe_re.sub("_", entry.key[:length].lower())
+    return prefix or "_"
+
+
+def _year_shard(entry, length=None):
+    year = "".join([c for c in entry.value('year') if c.isdigit()])
+    return year or "unknown"
+
+
+# functions giving the name of the shard that an entry belongs in
+shard_functions = {'prefix': _prefix_shard, 'year': _year_shard}
+
+
+class ShardedBibliography(Bibliography):
+    """A bibliography split into shard files in ``directory``.
+
+    ``by`` is a name from `shard_functions`; ``prefix_length`` is the
+    number of characters of the citekey used by the prefix function.
+    An existing manifest overrides ``by`` and ``prefix_length``. Shards
+    are loaded when first needed; a full scan loads the missing ones in
+    ``jobs`` parallel processes. Call `save` to write the shards that
+    changed and the manifest.
+
+    The shards and the manifest share one lock, on the manifest. Saving
+    merges the entries added and removed here into the manifest as it
+    is on disk, so that concurrent writers do not lose each other's.
+    """
+
+    def __init__(self, directory, by='prefix', prefix_length=1, jobs=None):
+        if by not in shard_functions:
+            raise ValueError("Cannot shard by '%s'; choose from %s." % (
+                by, ", ".join(sorted(shard_functions))))
+        # not Bibliography.__init__: bibentries is a property here
+        self.directory = os.path.abspath(directory)
+        self.by = by
+        self.prefix_length = prefix_length
+        self.jobs = jobs
+        self.abbrevs = {}
+        self.stringDict = {}
+        self.preambles = []
+        self.path = None
+        self._stat = None
+        self._loaded = []
+        self.shards = {}       # shard name -> loaded Bibliography
+        self.modified = set()  # names of shards changed since saving
+        self.manifest = {}     # citekey -> shard name
+        self._saved = {}       # the manifest as last read or written
+        self.manifest_path = os.path.join(self.directory, manifest_name)
+        if os.path.exists(self.manifest_path):
+            with locked(self.manifest_path):
+                manifest = self._read_manifest()
+            # entries stay where the manifest was built to put them
+            self.by = to_native(manifest.get('by', by))
+            self.prefix_length = manifest.get('prefix_length', prefix_length)
+            self.manifest = dict(manifest['keys'])
+            self._saved = dict(self.manifest)
+            self.abbrevs = manifest['strings']
+            self.preambles = manifest['preambles']
+        elif os.path.isdir(self.directory):
+            self.rebuild_manifest()
+
+    def _read_manifest(self):
+        """Return the manifest file, with its text as native strings."""
+        with open(self.manifest_path, 'r') as fp:
+            manifest = json.load(fp)
+        manifest['keys'] = dict((to_native(k), to_native(v))
+                                for k, v in iteritems(manifest['keys']))
+        manifest['strings'] = dict((to_native(k), to_native(v)) for k, v
+                                   in iteritems(manifest.get('strings', {})))
+        manifest['preambles'] = [to_native(p)
+                                 for p in manifest.get('preambles', [])]
+        return manifest
+
+    def shard_path(self, name):
+        return os.path.join(self.directory, name + ".bib")
+
+    def shard_names(self):
+        """Return the names of all shards, loaded or not, in order."""
+        names = set(self.manifest.values()) | set(self.shards)
+        if os.path.isdir(self.directory):
+            names.update([f[:-4] for f in os.listdir(self.directory)
+                          if f.endswith(".bib")])
+        return sorted(names)
+
+    def shard_of(self, entry):
+        return shard_functions[self.by](entry, self.prefix_length)
+
+    def _add_shard(self, name, bib):
+        self.shards[name] = bib
+        for abbrev, value in bib.abbrevs.items():
+            if self.abbrevs.get(abbrev) is None:
+                self.abbrevs[abbrev] = value
+        for entry in bib:
+            entry.bibliography = self
+
+    def shard(self, name):
+        """Return the shard ``name``, loading it if needed."""
+        if name not in self.shards:
+            bib = Bibliography()
+            path = self.shard_path(name)
+            with locked(self.manifest_path):
+                if os.path.exists(path):
+                    bib.load_bibtex(path)
+                else:
+                    # saved to its file even if another writer creates it
+                    bib.path = path
+            self._add_shard(name, bib)
+        return self.shards[name]
+
+    def load_all(self):
+        """Load every shard that is not loaded yet, in parallel."""
+        names = [name for name in self.shard_names()
+                 if name not in self.shards
+                 and os.path.exists(self.shard_path(name))]
+        paths = [self.shard_path(name) for name in names]
+        with locked(self.manifest_path):
+            bibs = list(load_bibtex_files(paths, self.jobs))
+        for name, bib in zip(names, bibs):
+            self._add_shard(name, bib)
+
+    def rebuild_manifest(self):
+        """Rebuild the manifest by loading every shard."""
+        self.load_all()
+        self.manifest = {}
+        for name, bib in iteritems(self.shards):
+            for entry in bib:
+                self.manifest[entry.key] = name
+
+    def __iter__(self):
+        self.load_all()
+        for name in sorted(self.shards):
+            for entry in self.shards[name]:
+                yield entry
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __contains__(self, key):
+        return key in self.manifest
+
+    def __getitem__(self, idx):
+        if idx in self.manifest:
+            return self.shard(self.manifest[idx])[idx]
+        if is_integer(idx):
+            return self.bibentries[idx]
+        raise ValueError("%s is not in the bibliography." % idx)
+
+    @property
+    def bibentries(self):
+        return list(self)
+
+    @property
+    def keys(self):
+        return list(self.manifest)
+
+    def _rekey(self, entry, old):
+        name = self.manifest.get(old)
+        if name is None:
+            return
+        if entry.key in self.manifest:
+            entry._key = old
+            raise ValueError(
+                "key %s already exists. Please change the key." % entry.key)
+        self.shards[name]._rekey(entry, old)
+        del self.manifest[old]
+        self.manifest[entry.key] = name
+        self.modified.add(name)
+
+    def insert_entry(self, entry):
+        if entry.key in self.manifest:
+            raise ValueError(
+                "key %s already exists. Please change the key." % entry.key)
+        name = self.shard_of(entry)
+        self.shard(name).insert_entry(entry)
+        entry.bibliography = self
+        self.manifest[entry.key] = name
+        self.modified.add(name)
+
+    def insert_entries(self, entries):
+        """Insert several entries.
+
+        Either all of the entries are inserted or, if one of them is
+        invalid, none of them.
+        """
+        groups = {}
+        keys = set()
+        for entry in entries:
+            if entry.key in self.manifest or entry.key in keys:
+                raise ValueError(
+                    "key %s already exists. Please change the key."
+                    % entry.key)
+            keys.add(entry.key)
+            groups.setdefault(self.shard_of(entry), []).append(entry)
+        for name, group in iteritems(groups):
+            self.shard(name).insert_entries(group)
+            for entry in group:
+                entry.bibliography = self
+                self.manifest[entry.key] = name
+            self.modified.add(name)
+
+    def remove_entry(self, key):
+        """Remove and return the entry with citekey ``key``."""
+        if key not in self.manifest:
+            raise ValueError("%s is not in the bibliography." % key)
+        name = self.manifest.pop(key)
+        self.modified.add(name)
+        return self.shard(name).remove_entry(key)
+
+    def sort(self, by=('key',), reverse=False):
+        raise TypeError("A sharded bibliography is ordered by shard; "
+                        "use sorted() instead.")
+
+    def load_bibtex(self, path_or_url=None, ignore=False):
+        """Import the entries of a BibTeX file into their shards."""
+        bib = Bibliography()
+        count = bib.load_bibtex(path_or_url, ignore=ignore)
+        entries = list(bib)
+        for entry in entries:
+            bib.remove_entry(entry.key)
+        self.insert_entries(entries)
+        for abbrev, value in bib.abbrevs.items():
+            if self.abbrevs.get(abbrev) is None:
+                self.abbrevs[abbrev] = value
+        self.preambles.extend(bib.preambles)
+        return count
+
+    def save(self):
+        """Write the shards that changed, then the manifest.
+
+        Other writers wait until the manifest is written.
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        with locked(self.manifest_path, exclusive=True):
+            self._save()
+
+    def _merge_manifest(self):
+        """Apply the changes made here to the manifest as it is on disk.
+
+        Another writer may have saved since it was read.
+        """
+        if not os.path.exists(self.manifest_path):
+            return
+        manifest = self._read_manifest()
+        keys = manifest['keys']
+        for key in self._saved:
+            if key not in self.manifest:
+                keys.pop(key, None)
+        for key, name in iteritems(self.manifest):
+            if self._saved.get(key) != name:
+                keys[key] = name
+        self.manifest = keys
+        for abbrev, value in iteritems(manifest['strings']):
+            if self.abbrevs.get(abbrev) is None:
+                self.abbrevs[abbrev] = value
+        self.preambles = manifest['preambles'] + [
+            p for p in self.preambles if p not in manifest['preambles']]
+
+    def _save(self):
+        self._merge_manifest()
+        changed = set(self.modified)
+        for name, bib in iteritems(self.shards):
+            # entries may have been edited in place
+            if any(entry.dirty for entry in bib):
+                changed.add(name)
+        used = set(self.manifest.values())
+        for name in sorted(changed):
+            path = self.shard_path(name)
+            if name not in used:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                # the manifest lock is held; other writers change the
+                # file too, so it is merged with theirs
+                self.shards[name]._save_bibtex(path)
+        for name in set(self.shards) - changed:
+            path = self.shard_path(name)
+            stat = (Bibliography._file_stat(path) if os.path.exists(path)
+                    else None)
+            if stat != self.shards[name]._stat:
+                # changed by another writer; loaded again when needed
+                del self.shards[name]
+        strings = dict((abbrev, value) for abbrev, value
+                       in iteritems(self.abbrevs) if value is not None)
+        with atomic_open(self.manifest_path) as fp:
+            json.dump({'version': 1, 'by': self.by,
+                       'prefix_length': self.prefix_length,
+                       'keys': self.manifest, 'strings': strings,
+                       'preambles': self.preambles},
+                      fp, sort_keys=True, indent=0)
+        self._saved = dict(self.manifest)
+        self.modified = set()
+
+    def save_bibtex(self, path=None):
+        """Save the shards, or export everything to the file ``path``."""
+        if path is None:
+            self.save()
+            return
+        with locked(path, exclusive=True):
+            with atomic_open(path, 'wb') as fp:
+                fp.write(self.dumps_strings())
+                self.write_bibtex(fp)
@@ -0,0 +1,120 @@
+"""Sort bibliographies that may be too large to fit in memory."""
+
+import heapq
+import sys
+import tempfile
+
+from .compat import pickle, range
+from .core import Bibliography, sort_key
+
+
+class _Reversed(object):
+    """Wraps a sort key so that it sorts in descending order."""
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def _iter_entries(fp, bib):
+    """Parse ``fp`` one block at a time, yielding ``(entry, text)`` pairs.
+
+    The text is what `.Bibliography.write_bibtex` would output for the
+    entry if it had been loaded as part of a whole bibliography. The
+    @string and @preamble blocks are collected in ``bib``.
+    """
+    for entry in bib.iter_bibtex(fp):
+        yield entry, bib._dumps_entry(entry, True)
+
+
+def _write_run(records, tmpdir):
+    records.sort()
+    fp = tempfile.TemporaryFile(dir=tmpdir)
+    for record in records:
+        pickle.dump(record, fp, pickle.HIGHEST_PROTOCOL)
+    fp.seek(0)
+    return fp
+
+
+def _read_run(fp):
+    try:
+        while True:
+            yield pickle.load(fp)
+    except EOFError:
+        fp.close()
+
+
+def _merge_runs(runs, tmpdir, fanin):
+    # merge in several passes if there are too many runs to open at once
+    while len(runs) > fanin:
+        merged = []
+        for i in range(0, len(runs), fanin):
+            fp = tempfile.TemporaryFile(dir=tmpdir)
+            for record in heapq.merge(*[_read_run(run)
+                                        for run in runs[i:i + fanin]]):
+                pickle.dump(record, fp, pickle.HIGHEST_PROTOCOL)
+            fp.seek(0)
+            merged.append(fp)
+        runs = merged
+    return heapq.merge(*[_read_run(run) for run in runs])
+
+
+def external_sort(infp, outfp=sys.stdout, by=('key',), reverse=False,
+                  buffer_size=64 << 20, tmpdir=None, fanin=64):
+    """Sort the BibTeX entries read from ``infp`` into ``outfp``.
+
+    Entries are read into a buffer of about ``buffer_size`` characters.
+    Each time the buffer fills, it is sorted and spilled to a temporary
+    file as a run of ``(key, position, text)`` records; the runs are then
+    merged into ``outfp``, after the @preamble blocks and @string
+    definitions of the input. Memory use is bounded by ``buffer_size``
+    regardless of the size of the input.
+
+    The output is the same as loading the whole bibliography, calling
+    `.Bibliography.sort` with ``by`` and ``reverse`` and then
+    `.Bibliography.write_strings` and `.Bibliography.write_bibtex`. Ties are broken by input order,
+    as in an in-memory sort.
+
+    Returns the number of entries written.
+    """
+    key = sort_key(by)
+    if reverse:
+        keyfunc = key
+        key = lambda entry: _Reversed(keyfunc(entry))
+
+    runs = []
+    records = []
+    size = 0
+    count = 0
+    bib = Bibliography()
+    for entry, text in _iter_entries(infp, bib):
+        records.append((key(entry), count, text))
+        count += 1
+        size += len(text)
+        if size >= buffer_size:
+            runs.append(_write_run(records, tmpdir))
+            records = []
+            size = 0
+
+    # the strings are only all known once the input has been read
+    outfp.write(bib.dumps_strings())
+    if not runs:
+        # everything fit in the buffer
+        records.sort()
+        outfp.write("".join([text for _, _, text in records]))
+        return count
+
+    if records:
+        runs.append(_write_run(records, tmpdir))
+        records = []
+    for _, _, text in _merge_runs(runs, tmpdir, fanin):
+        outfp.write(text)
+    return count
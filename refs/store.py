@@ -0,0 +1,150 @@
+"""A content-addressed store for the PDF files of references.
+
+Each PDF is stored once, under its SHA-1 hash, in
+``<config dir>/pdfs/objects/<first two hex digits>/<rest>.pdf``. Files
+are added by reflink where the file system supports it, so storing a
+PDF copies no data, and copied elsewhere; storing the same PDF twice is
+free. Objects are never hard links, which would share the inode of the
+original file: annotating the original in place would then change the
+object without changing its hash. The index file maps each hash to the
+citekey of its reference, one ``hash citekey`` line per PDF.
+"""
+
+import errno
+import os
+import shutil
+import tempfile
+
+from . import paths
+from .metadata import sha1hash
+
+# the Linux ioctl that makes dst share the data blocks of src
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """Clone ``src`` to ``dst`` on file systems that support it."""
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def reflink_or_copy(src, dst):
+    """Make ``dst`` a reflink or else a copy of ``src``.
+
+    Returns how it was made: 'reflink' or 'copy'.
+    """
+    try:
+        _reflink(src, dst)
+        return 'reflink'
+    except (IOError, OSError, ImportError):
+        if os.path.exists(dst):
+            os.remove(dst)
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+class PDFStore(object):
+    """The PDF files of references, stored by content in ``root``."""
+
+    def __init__(self, root=None):
+        if root is None:
+            root = os.path.join(paths.config_dir, "pdfs")
+        self.root = root
+        self.index_path = os.path.join(root, "index")
+        self._index = None
+
+    def object_path(self, filehash):
+        return os.path.join(self.root, "objects", filehash[:2],
+                            filehash[2:] + ".pdf")
+
+    @property
+    def index(self):
+        """The dict mapping the hash of each stored PDF to a citekey."""
+        if self._index is None:
+            self._index = {}
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r') as fp:
+                    for line in fp:
+                        parts = line.split()
+                        if len(parts) == 2:
+                            # later lines override earlier ones
+                            self._index[parts[0]] = parts[1]
+        return self._index
+
+    def __contains__(self, filehash):
+        return os.path.exists(self.object_path(filehash))
+
+    def citekey(self, filehash):
+        """Return the citekey of the PDF with hash ``filehash``, or None."""
+        return self.index.get(filehash)
+
+    def hashes(self, citekey):
+        """Return the hashes of the PDFs of ``citekey``."""
+        return sorted([h for h, key in self.index.items() if key == citekey])
+
+    def path(self, citekey):
+        """Return the path of a stored PDF of ``citekey``, or None."""
+        for filehash in self.hashes(citekey):
+            if filehash in self:
+                return self.object_path(filehash)
+        return None
+
+    def paths(self, citekeys=None):
+        """Return a dict mapping citekeys to the paths of their PDFs.
+
+        If ``citekeys`` is given, only the PDFs of those are looked up.
+        """
+        found = {}
+        for filehash, citekey in sorted(self.index.items()):
+            if citekeys is not None and citekey not in citekeys:
+                continue
+            if citekey not in found and filehash in self:
+                found[citekey] = self.object_path(filehash)
+        return found
+
+    def add(self, path, citekey=None, filehash=None):
+        """Store the PDF at ``path`` and return its hash.
+
+        If the same content is already stored, nothing is copied. If
+        ``citekey`` is given, the PDF is recorded as belonging to it.
+        """
+        if filehash is None:
+            filehash = sha1hash(path)
+        dst = self.object_path(filehash)
+        # objects hard linked by earlier versions get their own data
+        if not os.path.exists(dst) or os.path.samefile(path, dst):
+            directory = os.path.dirname(dst)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # copy to a temporary name first so that dst is never partial
+            fd, tmp = tempfile.mkstemp(prefix=".tmp", dir=directory)
+            os.close(fd)
+            os.remove(tmp)
+            try:
+                reflink_or_copy(path, tmp)
+                os.rename(tmp, dst)
+            except:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        if citekey is not None and self.index.get(filehash) != citekey:
+            self.set_citekey(filehash, citekey)
+        return filehash
+
+    def set_citekey(self, filehash, citekey):
+        """Record that the PDF with hash ``filehash`` is of ``citekey``."""
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        with open(self.index_path, 'a') as fp:
+            fp.write("%s %s\n" % (filehash, citekey))
+        self.index[filehash] = citekey
+
+    def remove(self, filehash):
+        """Remove the PDF with hash ``filehash`` from the store."""
+        try:
+            os.remove(self.object_path(filehash))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
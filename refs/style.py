@@ -0,0 +1,349 @@
+"""Format references without running BibTeX.
+
+A `Style` decides what goes in each reference and in which order, much
+as a BibTeX ``.bst`` file does; only the fields listed for an entry's
+type in `.required_fields` and `.optional_fields` are used. A `Markup`
+decides how the reference is written: as a ``.bbl`` file for LaTeX, as
+plain text or as HTML.
+"""
+
+import re
+
+from .compat import html_escape
+from .core import Entry, optional_fields, required_fields, sort_key
+from .utils import detex, english_join, name_tokens
+
+_dash_re = re.compile(r"""\s*-+\s*""")
+
+# the fields each reference type may use, in lower case
+allowed_fields = dict(
+    (reftype, frozenset([f.lower() for f in required_fields[reftype]
+                         + optional_fields[reftype]]))
+    for reftype in required_fields)
+
+
+class Markup(object):
+    """Writes references as a LaTeX ``thebibliography`` environment."""
+
+    dash = "--"
+    newblock = "\n\\newblock "
+
+    def text(self, s):
+        return s
+
+    def emph(self, s):
+        return "{\\em %s}" % s
+
+    def quoted(self, s):
+        return "``%s''" % s
+
+    def begin(self, count):
+        return "\\begin{thebibliography}{%d}\n\n" % count
+
+    def item(self, key, label, body):
+        return "\\bibitem{%s}\n%s\n\n" % (key, body)
+
+    def end(self):
+        return "\\end{thebibliography}\n"
+
+
+class TextMarkup(Markup):
+    """Writes references as plain text, one per line."""
+
+    dash = "-"
+    newblock = " "
+
+    def text(self, s):
+        return detex(s)
+
+    def emph(self, s):
+        return s
+
+    def quoted(self, s):
+        return '"%s"' % s
+
+    def begin(self, count):
+        return ""
+
+    def item(self, key, label, body):
+        return "[%s] %s\n" % (label, body)
+
+    def end(self):
+        return ""
+
+
+class HTMLMarkup(Markup):
+    """Writes references as HTML paragraphs."""
+
+    dash = "&ndash;"
+    newblock = " "
+
+    def text(self, s):
+        return html_escape(detex(s))
+
+    def emph(self, s):
+        return "<i>%s</i>" % s
+
+    def quoted(self, s):
+        return "&ldquo;%s&rdquo;" % s
+
+    def begin(self, count):
+        return '<div class="bibliography">\n'
+
+    def item(self, key, label, body):
+        return '<p id="%s">[%s] %s</p>\n' % (html_escape(key), label, body)
+
+    def end(self):
+        return "</div>\n"
+
+
+markups = {'bbl': Markup, 'text': TextMarkup, 'html': HTMLMarkup}
+
+
+def split_name(name):
+    """Split a BibTeX name into its first and last parts."""
+    if "," in name:
+        parts = [p.strip() for p in name.split(",")]
+        # "von Last, Jr, First" or "von Last, First"
+        last = parts[0]
+        if len(parts) > 2:
+            last = "%s, %s" % (parts[0], parts[1])
+        return parts[-1], last
+    tokens = name_tokens(name)
+    if len(tokens) < 2:
+        return "", name.strip()
+    return " ".join(tokens[:-1]), tokens[-1]
+
+
+def _initials(first):
+    initials = []
+    for token in name_tokens(first):
+        if token.startswith("{") or token.endswith("."):
+            initials.append(token)
+        else:
+            initials.append("-".join([part[:1] + "." for part in
+                                      token.split("-")]))
+    return " ".join(initials)
+
+
+def _month(value):
+    month = value.strip().lower()
+    if month.isdigit() and 1 <= int(month) <= 12:
+        return Entry.months[int(month) - 1]
+    for name in Entry.months:
+        if len(month) >= 3 and name.lower().startswith(month[:3]):
+            return name
+    return value
+
+
+class Style(object):
+    """The plain style: full names, sorted by author, year and title.
+
+    References are made of blocks, each ending with a period, that are
+    separated by ``Markup.newblock``.
+    """
+
+    name = 'plain'
+    sort_by = ('author', 'year', 'title')
+    initials = False
+    in_word = "In"
+
+    def __init__(self, markup):
+        self.markup = markup
+
+    def field(self, entry, field):
+        """Return the marked-up text of ``field`` if the type allows it."""
+        if field not in allowed_fields.get(entry.reftype, ()):
+            return ""
+        if field == 'type':
+            # Entry.value would give the reference type, stored as 'Type'
+            value = entry.get('type', "")
+        else:
+            value = entry.value(field)
+        return self.markup.text(value.strip())
+
+    def format_name(self, name):
+        first, last = split_name(name)
+        if self.initials:
+            first = _initials(first)
+        return " ".join([p for p in (first, last) if p])
+
+    def names(self, entry, field):
+        if field not in allowed_fields.get(entry.reftype, ()):
+            return ""
+        names = entry.names(field)
+        etal = names and names[-1] == "others"
+        if etal:
+            names = names[:-1]
+        names = [self.markup.text(self.format_name(n)) for n in names]
+        if etal:
+            return "%s et al." % ", ".join(names)
+        return english_join(names) if len(names) < 3 else \
+            "%s, and %s" % (", ".join(names[:-1]), names[-1])
+
+    def editors(self, entry):
+        editors = self.names(entry, 'editor')
+        if not editors:
+            return ""
+        count = len(entry.names('editor'))
+        return "%s, %s" % (editors, "editors" if count > 1 else "editor")
+
+    def date(self, entry):
+        month = self.field(entry, 'month')
+        return " ".join([p for p in (_month(month) if month else "",
+                                     self.field(entry, 'year')) if p])
+
+    def pages(self, entry):
+        return _dash_re.sub(self.markup.dash, self.field(entry, 'pages'))
+
+    def volume_number_pages(self, entry):
+        s = self.field(entry, 'volume')
+        number = self.field(entry, 'number')
+        if number:
+            s += "(%s)" % number
+        pages = self.pages(entry)
+        if pages:
+            s = "%s:%s" % (s, pages) if s else "pages %s" % pages
+        return s
+
+    def volume_series(self, entry):
+        volume = self.field(entry, 'volume')
+        series = self.field(entry, 'series')
+        if volume:
+            return "volume %s%s" % (volume, " of %s" % self.markup.emph(
+                series) if series else "")
+        number = self.field(entry, 'number')
+        if number and series:
+            return "number %s in %s" % (number, series)
+        return series
+
+    def container(self, entry):
+        """Return the parts saying where the reference was published."""
+        reftype = entry.reftype
+        edition = self.field(entry, 'edition')
+        edition = "%s edition" % edition if edition else ""
+        if reftype == 'article':
+            journal = self.field(entry, 'journal')
+            return [self.markup.emph(journal) if journal else "",
+                    self.volume_number_pages(entry)]
+        if reftype in ('incollection', 'inproceedings'):
+            booktitle = self.field(entry, 'booktitle')
+            editors = self.editors(entry)
+            pages = self.pages(entry)
+            return ["%s %s" % (self.in_word, ", ".join([p for p in (
+                        editors, self.markup.emph(booktitle)) if p]))
+                    if booktitle else "",
+                    self.volume_series(entry),
+                    "pages %s" % pages if pages else "",
+                    self.field(entry, 'organization'),
+                    self.field(entry, 'publisher'),
+                    self.field(entry, 'address'), edition]
+        if reftype in ('phdthesis', 'mastersthesis'):
+            kind = ("PhD thesis" if reftype == 'phdthesis'
+                    else "Master's thesis")
+            return [self.field(entry, 'type') or kind,
+                    self.field(entry, 'school'),
+                    self.field(entry, 'address')]
+        if reftype == 'techreport':
+            number = self.field(entry, 'number')
+            kind = self.field(entry, 'type') or "Technical Report"
+            return ["%s %s" % (kind, number) if number else kind,
+                    self.field(entry, 'institution'),
+                    self.field(entry, 'address')]
+        chapter = self.field(entry, 'chapter')
+        pages = self.pages(entry)
+        return [self.volume_series(entry),
+                "chapter %s" % chapter if chapter else "",
+                "pages %s" % pages if pages else "",
+                self.field(entry, 'howpublished'),
+                self.field(entry, 'organization'),
+                self.field(entry, 'publisher'),
+                self.field(entry, 'address'), edition]
+
+    def title(self, entry):
+        title = self.field(entry, 'title')
+        if entry.reftype in ('book', 'inbook', 'manual', 'proceedings',
+                             'phdthesis'):
+            return self.markup.emph(title) if title else ""
+        return title
+
+    def authors(self, entry):
+        return self.names(entry, 'author') or self.editors(entry)
+
+    def format(self, entry):
+        """Return the body of the reference for ``entry``."""
+        blocks = [self.authors(entry), self.title(entry),
+                  ", ".join([p for p in self.container(entry) + [
+                      self.date(entry)] if p]),
+                  self.field(entry, 'note')]
+        return self.markup.newblock.join(
+            [b if b.endswith((".", "?", "!")) else b + "."
+             for b in blocks if b])
+
+    def order(self, entries):
+        return sorted(entries, key=sort_key(self.sort_by))
+
+
+class IEEEStyle(Style):
+    """An ieeetr-like style: initials, in citation order.
+
+    The whole reference is one block with the parts separated by commas
+    and the title in quotes.
+    """
+
+    name = 'ieeetr'
+    initials = True
+    in_word = "in"
+
+    def volume_number_pages(self, entry):
+        volume = self.field(entry, 'volume')
+        number = self.field(entry, 'number')
+        pages = self.pages(entry)
+        return ", ".join([p for p in (
+            "vol. %s" % volume if volume else "",
+            "no. %s" % number if number else "",
+            "pp. %s" % pages if pages else "") if p])
+
+    def format(self, entry):
+        parts = [self.authors(entry)]
+        title = self.field(entry, 'title')
+        rest = [p for p in self.container(entry) + [
+            self.date(entry), self.field(entry, 'note')] if p]
+        body = ", ".join([p for p in parts if p])
+        if title:
+            if entry.reftype in ('book', 'inbook', 'manual', 'proceedings'):
+                title = self.markup.emph(title) + ("," if rest else "")
+            else:
+                title = self.markup.quoted(title + ("," if rest else ""))
+            body = "%s, %s" % (body, title) if body else title
+            if rest:
+                body += " " + ", ".join(rest)
+        elif rest:
+            body = ", ".join([p for p in [body] + rest if p])
+        return body if body.endswith(".") else body + "."
+
+    def order(self, entries):
+        return entries
+
+
+styles = {'plain': Style, 'ieeetr': IEEEStyle}
+
+
+def format_entries(entries, style='plain', to='text'):
+    """Yield the formatted references for ``entries`` in pieces.
+
+    ``style`` is a name from `styles` and ``to`` one from `markups`.
+    """
+    if style not in styles:
+        raise ValueError("Unknown style '%s'; choose from %s." % (
+            style, ", ".join(sorted(styles))))
+    if to not in markups:
+        raise ValueError("Unknown format '%s'; choose from %s." % (
+            to, ", ".join(sorted(markups))))
+    markup = markups[to]()
+    style = styles[style](markup)
+    entries = list(style.order(entries))
+    yield markup.begin(len(entries))
+    for label, entry in enumerate(entries, 1):
+        yield markup.item(entry.key, label, style.format(entry))
+    yield markup.end()
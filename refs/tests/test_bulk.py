@@ -0,0 +1,53 @@
+import os
+import threading
+import time
+
+from refs.bulk import hash_files, lookup_files
+from refs.metadata import HashCache, file_sha1
+
+
+def test_hash_files_uses_cache(tmpdir):
+    cache = HashCache(str(tmpdir.join("hashes.sqlite")))
+    paths = []
+    for i in range(5):
+        path = tmpdir.join("%d.pdf" % i)
+        path.write("pdf %d" % i)
+        paths.append(str(path))
+    expected = [(p, file_sha1(p)) for p in paths]
+    assert list(hash_files(paths, processes=1, cache=cache)) == expected
+    assert len(cache.get_many([(p, os.stat(p)) for p in paths])) == 5
+
+    # cached hashes are not recomputed, even if wrong
+    cache.put(paths[0], "cached")
+    assert next(hash_files(paths, processes=1, cache=cache)) == \
+        (paths[0], "cached")
+
+
+class Catalog(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def by_identifier(self, filehash, view):
+        with self.lock:
+            self.calls += 1
+        time.sleep(0.05)
+        return filehash
+
+
+class Session(object):
+
+    def __init__(self):
+        self.catalog = Catalog()
+
+
+def test_lookup_files_stops_early():
+    session = Session()
+    hashed = [("%d.pdf" % i, str(i)) for i in range(100)]
+    results = lookup_files(hashed, session, workers=2)
+    assert next(results)[2] is not None
+    results.close()
+    calls = session.catalog.calls
+    time.sleep(0.2)
+    assert session.catalog.calls == calls < 10
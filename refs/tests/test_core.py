@@ -0,0 +1,239 @@
+import pytest
+
+from refs.core import Bibliography, FileChangedError
+
+bibtex = """% A bibliography edited by two processes
+@string{jnl = "Journal of Results"}
+
+@article{adams1999,
+  author = {Adams, A.},
+  title = {First},
+  journal = jnl,
+  year = {1999},
+}
+
+% between entries
+@article{baker2000,
+  author = {Baker, B.},
+  title = {Second},
+  journal = jnl,
+  year = {2000},
+}
+"""
+
+
+def load(path):
+    bib = Bibliography()
+    bib.load_bibtex(str(path))
+    return bib
+
+
+def test_save_after_concurrent_edit(tmpdir):
+    path = tmpdir.join("refs.bib")
+    path.write(bibtex)
+    ours = load(path)
+    theirs = load(path)
+
+    theirs.remove_entry('adams1999')
+    theirs.save_bibtex()
+
+    ours['baker2000'].fieldDict['title'] = "Second, revised"
+    ours['baker2000'].dirty = True
+    ours.save_bibtex()
+
+    text = path.read()
+    assert '@string{jnl = "Journal of Results"}' in text
+    assert "% A bibliography edited by two processes" in text
+    assert "% between entries" in text
+    assert "adams1999" not in text
+    assert "Second, revised" in text
+    assert 'adams1999' not in ours
+    reloaded = load(path)
+    assert reloaded.keys == ['baker2000']
+    assert reloaded.abbrevs['jnl'] == "Journal of Results"
+
+
+def test_save_keeps_entries_added_concurrently(tmpdir):
+    path = tmpdir.join("refs.bib")
+    path.write(bibtex)
+    ours = load(path)
+    theirs = load(path)
+
+    theirs.loads_bibtex("@misc{clark2001, title = {Third}}")
+    theirs.save_bibtex()
+
+    ours.remove_entry('adams1999')
+    ours.save_bibtex()
+
+    assert load(path).keys == ['baker2000', 'clark2001']
+    assert "% between entries" in path.read()
+
+
+def test_save_conflicting_edit(tmpdir):
+    path = tmpdir.join("refs.bib")
+    path.write(bibtex)
+    ours = load(path)
+    theirs = load(path)
+
+    theirs['adams1999'].fieldDict['title'] = "Theirs"
+    theirs['adams1999'].dirty = True
+    theirs.save_bibtex()
+
+    ours.remove_entry('adams1999')
+    with pytest.raises(FileChangedError):
+        ours.save_bibtex()
+    assert "Theirs" in path.read()
+
+
+def old_write_bibtex(entry, fp):
+    """The entry writer before entries were rendered into strings."""
+    fp.write("@%s{%s,\n" % (entry.reftype, entry.key))
+    count = 0
+    for rk in entry.fieldDict:
+        count += 1
+        if rk[0] == '_' or rk == 'Type':
+            continue
+        value = entry.fieldDict[rk]
+        fp.write("  %s=" % rk)
+        if rk in ['Author', 'Editor']:
+            fp.write("{%s}" % " and ".join(value))
+        elif rk == 'Month':
+            if value:
+                fp.write("{%s}" % value)
+            else:
+                fp.write("%s" % entry.month_name[:3].lower())
+        elif (entry.bibliography is not None
+              and value in entry.bibliography.abbrevs):
+            fp.write("%s" % value)
+        else:
+            fp.write("{%s}" % value)
+        if count < len(entry.fieldDict):
+            fp.write(",\n")
+        else:
+            fp.write("\n")
+    fp.write("}\n")
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, s):
+        self.writes.append(s)
+
+
+def edited(tmpdir):
+    path = tmpdir.join("refs.bib")
+    path.write(bibtex)
+    bib = load(path)
+    entry = bib['baker2000']
+    entry.fieldDict['Author'] = ["Baker, B.", "Clark, C."]
+    entry.fieldDict['Month'] = ""
+    entry.fieldDict['_month'] = 3
+    for entry in bib:
+        entry.dirty = True
+    return bib
+
+
+def test_dumps_bibtex_matches_field_writer(tmpdir):
+    bib = edited(tmpdir)
+    for entry in bib:
+        old = Recorder()
+        old_write_bibtex(entry, old)
+        assert entry.dumps_bibtex() == "".join(old.writes)
+    assert "  Month=mar,\n" in bib['baker2000'].dumps_bibtex()
+    assert "  journal=jnl,\n" in bib['adams1999'].dumps_bibtex()
+
+
+def test_write_bibtex_in_blocks(tmpdir):
+    bib = edited(tmpdir)
+    for i in range(20):
+        entry = bib['adams1999'].dumps_bibtex().replace(
+            "adams1999", "adams%d" % i)
+        bib.loads_bibtex(entry)
+    out = Recorder()
+    bib.write_bibtex(out, bufsize=200)
+    assert "".join(out.writes) == bib.dumps_bibtex()
+    assert 1 < len(out.writes) < len(bib)
+    assert all(len(s) >= 200 for s in out.writes[:-1])
+
+
+odd = """@Article{ adams1999 ,
+    author = "Adams, A." ,
+  title={First},   journal = jnl,
+  year = 1999, month = jan }
+@article{baker2000,
+  title = {Second},
+  year = {2000},
+  month = feb,
+}
+"""
+
+
+def test_passthrough_is_verbatim(tmpdir):
+    path = tmpdir.join("refs.bib")
+    path.write(odd)
+    bib = load(path)
+    assert bib.dumps_bibtex() == odd
+    bib.save_bibtex(str(tmpdir.join("copy.bib")))
+    assert tmpdir.join("copy.bib").read() == odd
+
+
+def test_passthrough_writes_edits(tmpdir):
+    path = tmpdir.join("refs.bib")
+    path.write(odd)
+    bib = load(path)
+    entry = bib['baker2000']
+    entry.set('title', "Second, revised")
+    entry.dirty = False
+    entry.year = "2001"
+    assert entry.dirty
+    entry.dirty = False
+    entry.month = "March"
+    assert entry.dirty
+    bib.save_bibtex()
+
+    text = path.read()
+    assert text.startswith(odd[:odd.index("@article")])
+    bib = load(path)
+    entry = bib['baker2000']
+    assert entry.value('title') == "Second, revised"
+    assert entry.value('year') == "2001"
+    assert entry.value('month') == "March"
+    assert text.lower().count("year") == 2
+
+
+def test_copied_entries_keep_their_strings(tmpdir):
+    tmpdir.join("master.bib").write(bibtex)
+    master = load(tmpdir.join("master.bib"))
+    path = tmpdir.join("paper.bib")
+    path.write("@article{other2001,\n  title = {Other},\n}\n")
+    paper = load(path)
+    paper.insert_entry(master['adams1999'])
+    paper.copy_abbrevs(master['adams1999'], master.abbrevs)
+    paper.save_bibtex()
+    assert load(path)['adams1999'].value('journal') == "jnl"
+    text = path.read()
+    assert "@string{jnl = {Journal of Results}}" in text
+    assert text.index("@string") < text.index("@article{adams1999")
+
+    # a modified entry may use it too, so it goes first when splicing
+    path.write("@article{other2001,\n  title = {Other},\n}\n")
+    paper = load(path)
+    paper['other2001'].fieldDict['journal'] = "jnl"
+    paper['other2001'].dirty = True
+    paper.copy_abbrevs(paper['other2001'], master.abbrevs)
+    paper.save_bibtex()
+    assert path.read().startswith("@string{jnl = {Journal of Results}}\n")
+
+
+def test_save_needs_a_path(tmpdir):
+    tmpdir.join("a.bib").write(bibtex)
+    tmpdir.join("b.bib").write("@article{other2001,\n  title = {Other},\n}\n")
+    bib = load(tmpdir.join("a.bib"))
+    bib.load_bibtex(str(tmpdir.join("b.bib")))
+    with pytest.raises(ValueError):
+        bib.save_bibtex()
+    bib.save_bibtex(str(tmpdir.join("c.bib")))
+    assert len(load(tmpdir.join("c.bib"))) == 3
@@ -0,0 +1,86 @@
+import pytest
+
+from refs import db
+from refs.core import Bibliography
+from refs.db import SQLiteBibliography, dump_sqlite, load_sqlite
+
+bibtex = """@string{jnl = "Journal of Results"}
+
+@article{adams1999,
+  author = {Adams, A. and Baker, B.},
+  title = {First},
+  journal = jnl,
+  year = {1999},
+}
+
+@book{baker2000,
+  editor = {Baker, B.},
+  title = {Second},
+  year = {2000},
+}
+
+@misc{carter,
+  title = {Third},
+}
+"""
+
+
+def parsed():
+    bib = Bibliography()
+    bib.loads_bibtex(bibtex)
+    return bib
+
+
+def fields(entry):
+    return dict((name, value) for name, value in entry.fieldDict.items()
+                if not name.startswith('_'))
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join("refs.sqlite"))
+    bib = parsed()
+    bib['baker2000'].year = "2001"
+    dump_sqlite(bib, path)
+    loaded = load_sqlite(path)
+    assert loaded.keys == ['adams1999', 'baker2000', 'carter']
+    assert loaded.abbrevs['jnl'] == "Journal of Results"
+    for entry in bib:
+        copy = loaded[entry.key]
+        assert copy.reftype == entry.reftype
+        assert fields(copy) == fields(entry)
+        assert copy.dirty == entry.dirty
+    assert loaded['baker2000'].year == 2001
+    # unmodified entries keep their source text, modified ones do not
+    for key in ('adams1999', 'carter'):
+        assert loaded[key].source == bib[key].source
+        assert not loaded[key].dirty
+    assert loaded['baker2000'].source is None
+
+
+def test_failed_dump_leaves_no_database(tmpdir, monkeypatch):
+    path = tmpdir.join("refs.sqlite")
+
+    def fail(bib):
+        raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(db, '_rows', fail)
+    with pytest.raises(RuntimeError):
+        dump_sqlite(parsed(), str(path))
+    assert tmpdir.listdir() == []
+
+
+def test_index(tmpdir):
+    path = str(tmpdir.join("refs.sqlite"))
+    dump_sqlite(parsed(), path)
+    bib = SQLiteBibliography(path)
+    assert bib[0].key == 'adams1999'
+    assert bib[2].key == 'carter'
+    assert bib[-1].key == 'carter'
+    assert bib[-3].key == 'adams1999'
+    assert bib['baker2000'].value('title') == "Second"
+    for idx in (3, -4, -100):
+        with pytest.raises(IndexError):
+            bib[idx]
+    with pytest.raises(ValueError):
+        bib['missing']
+    bib.close()
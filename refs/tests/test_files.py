@@ -0,0 +1,58 @@
+import threading
+import time
+
+from refs.core import Bibliography
+from refs.files import locked
+
+bibtex = """@article{alpha2001,
+  title = {Alpha},
+}
+@article{zeta2010,
+  title = {Zeta},
+}
+"""
+
+
+def in_thread(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_iter_bibtex_does_not_hold_lock(tmpdir):
+    path = str(tmpdir.join("refs.bib"))
+    tmpdir.join("refs.bib").write(bibtex)
+    entries = Bibliography().iter_bibtex(path)
+    assert next(entries).key == 'alpha2001'
+
+    def write():
+        with locked(path, exclusive=True):
+            with open(path, 'a') as fp:
+                fp.write("@article{omega2020,\n  title = {Omega},\n}\n")
+    writer = in_thread(write)
+    writer.join(5)
+    assert not writer.is_alive()
+    # the text appended after the file was opened is not read
+    assert [entry.key for entry in entries] == ['zeta2010']
+
+
+def test_locks_exclude_threads(tmpdir):
+    path = str(tmpdir.join("refs.bib"))
+    events = []
+
+    def hold():
+        with locked(path, exclusive=True):
+            events.append('held')
+            time.sleep(0.2)
+            events.append('released')
+
+    holder = in_thread(hold)
+    while not events:
+        time.sleep(0.01)
+    with locked(path, exclusive=True):
+        # reentrant within this thread
+        with locked(path):
+            events.append('taken')
+    holder.join()
+    assert events == ['held', 'released', 'taken']
@@ -0,0 +1,174 @@
+import re
+
+import pytest
+from click.testing import CliRunner
+
+from refs.core import Bibliography
+from refs.htmlpage import HTMLRenderer, Site, site_splits, write_html
+from refs.main import main
+
+bibtex = """@string{jnl = "Journal of Results"}
+
+@article{adams1999,
+  author = {Adams, A. and Baker, B.},
+  title = {First & {Best}},
+  journal = jnl,
+  year = {1999},
+  month = {3},
+  url = {http://example.com/?a=1&b=2},
+}
+
+@article{baker2000,
+  author = {Baker, B.},
+  title = {Second <result>},
+  journal = jnl,
+  year = {2000},
+}
+"""
+
+
+def entries(text=bibtex):
+    bib = Bibliography()
+    bib.loads_bibtex(text)
+    return list(bib)
+
+
+def untimed(page):
+    return re.sub(r"Generated by refs at [^<]*", "Generated by refs", page)
+
+
+def test_iter_page_is_lazy():
+    consumed = []
+
+    def parsed():
+        for entry in entries():
+            consumed.append(entry.key)
+            yield entry
+
+    chunks = HTMLRenderer().iter_page(parsed(), title="Refs")
+    assert "<title>Refs</title>" in next(chunks)
+    assert consumed == []
+    assert 'id="adams1999"' in next(chunks)
+    assert consumed == ['adams1999']
+    assert 'id="baker2000"' in next(chunks)
+    assert "Generated by refs at" in next(chunks)
+    assert consumed == ['adams1999', 'baker2000']
+
+
+def test_entry_is_escaped():
+    adams, baker = entries()
+    html = HTMLRenderer().entry(adams)
+    assert '<a href="http://example.com/?a=1&amp;b=2">' in html
+    assert "First &amp; Best" in html
+    assert "Adams, A. and Baker, B.." in html
+    assert "March 1999" in html
+    assert "Second &lt;result&gt;" in HTMLRenderer().entry(baker)
+
+
+def test_highlight():
+    html = HTMLRenderer(highlight="Best").entry(entries()[0])
+    assert '<font color="ff0000">Best</font>' in html
+
+
+def test_write_html_in_blocks():
+    class Recorder(object):
+        def __init__(self):
+            self.writes = []
+
+        def write(self, data):
+            self.writes.append(data)
+
+    recorder = Recorder()
+    write_html(entries(), recorder, title="Refs", bufsize=1)
+    # with a tiny buffer, each piece of the page is written on its own
+    assert len(recorder.writes) == 5
+    whole = Recorder()
+    write_html(entries(), whole, title="Refs")
+    assert len(whole.writes) == 1
+    assert (untimed("".join(recorder.writes))
+            == untimed("".join(whole.writes)))
+
+
+def html(tmpdir, *args):
+    result = CliRunner().invoke(
+        main, ("--master", str(tmpdir.join("master.bib")), "html") + args)
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_html_command(tmpdir):
+    path = tmpdir.join("refs.bib")
+    path.write(bibtex)
+    page = html(tmpdir, str(path))
+    # abbreviations are resolved as each entry is parsed
+    assert page.count("Journal of Results") == 2
+    assert page.index('id="adams1999"') < page.index('id="baker2000"')
+    output = tmpdir.join("refs.html")
+    html(tmpdir, "-o", str(output), str(path))
+    assert untimed(output.read()) == untimed(page)
+
+
+def test_site_splits():
+    adams, baker = entries()
+    assert site_splits['year'](adams) == ['1999']
+    assert site_splits['author'](adams) == ['adams', 'baker']
+    odd = entries("""@article{odd,
+  author = { and von Neumann, J. and Alan Turing and {}},
+  year = {circa},
+}
+""")[0]
+    assert site_splits['year'](odd) == ['unknown']
+    assert site_splits['author'](odd) == [
+        'unknown', 'von-neumann', 'turing', 'unknown']
+    assert site_splits['author'](entries("@misc{none,}")[0]) == ['unknown']
+
+
+def site(tmpdir, split='year'):
+    return Site(str(tmpdir.join("site")), split=split,
+                cache_dir=str(tmpdir.join("cache")))
+
+
+def test_site_build(tmpdir):
+    first = site(tmpdir)
+    first.build(entries(), title="Refs")
+    outdir = tmpdir.join("site")
+    assert sorted(outdir.listdir()) == [outdir.join(name) for name in (
+        "index.html", "year-1999.html", "year-2000.html")]
+    assert (first.rendered, first.written) == (2, 3)
+    index = outdir.join("index.html").read()
+    # newest years first
+    assert index.index("year-2000.html") < index.index("year-1999.html")
+    assert 'id="adams1999"' in outdir.join("year-1999.html").read()
+
+    # nothing changed, so nothing is rendered or written
+    again = site(tmpdir)
+    again.build(entries(), title="Refs")
+    assert (again.rendered, again.written) == (0, 0)
+
+    # a changed entry is rendered again, and only its pages are written
+    changed = entries(bibtex.replace("Second", "Third"))
+    again = site(tmpdir)
+    again.build(changed, title="Refs")
+    assert (again.rendered, again.written) == (1, 1)
+    assert "Third" in outdir.join("year-2000.html").read()
+
+    # pages without entries are removed
+    again = site(tmpdir)
+    again.build(changed[:1], title="Refs")
+    assert not outdir.join("year-2000.html").exists()
+    assert (again.rendered, again.written) == (0, 1)
+
+
+def test_site_by_author(tmpdir):
+    builder = site(tmpdir, split='author')
+    builder.build(entries(bibtex.replace("Baker, B.}", "Baker, B. and }")))
+    outdir = tmpdir.join("site")
+    assert outdir.join("author-adams.html").exists()
+    assert outdir.join("author-unknown.html").exists()
+    baker = outdir.join("author-baker.html").read()
+    assert 'id="adams1999"' in baker and 'id="baker2000"' in baker
+
+
+def test_site_split_must_exist(tmpdir):
+    with pytest.raises(ValueError):
+        site(tmpdir, split='journal')
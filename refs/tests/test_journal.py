@@ -0,0 +1,44 @@
+from refs import journal
+from refs.journal import Journal
+
+bibtex = """@article{alpha2001,
+  title = {Alpha},
+  year = {2001},
+}
+@article{zeta2010,
+  title = {Zeta},
+  year = {2010},
+}
+"""
+
+
+def test_compact_keeps_edits_of_other_processes(tmpdir):
+    path = str(tmpdir.join("master.bib"))
+    tmpdir.join("master.bib").write(bibtex)
+    journal_a, journal_b = Journal(path), Journal(path)
+    a = journal.load(path, journal_a)
+    b = journal.load(path, journal_b)
+
+    b.remove_entry('zeta2010')
+    journal_b.record(b)
+
+    a['alpha2001'].fieldDict['title'] = "Alpha, revised"
+    a['alpha2001'].dirty = True
+    journal_a.record(a)
+    journal.compact(path, a, journal_a)
+
+    assert journal_a.size() == 0
+    bib = journal.load(path)
+    assert bib.keys == ['alpha2001']
+    assert bib['alpha2001'].value('title') == "Alpha, revised"
+
+
+def test_compact_keeps_unfinished_line(tmpdir):
+    path = str(tmpdir.join("master.bib"))
+    tmpdir.join("master.bib").write(bibtex)
+    log = Journal(path)
+    tmpdir.join("master.bib.journal").write(
+        '{"op": "rm", "key": "zeta2010"}\n{"op": "rm", "ke')
+    journal.compact(path, journal=log)
+    assert tmpdir.join("master.bib.journal").read() == '{"op": "rm", "ke'
+    assert journal.load(path).keys == ['alpha2001']
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from refs.core import Bibliography
+from refs.jsonio import (csl2entry, csl_json_chunks, entry2csl,
+                         load_csl_json)
+
+bibtex = """@article{adams1999,
+  author = {Adams, A. and {World Health Organization} and Carl Baker},
+  title = {First},
+  journal = {Journal of Results},
+  year = {1999},
+  month = mar,
+}
+"""
+
+
+def test_csl_round_trip(tmpdir):
+    bib = Bibliography()
+    bib.loads_bibtex(bibtex)
+    item = entry2csl(bib['adams1999'])
+    assert item['author'] == [
+        {'family': "Adams", 'given': "A."},
+        {'literal': "World Health Organization"},
+        {'family': "Baker", 'given': "Carl"}]
+    assert item['issued'] == {'date-parts': [[1999, 3]]}
+    path = tmpdir.join("refs.json")
+    path.write("".join(csl_json_chunks(bib)))
+    entry = load_csl_json(str(path))['adams1999']
+    assert entry.reftype == 'article'
+    assert entry.value('journal') == "Journal of Results"
+    assert entry.value('month') == "mar"
+    assert entry.value('author') == (
+        "Adams, A. and {World Health Organization} and Baker, Carl")
+
+
+@pytest.mark.parametrize('parts, month', [
+    ([2001, 3], "mar"),
+    ([2001, "12"], "dec"),
+    ([2001, 21], ""),  # spring
+    ([2001, 0], ""),
+    ([2001, 13], ""),
+    ([2001, "summer"], ""),
+    ([2001], ""),
+])
+def test_csl_months(parts, month):
+    entry = csl2entry({'id': "a", 'issued': {'date-parts': [parts]}})
+    assert entry.value('year') == "2001"
+    assert entry.value('month') == month
+
+
+def test_csl_numeric_id():
+    entry = csl2entry(json.loads('{"id": 42, "type": "book"}'))
+    assert entry.key == "42"
+    assert entry.reftype == 'book'
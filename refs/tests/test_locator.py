@@ -0,0 +1,33 @@
+from refs.core import Bibliography
+from refs.locator import Locator
+
+bibtex = """@article{alpha2001,
+  title = {Alpha},
+  doi = {10.1/alpha},
+}
+@article{zeta2010,
+  title = {Zeta},
+  url = {http://example.com/zeta},
+}
+"""
+
+
+def test_update_changed_keys(tmpdir):
+    tmpdir.join("master.bib").write(bibtex)
+    bib = Bibliography()
+    bib.load_bibtex(str(tmpdir.join("master.bib")))
+    index = Locator(str(tmpdir.join("locator.sqlite")))
+    assert not index.update([], [], {}, "new", "old")
+
+    index.sync(list(bib), {}, "old 1", set(bib.keys))
+    bib['alpha2001'].fieldDict['doi'] = "10.1/beta"
+    assert index.update([bib['alpha2001']], ['zeta2010'],
+                        {'alpha2001': "/pdfs/alpha.pdf"}, "new 1", "old")
+    assert index.current() == "new 1"
+    assert index.lookup('alpha2001') == (
+        {'pdf': "/pdfs/alpha.pdf", 'doi': "10.1/beta"}, "new 1")
+    assert index.lookup('zeta2010') == (None, "new 1")
+
+    # an index that was not up to date is left alone
+    assert not index.update([], ['alpha2001'], {}, "newer 1", "old")
+    assert index.lookup('alpha2001')[0] is not None
@@ -0,0 +1,353 @@
+import errno
+import os
+import re
+
+import pytest
+from click.testing import CliRunner
+
+from refs import db, sorting
+from refs import main as refs_main
+from refs.bulk import ResumeJournal
+from refs.core import Bibliography, Entry
+from refs.main import Refs, main, write_stream
+from refs.rc import rc
+from refs.store import PDFStore
+
+master = """@string{jnl = "Journal of Results"}
+
+@article{adams1999,
+  author = {Adams, A.},
+  title = {First},
+  journal = jnl,
+  year = {1999},
+}
+"""
+
+
+def refs(tmpdir, *args):
+    result = CliRunner().invoke(
+        main, ("--master", str(tmpdir.join("master.bib"))) + args)
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_add_copies_strings(tmpdir):
+    tmpdir.join("master.bib").write(master)
+    paper = str(tmpdir.join("paper.bib"))
+    refs(tmpdir, "add", "adams1999", paper)
+    bib = Bibliography()
+    bib.load_bibtex(paper)
+    assert bib.abbrevs == {'jnl': "Journal of Results"}
+    assert bib['adams1999'].value('journal') == "jnl"
+
+
+unsorted = """@preamble{"\\newcommand{\\noop}[1]{}"}
+@string{jnl = "Journal of Results"}
+
+@article{baker2000,
+  author = {Baker, B.},
+  title = {Second},
+  journal = jnl,
+  year = {2000},
+}
+
+@article{adams1999,
+  author = {Adams, A.},
+  title = {First},
+  journal = jnl,
+  year = {1999},
+}
+"""
+
+
+@pytest.mark.parametrize('external', [(), ("--external",)])
+def test_sort_overwrite_keeps_strings(tmpdir, external):
+    path = tmpdir.join("refs.bib")
+    path.write(unsorted)
+    refs(tmpdir, "sort", "--overwrite", str(path), *external)
+    bib = Bibliography()
+    bib.load_bibtex(str(path))
+    assert [entry.key for entry in bib] == ['adams1999', 'baker2000']
+    assert bib.abbrevs == {'jnl': "Journal of Results"}
+    assert bib.preambles == ['@preamble{"\\newcommand{\\noop}[1]{}"}']
+    # sorting again changes nothing
+    text = path.read()
+    refs(tmpdir, "sort", "--overwrite", str(path), *external)
+    assert path.read() == text
+
+
+def test_external_sort_keeps_strings_across_runs(tmpdir):
+    path = tmpdir.join("refs.bib")
+    path.write(unsorted)
+    out = tmpdir.join("sorted.bib")
+    with open(str(path)) as infp, open(str(out), 'w') as outfp:
+        # a tiny buffer spills every entry to a run of its own
+        sorting.external_sort(infp, outfp, buffer_size=1)
+    bib = Bibliography()
+    bib.load_bibtex(str(path))
+    bib.sort()
+    assert out.read() == bib.dumps_strings() + bib.dumps_bibtex()
+
+
+def keys(bibtex):
+    bib = Bibliography()
+    bib.loads_bibtex(bibtex)
+    return [entry.key for entry in bib]
+
+
+authors = """@article{one,
+  author = {Young, Y.},
+  title = {Beta},
+  year = {1999},
+}
+
+@article{two,
+  author = { and Baker, B.},
+  title = {Gamma},
+  year = {2001},
+}
+
+@article{three,
+  author = {Adams, A.},
+  title = {Alpha},
+  year = {2000},
+}
+
+@article{four,
+  author = {},
+  title = {Delta},
+  year = {1998},
+}
+"""
+
+
+@pytest.mark.parametrize('args, expected', [
+    (("--by", "author"), ['three', 'one', 'two', 'four']),
+    # ties, here the missing authors, stay in input order
+    (("--by", "author", "--reverse"), ['two', 'four', 'one', 'three']),
+    (("--by", "year"), ['four', 'one', 'three', 'two']),
+    (("--by", "year", "--reverse"), ['two', 'three', 'one', 'four']),
+    (("--by", "title,key"), ['three', 'one', 'four', 'two']),
+])
+def test_sort_by(tmpdir, args, expected):
+    path = tmpdir.join("refs.bib")
+    path.write(authors)
+    assert keys(refs(tmpdir, "sort", str(path), *args)) == expected
+    assert keys(refs(tmpdir, "sort", "--external", str(path), *args)) \
+        == expected
+
+
+def listed(output):
+    return re.findall(r"CiteKey: (\S+)", output)
+
+
+@pytest.mark.parametrize('args, expected', [
+    ((), ['one', 'two', 'three', 'four']),
+    (("--offset", "1"), ['two', 'three', 'four']),
+    (("--limit", "2"), ['one', 'two']),
+    (("--offset", "1", "--limit", "2"), ['two', 'three']),
+    (("--offset", "5"), []),
+    (("--limit", "0"), []),
+])
+def test_list_offset_limit(tmpdir, args, expected):
+    path = tmpdir.join("refs.bib")
+    path.write(authors)
+    assert listed(refs(tmpdir, "list", str(path), *args)) == expected
+
+
+def test_list_unique(tmpdir):
+    first = tmpdir.join("first.bib")
+    first.write(authors)
+    second = tmpdir.join("second.bib")
+    second.write(unsorted.replace("baker2000", "three"))
+    args = ("list", str(first), str(second))
+    assert listed(refs(tmpdir, *args)) == [
+        'one', 'two', 'three', 'four', 'three', 'adams1999']
+    output = refs(tmpdir, *(args + ("--unique",)))
+    assert listed(output) == ['one', 'two', 'three', 'four', 'adams1999']
+    # the first entry with a citekey is the one listed
+    assert "Second" not in output
+    assert listed(refs(tmpdir, *(args + ("--unique", "--offset", "3",
+                                         "--limit", "2")))) == [
+        'four', 'adams1999']
+
+
+def test_write_stream_stops_on_closed_pipe(monkeypatch):
+    read, write = os.pipe()
+    os.close(read)
+    produced = []
+
+    def chunks():
+        for i in range(1000):
+            produced.append(i)
+            yield "x" * 100
+
+    with os.fdopen(write, 'w') as out:
+        monkeypatch.setattr('sys.stdout', out)
+        write_stream(chunks())
+        # stdout now discards output, so flushing it at exit succeeds
+        out.write("more")
+        out.flush()
+    # the first chunk is written at once, and fails
+    assert produced == [0]
+
+
+def test_write_stream_raises_other_errors(monkeypatch):
+    class Full(object):
+        def write(self, data):
+            raise IOError(errno.ENOSPC, "No space left on device")
+
+        def flush(self):
+            pass
+
+    monkeypatch.setattr('sys.stdout', Full())
+    with pytest.raises(IOError):
+        write_stream(iter(["x"]))
+
+
+def test_list_jobs_keeps_file_order(tmpdir):
+    # the first file takes longest to parse, so it is loaded last
+    paths = []
+    expected = []
+    for i, count in enumerate([2000, 1, 50, 3]):
+        path = tmpdir.join("refs%d.bib" % i)
+        keys = ["file%dentry%d" % (i, j) for j in range(count)]
+        path.write("".join(["@article{%s,\n  title = {T},\n}\n\n" % key
+                            for key in keys]))
+        paths.append(str(path))
+        expected.extend(keys)
+    for jobs in ("1", "3"):
+        output = refs(tmpdir, "list", "--jobs", jobs, *paths)
+        assert listed(output) == expected
+
+
+def test_list_jobs_abbrev(tmpdir):
+    # each file keeps its own strings when it is loaded in a worker
+    first = tmpdir.join("first.bib")
+    first.write(master)
+    second = tmpdir.join("second.bib")
+    second.write(unsorted.replace('"Journal of Results"', "{Other}"))
+    output = refs(tmpdir, "list", "--jobs", "2", "--abbrev",
+                  str(first), str(second))
+    assert listed(output) == ['adams1999', 'baker2000', 'adams1999']
+    assert output.count("Journal of Results") == 1
+    assert output.count("Other") == 2
+
+
+@pytest.fixture
+def sqlite_store():
+    rc.set('general', 'store', 'sqlite')
+    yield
+    rc.reload_rc()
+
+
+def test_sqlite_master_is_imported_once(tmpdir, sqlite_store):
+    path = tmpdir.join("master.bib")
+    path.write(unsorted)
+    master = Refs(str(path)).load_master()
+    assert master.keys == ['baker2000', 'adams1999']
+    assert master.abbrevs['jnl'] == "Journal of Results"
+    master.close()
+    assert tmpdir.join("master.sqlite").exists()
+    # later runs use the database, not the file
+    path.write(master)
+    master = Refs(str(path)).load_master()
+    assert master.keys == ['baker2000', 'adams1999']
+    master.close()
+
+
+def test_failed_sqlite_import_leaves_no_database(tmpdir, sqlite_store,
+                                                 monkeypatch):
+    path = tmpdir.join("master.bib")
+    path.write(unsorted)
+
+    def fail(bib):
+        raise RuntimeError("interrupted")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(db, '_rows', fail)
+        with pytest.raises(RuntimeError):
+            Refs(str(path)).load_master()
+    assert not tmpdir.join("master.sqlite").exists()
+    # the next run imports the master again
+    master = Refs(str(path)).load_master()
+    assert master.keys == ['baker2000', 'adams1999']
+    master.close()
+
+
+class Doc(object):
+    """Stands in for a catalog document; doc2bib is replaced below."""
+
+    def __init__(self, authors):
+        self.authors = authors
+
+
+def fake_doc2bib(doc):
+    # IndexError without authors, like doc2bib
+    entry = Entry(doc.authors[0].lower() + "2001", None)
+    entry.reftype = 'article'
+    return entry
+
+
+@pytest.fixture
+def catalog(tmpdir, monkeypatch):
+    """PDFs under tmpdir/pdfs, the first of them with incomplete metadata,
+    and their lookups, interrupted after the first two if ``interrupt``
+    is set."""
+    directory = tmpdir.mkdir("pdfs")
+    found = []
+    for name, surname in (("a.pdf", ""), ("b.pdf", "Baker"),
+                          ("c.pdf", "Carter")):
+        path = directory.join(name)
+        path.write(name)
+        found.append((str(path), name, Doc([surname] if surname else [])))
+    state = {'interrupt': False}
+
+    def bulk_files(refs, directory, journal_name, jobs, workers):
+        resume = ResumeJournal(os.path.join(directory, journal_name))
+
+        def lookups():
+            todo = [(path, sha1, doc) for path, sha1, doc in found
+                    if not resume.is_done(path)
+                    and sha1 not in resume.done_hashes]
+            for i, result in enumerate(todo):
+                if state['interrupt'] and i == 2:
+                    raise KeyboardInterrupt
+                yield result
+        return resume, lookups()
+
+    monkeypatch.setattr(refs_main, 'bulk_files', bulk_files)
+    monkeypatch.setattr(refs_main, 'doc2bib', fake_doc2bib)
+    monkeypatch.setattr(refs_main, 'PDFStore',
+                        lambda: PDFStore(str(tmpdir.join("store"))))
+    return directory, state
+
+
+def test_add_directory_skips_incomplete_metadata(tmpdir, catalog, capsys):
+    directory, state = catalog
+    refs_main.add_directory(Refs(str(tmpdir.join("master.bib"))),
+                            str(directory), None, 1, 1)
+    err = capsys.readouterr()[1]
+    assert "a.pdf has incomplete catalog metadata" in err
+    assert "Added 2 files; 1 were not found." in err
+    bib = Bibliography()
+    bib.load_bibtex(str(tmpdir.join("master.bib")))
+    assert sorted(bib.keys) == ['baker2001', 'carter2001']
+
+
+def test_rename_directory_skips_incomplete_metadata(tmpdir, catalog, capsys):
+    directory, state = catalog
+    refs = Refs(str(tmpdir.join("master.bib")))
+    state['interrupt'] = True
+    with pytest.raises(KeyboardInterrupt):
+        refs_main.rename_directory(refs, str(directory), 1, 1)
+    assert "a.pdf has incomplete catalog metadata" in capsys.readouterr()[1]
+    # the file is done with, so a resumed run does not look it up again
+    resume = ResumeJournal(str(directory.join(".refs-rename.journal")))
+    assert resume.is_done(str(directory.join("a.pdf")))
+    assert resume.is_done(str(directory.join("baker2001.pdf")))
+
+    state['interrupt'] = False
+    refs_main.rename_directory(refs, str(directory), 1, 1)
+    assert sorted(directory.listdir()) == [directory.join(name) for name in (
+        "a.pdf", "baker2001.pdf", "carter2001.pdf")]
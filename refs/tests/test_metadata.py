@@ -0,0 +1,214 @@
+import json
+import os
+import stat
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import pytest
+
+from refs import metadata
+from refs.core import Entry
+from refs.metadata import (HashCache, RateLimiter, TokenCache, by_filehash,
+                           connect, file_sha1, rate_limiter, search_many,
+                           sha1hash)
+
+
+def test_hash_cache(tmpdir):
+    cache = HashCache(str(tmpdir.join("hashes.sqlite")))
+    paths = []
+    for i in range(3):
+        path = tmpdir.join("%d.pdf" % i)
+        path.write("pdf %d" % i)
+        paths.append(str(path))
+    assert cache.get(paths[0]) is None
+    assert not os.path.exists(cache.path)
+
+    cache.update([(p, file_sha1(p), os.stat(p)) for p in paths])
+    assert sha1hash(paths[1], cache=cache) == file_sha1(paths[1])
+    found = cache.get_many([(p, os.stat(p)) for p in paths])
+    assert found == dict((p, file_sha1(p)) for p in paths)
+
+    # a changed file is hashed again
+    tmpdir.join("2.pdf").write("changed, and longer")
+    assert cache.get(paths[2]) is None
+    assert sha1hash(paths[2], cache=cache) == file_sha1(paths[2])
+    assert cache.get(paths[2]) == file_sha1(paths[2])
+
+
+class Catalog(BaseHTTPRequestHandler):
+    """A stand-in for the Mendeley token endpoint and catalog."""
+
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, body, content_type="application/json"):
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.tokens.append(self.client_address)
+        self.reply({'access_token': "token%d" % len(self.server.tokens),
+                    'token_type': "bearer", 'expires_in': 3600,
+                    'scope': "all"})
+
+    def do_GET(self):
+        self.server.lookups.append(
+            (self.client_address, self.headers.get("Authorization")))
+        self.reply([{'id': "1", 'title': "Alpha", 'type': "journal"}],
+                   "application/vnd.mendeley-document.1+json")
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    # a connection kept alive must not hold up the others
+    daemon_threads = True
+
+
+@pytest.fixture
+def catalog(tmpdir, monkeypatch):
+    monkeypatch.setenv('OAUTHLIB_INSECURE_TRANSPORT', "1")
+    monkeypatch.setattr(metadata, '_sessions', {})
+    server = Server(("127.0.0.1", 0), Catalog)
+    server.tokens, server.lookups = [], []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = "http://127.0.0.1:%d" % server.server_port
+    server.cache = TokenCache(str(tmpdir.join("token.json")))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_token_reused(catalog, monkeypatch):
+    session = connect("id", "secret", catalog.url, catalog.cache)
+    assert connect("id", "secret", catalog.url, catalog.cache) is session
+    assert len(catalog.tokens) == 1
+    mode = os.stat(catalog.cache.path).st_mode
+    assert stat.S_IMODE(mode) == 0o600
+
+    # a later process reuses the saved token
+    monkeypatch.setattr(metadata, '_sessions', {})
+    session = connect("id", "secret", catalog.url, catalog.cache)
+    assert by_filehash(session, "0" * 40).title == "Alpha"
+    assert len(catalog.tokens) == 1
+    assert catalog.lookups[-1][1] == "Bearer token1"
+
+
+def test_token_refreshed(catalog):
+    session = connect("id", "secret", catalog.url, catalog.cache)
+    session._client._expires_at = time.time() - 1
+    assert by_filehash(session, "0" * 40).title == "Alpha"
+    assert len(catalog.tokens) == 2
+    assert catalog.lookups[-1][1] == "Bearer token2"
+    saved = catalog.cache.get("id", catalog.url)
+    assert saved['access_token'] == "token2"
+
+
+def test_session_reused(catalog):
+    session = connect("id", "secret", catalog.url, catalog.cache)
+    for i in range(3):
+        by_filehash(session, "%040d" % i)
+    # one connection for all lookups
+    assert len(set(address for address, _ in catalog.lookups)) == 1
+
+
+class Session(object):
+    host = "https://catalog.test"
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """Lookups that take as many tenths of a second as the query says,
+    and entries with the query as citekey."""
+    import requests
+
+    def lookup(session, query, limiter=None):
+        delay, _, what = query.partition(":")
+        time.sleep(float(delay) / 10)
+        if what == "error":
+            raise requests.ConnectionError("connection refused")
+        if what == "missing":
+            return None
+        return query
+
+    def doc2bib(doc):
+        if doc.endswith("incomplete"):
+            raise IndexError("list index out of range")
+        return Entry(doc, None)
+
+    monkeypatch.setattr(metadata, 'lookup', lookup)
+    monkeypatch.setattr(metadata, 'doc2bib', doc2bib)
+
+
+def test_search_many_yields_as_lookups_complete(lookups):
+    queries = ["3:slow", "0:fast", "1:medium"]
+    results = list(search_many(queries, "id", "secret", session=Session(),
+                               workers=3, rate=0))
+    assert [query for query, _, _ in results] == ["0:fast", "1:medium",
+                                                  "3:slow"]
+    assert [entry.key for _, entry, _ in results] == ["0:fast", "1:medium",
+                                                      "3:slow"]
+    assert all(error is None for _, _, error in results)
+
+
+def test_search_many_reports_errors(lookups):
+    queries = ["0:found", "0:missing", "0:error", "0:incomplete"]
+    results = dict((query, (entry, error)) for query, entry, error in
+                   search_many(queries, "id", "secret", session=Session(),
+                               workers=2, rate=0))
+    assert sorted(results) == sorted(queries)
+    assert results["0:found"][0].key == "0:found"
+    assert results["0:found"][1] is None
+    assert results["0:missing"] == (None, None)
+    entry, error = results["0:error"]
+    assert entry is None and "connection refused" in str(error)
+    entry, error = results["0:incomplete"]
+    assert entry is None and isinstance(error, ValueError)
+    assert "incomplete catalog metadata" in str(error)
+
+
+def test_rate_limiter_spaces_out_requests():
+    limiter = RateLimiter(50)
+    starts = []
+
+    def work():
+        for i in range(5):
+            limiter.wait()
+            starts.append(time.time())
+
+    threads = [threading.Thread(target=work) for i in range(4)]
+    begin = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    starts.sort()
+    assert len(starts) == 20
+    # the nth request starts n / rate seconds after the first, or later
+    for n, start in enumerate(starts):
+        assert start >= begin + n / 50.0 - 0.001
+
+
+def test_rate_limiter_unlimited():
+    limiter = RateLimiter(0)
+    start = time.time()
+    for i in range(1000):
+        limiter.wait()
+    assert time.time() - start < 0.1
+
+
+def test_rate_limiter_per_host(monkeypatch):
+    monkeypatch.setattr(metadata, '_limiters', {})
+    limiter = rate_limiter("https://a", 5)
+    assert rate_limiter("https://b", 5) is not limiter
+    assert rate_limiter("https://a", 10) is limiter
+    assert limiter.rate == 10
@@ -0,0 +1,93 @@
+import os
+import stat
+import sys
+
+import pytest
+
+from refs.rc import rc
+from refs.render import Build, RenderError
+
+bibtex = """@preamble{ "\\newcommand{\\noop}[1]{}" }
+@string{jnl = "Journal of Results"}
+
+@article{adams1999,
+  author = {Adams, A.},
+  title = {First},
+  journal = jnl,
+  year = {1999},
+}
+"""
+
+# logs its name and arguments, and fails if $STUB_FAIL names it
+stub = """#!%s
+import os, sys
+name = os.path.basename(sys.argv[0])
+with open(os.environ['STUB_LOG'], 'a') as fp:
+    fp.write("%%s %%s\\n" %% (name, " ".join(sys.argv[1:])))
+if os.environ.get('STUB_FAIL') == name:
+    sys.exit(1)
+if name == 'latex':
+    job = os.path.splitext(sys.argv[-1])[0]
+    with open(job + ".dvi", 'w') as fp:
+        fp.write("dvi")
+"""
+
+
+@pytest.fixture
+def tools(tmpdir, monkeypatch):
+    bindir = tmpdir.mkdir("bin")
+    for name in ('latex', 'bibtex'):
+        path = bindir.join(name)
+        path.write(stub % sys.executable)
+        path.chmod(stat.S_IRWXU)
+        rc.set('render', name, str(path))
+    log = tmpdir.join("log")
+    log.write("")
+    monkeypatch.setenv('STUB_LOG', str(log))
+    yield log
+    rc.reload_rc()
+
+
+def calls(log):
+    return [line.split()[0] for line in log.read().splitlines()]
+
+
+def make_build(tmpdir):
+    path = tmpdir.join("refs.bib")
+    if not path.exists():
+        path.write(bibtex)
+    return Build(str(path), str(tmpdir.join("out")))
+
+
+def test_build_and_skip(tmpdir, tools):
+    assert make_build(tmpdir).build()
+    assert calls(tools) == ['latex', 'bibtex', 'latex']
+    assert os.path.exists(str(tmpdir.join("out", "refs.dvi")))
+
+    assert not make_build(tmpdir).build()
+    assert len(calls(tools)) == 3
+
+
+def test_rebuild_when_changed(tmpdir, tools):
+    assert make_build(tmpdir).build()
+    tmpdir.join("refs.bib").write(bibtex.replace("First", "Revised"))
+    assert make_build(tmpdir).build()
+    assert len(calls(tools)) == 6
+    assert make_build(tmpdir).build(force=True)
+    assert len(calls(tools)) == 9
+
+
+def test_failed_build_is_not_current(tmpdir, tools, monkeypatch):
+    monkeypatch.setenv('STUB_FAIL', 'bibtex')
+    with pytest.raises(RenderError):
+        make_build(tmpdir).build()
+    monkeypatch.delenv('STUB_FAIL')
+    assert make_build(tmpdir).build()
+
+
+def test_bibliography_keeps_strings(tmpdir, tools):
+    make_build(tmpdir).build()
+    text = tmpdir.join("out", "refs.refs.bib").read()
+    assert '@preamble{ "\\newcommand{\\noop}[1]{}" }' in text
+    assert "@string{jnl = {Journal of Results}}" in text
+    assert text.index("@string") < text.index("@article")
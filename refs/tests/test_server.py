@@ -0,0 +1,156 @@
+import io
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+import refs.main
+from refs import client, paths
+from refs.client import ServerError, frame, request
+from refs.locator import Locator
+from refs.server import Server
+
+bibtex = """@article{alpha2001,
+  title = {Alpha},
+  year = {2001},
+}
+"""
+
+
+@pytest.fixture
+def server(tmpdir):
+    path = str(tmpdir.join("refs.sock"))
+    process = multiprocessing.Process(target=Server(path).serve_forever)
+    process.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    yield path
+    process.terminate()
+    process.join()
+
+
+def run(path, *argv):
+    out, err = io.BytesIO(), io.BytesIO()
+    status = request(list(argv), path, timeout=5, stdout=out, stderr=err)
+    return status, out.getvalue(), err.getvalue()
+
+
+def test_serve_show(tmpdir, server):
+    master = str(tmpdir.join("master.bib"))
+    tmpdir.join("master.bib").write(bibtex)
+    status, out, err = run(server, "--master", master, "show", "alpha2001")
+    assert status == 0
+    assert out.startswith("@article{alpha2001,")
+    status, out, err = run(server, "--master", master, "show", "nosuch")
+    assert status == 2
+    assert "not in the master bibliography" in err
+
+
+def test_fall_back(tmpdir, server):
+    # commands that change the master are not served
+    assert run(server, "rm", "alpha2001") == (None, b"", b"")
+
+
+def test_timeout(tmpdir):
+    path = str(tmpdir.join("refs.sock"))
+    silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    silent.bind(path)
+    silent.listen(1)
+    try:
+        with pytest.raises(socket.timeout):
+            request(["show", "alpha2001"], path, timeout=0.2)
+    finally:
+        silent.close()
+
+
+@pytest.fixture
+def fake_server(tmpdir):
+    """A server at the returned path that answers one request with the
+    bytes put in the returned list."""
+    path = str(tmpdir.join("refs.sock"))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    reply = []
+
+    def answer():
+        conn, _ = listener.accept()
+        conn.makefile('rb').readline()
+        conn.sendall(b"".join(reply))
+        conn.close()
+
+    thread = threading.Thread(target=answer)
+    thread.daemon = True
+    thread.start()
+    yield path, reply
+    listener.close()
+    thread.join(1)
+
+
+def test_unreadable_greeting_falls_back(fake_server):
+    path, reply = fake_server
+    reply.append(b"HTTP/1.0 400 Bad Request\n")
+    assert run(path, "show", "alpha2001") == (None, b"", b"")
+
+
+@pytest.mark.parametrize('frames', [
+    [b"not json\n"],
+    [b'{"stdout": "many"}\n'],
+    [frame({'stdout': 3}, b"abc")],
+])
+def test_bad_response_after_start(fake_server, frames):
+    path, reply = fake_server
+    reply.extend([frame({'served': True}), frame({'stdout': 6}, b"first\n")]
+                 + frames)
+    out = io.BytesIO()
+    with pytest.raises(ServerError):
+        request(["show", "alpha2001"], path, timeout=5, stdout=out,
+                stderr=io.BytesIO())
+    assert out.getvalue().startswith(b"first\n")
+
+
+def test_main_does_not_run_a_started_command_again(fake_server, monkeypatch,
+                                                   capsys):
+    path, reply = fake_server
+    reply.extend([frame({'served': True}), b"not json\n"])
+    ran = []
+    monkeypatch.setattr(client, 'socket_path', lambda: path)
+    monkeypatch.setattr(refs.main, 'main', lambda **kw: ran.append(kw))
+    monkeypatch.setattr(sys, 'argv', ["refs", "show", "alpha2001"])
+    with pytest.raises(SystemExit) as e:
+        client.main()
+    assert e.value.code == 1
+    assert ran == []
+    assert "Bad response from the server" in capsys.readouterr()[1]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+def test_serve_keeps_locator_current(tmpdir, monkeypatch):
+    monkeypatch.setattr(paths, 'config_dir', str(tmpdir))
+    master = tmpdir.join("master.bib")
+    master.write(bibtex)
+    path = str(tmpdir.join("refs.sock"))
+    process = multiprocessing.Process(
+        target=refs.main.main,
+        args=(["--master", str(master), "serve", "--socket", path],),
+        kwargs={'prog_name': "refs"})
+    process.start()
+    try:
+        index = Locator(str(tmpdir.join("locator.sqlite")))
+        wait_for(lambda: index.lookup('alpha2001')[1] is not None)
+        master.write(bibtex + "\n@misc{beta2002,\n  url = {http://b/},\n}\n")
+        wait_for(lambda: index.lookup('beta2002')[0] is not None)
+        assert index.lookup('beta2002')[0] == {'url': "http://b/"}
+    finally:
+        process.terminate()
+        process.join()
@@ -0,0 +1,114 @@
+import os
+
+from refs.core import Bibliography
+from refs.shards import ShardedBibliography
+
+bibtex = """@preamble{ "\\newcommand{\\noop}[1]{}" }
+@string{jnl = "Journal of Results"}
+
+@article{adams1999,
+  author = {Adams, A.},
+  title = {First},
+  journal = jnl,
+  year = {1999},
+}
+@article{baker2000,
+  author = {Baker, B.},
+  title = {Second},
+  journal = {Other},
+  year = {2000},
+}
+"""
+
+
+def test_round_trip_keeps_strings(tmpdir):
+    tmpdir.join("master.bib").write(bibtex)
+    directory = str(tmpdir.join("master.shards"))
+    sharded = ShardedBibliography(directory)
+    sharded.load_bibtex(str(tmpdir.join("master.bib")))
+    sharded.save()
+
+    sharded = ShardedBibliography(directory)
+    assert sharded.abbrevs['jnl'] == "Journal of Results"
+    entry = sharded['adams1999']
+    entry.resolve_abbrev(sharded.abbrevs)
+    assert entry.value('journal') == "Journal of Results"
+
+    export = str(tmpdir.join("export.bib"))
+    sharded.save_bibtex(export)
+    bib = Bibliography()
+    bib.load_bibtex(export)
+    assert bib.abbrevs['jnl'] == "Journal of Results"
+    assert bib.preambles == ['@preamble{ "\\newcommand{\\noop}[1]{}" }']
+    assert sorted(bib.keys) == ['adams1999', 'baker2000']
+
+
+def entry_text(key, year):
+    return "@article{%s,\n  title = {T},\n  year = {%s},\n}\n" % (key, year)
+
+
+def imported(tmpdir):
+    tmpdir.join("master.bib").write(bibtex)
+    directory = str(tmpdir.join("master.shards"))
+    sharded = ShardedBibliography(directory)
+    sharded.load_bibtex(str(tmpdir.join("master.bib")))
+    sharded.save()
+    return directory
+
+
+def test_concurrent_saves_keep_all_keys(tmpdir):
+    directory = imported(tmpdir)
+    first = ShardedBibliography(directory)
+    second = ShardedBibliography(directory)
+    # the same shard, and a new one
+    first.loads_bibtex(entry_text("able2001", 2001))
+    second.loads_bibtex(entry_text("abbot2002", 2002)
+                        + entry_text("carter2003", 2003))
+    second.remove_entry('baker2000')
+    first.save()
+    second.save()
+    assert sorted(second.keys) == ['abbot2002', 'able2001', 'adams1999',
+                                   'carter2003']
+
+    sharded = ShardedBibliography(directory)
+    assert sorted(sharded.keys) == sorted(second.keys)
+    assert sorted(entry.key for entry in sharded) == sorted(second.keys)
+    assert not tmpdir.join("master.shards", "b.bib").exists()
+    # the shard saved last has the entries of both
+    assert second['able2001'].value('year') == "2001"
+
+
+def test_new_shard_written_by_both(tmpdir):
+    directory = imported(tmpdir)
+    first = ShardedBibliography(directory)
+    second = ShardedBibliography(directory)
+    first.loads_bibtex(entry_text("zeta2001", 2001))
+    second.loads_bibtex(entry_text("zulu2002", 2002))
+    first.save()
+    second.save()
+    sharded = ShardedBibliography(directory)
+    assert [entry.key for entry in sharded.shard('z')] == [
+        'zeta2001', 'zulu2002']
+
+
+def test_one_lock_file(tmpdir):
+    directory = imported(tmpdir)
+    sharded = ShardedBibliography(directory)
+    sharded.loads_bibtex(entry_text("carter2003", 2003))
+    sharded['adams1999'].year = "1998"
+    sharded.save()
+    locks = [name for name in os.listdir(directory) if name.endswith(".lock")]
+    assert locks == [".manifest.json.lock"]
+
+
+def test_save_reads_shards_changed_elsewhere(tmpdir):
+    directory = imported(tmpdir)
+    first = ShardedBibliography(directory)
+    assert first['adams1999'].value('year') == "1999"
+    second = ShardedBibliography(directory)
+    second.loads_bibtex(entry_text("able2001", 2001))
+    second.save()
+    first.loads_bibtex(entry_text("carter2003", 2003))
+    first.save()
+    # the keys saved by second are merged, and shard a is loaded again
+    assert first['able2001'].value('year') == "2001"
@@ -0,0 +1,100 @@
+import pytest
+
+from refs.core import Bibliography
+from refs.style import format_entries, split_name
+
+bibtex = """@article{knuth1984,
+  author = {Donald E. Knuth},
+  title = {Literate Programming},
+  journal = {The Computer Journal},
+  volume = {27},
+  number = {2},
+  pages = {97--111},
+  year = {1984},
+  month = may,
+}
+
+@book{aho1986,
+  author = {Aho, Alfred V. and Sethi, Ravi and Ullman, Jeffrey D.},
+  title = {Compilers: Principles, Techniques, and Tools},
+  publisher = {Addison-Wesley},
+  address = {Reading, MA},
+  year = {1986},
+}
+
+@inproceedings{lamport1978,
+  author = {Leslie Lamport and others},
+  title = {Time, Clocks and the {O}rdering of Events},
+  booktitle = {Proc. <Symposium>},
+  year = {1978},
+}
+"""
+
+
+def entries():
+    bib = Bibliography()
+    bib.loads_bibtex(bibtex)
+    return list(bib)
+
+
+def formatted(style, to):
+    return "".join(format_entries(entries(), style=style, to=to))
+
+
+def test_ieee_text():
+    assert formatted('ieeetr', 'text') == (
+        '[1] D. E. Knuth, "Literate Programming," The Computer Journal, '
+        'vol. 27, no. 2, pp. 97-111, May 1984.\n'
+        '[2] A. V. Aho, R. Sethi, and J. D. Ullman, Compilers: Principles, '
+        'Techniques, and Tools, Addison-Wesley, Reading, MA, 1986.\n'
+        '[3] L. Lamport et al., "Time, Clocks and the Ordering of Events," '
+        'in Proc. <Symposium>, 1978.\n')
+
+
+def test_ieee_html():
+    assert formatted('ieeetr', 'html') == (
+        '<div class="bibliography">\n'
+        '<p id="knuth1984">[1] D. E. Knuth, &ldquo;Literate Programming,'
+        '&rdquo; <i>The Computer Journal</i>, vol. 27, no. 2, '
+        'pp. 97&ndash;111, May 1984.</p>\n'
+        '<p id="aho1986">[2] A. V. Aho, R. Sethi, and J. D. Ullman, '
+        '<i>Compilers: Principles, Techniques, and Tools</i>, '
+        'Addison-Wesley, Reading, MA, 1986.</p>\n'
+        '<p id="lamport1978">[3] L. Lamport et al., &ldquo;Time, Clocks '
+        'and the Ordering of Events,&rdquo; in '
+        '<i>Proc. &lt;Symposium&gt;</i>, 1978.</p>\n'
+        '</div>\n')
+
+
+def test_plain_is_sorted_by_author():
+    text = formatted('plain', 'text').splitlines()
+    assert text[0].startswith("[1] Alfred V. Aho, Ravi Sethi, and "
+                              "Jeffrey D. Ullman. Compilers:")
+    assert text[1] == ("[2] Donald E. Knuth. Literate Programming. "
+                       "The Computer Journal, 27(2):97-111, May 1984.")
+    assert text[2].startswith("[3] Leslie Lamport et al.")
+
+
+def test_bbl():
+    bbl = formatted('plain', 'bbl')
+    assert bbl.startswith(
+        "\\begin{thebibliography}{3}\n\n\\bibitem{aho1986}\n")
+    assert "\\newblock {\\em The Computer Journal}, 27(2):97--111" in bbl
+    assert bbl.endswith("\\end{thebibliography}\n")
+
+
+def test_unknown_style_or_markup():
+    with pytest.raises(ValueError):
+        next(format_entries(entries(), style='apa'))
+    with pytest.raises(ValueError):
+        next(format_entries(entries(), to='rtf'))
+
+
+@pytest.mark.parametrize('name, parts', [
+    ("Donald E. Knuth", ("Donald E.", "Knuth")),
+    ("Knuth, Donald E.", ("Donald E.", "Knuth")),
+    ("Ford, Jr, Henry", ("Henry", "Ford, Jr")),
+    ("{World Health Organization}", ("", "{World Health Organization}")),
+])
+def test_split_name(name, parts):
+    assert split_name(name) == parts
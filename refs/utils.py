@@ -1,3 +1,7 @@
+import hashlib
+import re
+
+
 def fuzzymatch(n1, n2):
     """Match two numeric values.
 
@@ -20,8 +24,61 @@ def english_join(words):
         return ""
 
 
+_name_token_re = re.compile(r"""\{[^{}]*\}|[^\s{}]+""")
+
+
+def name_tokens(name):
+    """Split a BibTeX name into words; a braced group is one word."""
+    return _name_token_re.findall(name)
+
+
 def mogrify(s):
     """Removes punctuation marks and white space."""
     s = s.lower()
     s = re.sub(r"[#{}:,&$ -'\"]", "", s)
     return s
+
+
+_accent_re = re.compile(
+    r"""\\(?:[.'`^"~=]\s*\{?|[uvHcdbrkt]\s*\{|[uvHcdbrkt]\s+)\s*(\w)\}?""")
+_command_re = re.compile(r"""\\([a-zA-Z]+)\s*""")
+_space_re = re.compile(r"""\s+""")
+
+# commands that stand for letters, e.g. \ss for the German sharp s,
+# or for words, like \TeX
+_letter_commands = ('aa', 'AA', 'ae', 'AE', 'i', 'j', 'l', 'L',
+                    'o', 'O', 'oe', 'OE', 'ss', 'TeX', 'LaTeX', 'BibTeX')
+
+
+def _command(mo):
+    name = mo.group(1)
+    return name if name in _letter_commands else ""
+
+
+def detex(s):
+    """Return the LaTeX string ``s`` as plain text.
+
+    LaTeX accents are stripped (``\\'{e}`` becomes ``e``), commands that
+    stand for letters are spelled out (``\\ss`` becomes ``ss``) and other
+    commands are dropped. Braces are removed and white space is collapsed.
+    """
+    if "\\" in s:
+        s = _accent_re.sub(r"\1", s)
+        s = _command_re.sub(_command, s)
+    s = s.replace("{", "").replace("}", "")
+    return _space_re.sub(" ", s).strip()
+
+
+def collate(s):
+    """Return a key for sorting the LaTeX string ``s``.
+
+    This is the case-folded `.detex` text.
+    """
+    return detex(s).lower()
+
+
+def digest(s):
+    """Return the hex SHA-1 digest of the text ``s``."""
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return hashlib.sha1(s).hexdigest()
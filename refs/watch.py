@@ -0,0 +1,167 @@
+"""Watch bibliography files for changes.
+
+On Linux, a `Watcher` uses inotify, through ctypes, so a change is
+noticed as soon as the file is written. Elsewhere, or if inotify is not
+available, it compares the size and mtime of each file every few
+moments instead. The directories of the files are watched rather than
+the files, since writers replace files by renaming new ones over them.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from .locator import stamp
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+
+_event = struct.Struct("iIII")  # wd, mask, cookie, len; then the name
+
+
+class Inotify(object):
+    """A minimal binding of the Linux inotify API."""
+
+    mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+            | IN_CREATE | IN_DELETE)
+
+    def __init__(self):
+        name = ctypes.util.find_library('c')
+        if name is None:
+            raise OSError(errno.ENOSYS, "No C library to find inotify in.")
+        self.libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available.")
+        self.fd = self._check(self.libc.inotify_init1(IN_CLOEXEC))
+        self.directories = {}  # watch descriptor -> directory
+
+    def _check(self, result):
+        if result < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return result
+
+    def add_watch(self, directory):
+        path = directory.encode('utf-8') if not isinstance(
+            directory, bytes) else directory
+        wd = self._check(self.libc.inotify_add_watch(
+            self.fd, ctypes.c_char_p(path), self.mask))
+        self.directories[wd] = directory
+
+    def read(self, timeout=None):
+        """Return the paths named by the events that arrive within
+        ``timeout`` seconds, or wait for the first events if None."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 1 << 16)
+        paths = []
+        pos = 0
+        while pos + _event.size <= len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, pos)
+            pos += _event.size
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+            if wd in self.directories and name:
+                if not isinstance(name, str):
+                    name = name.decode('utf-8')
+                paths.append(os.path.join(self.directories[wd], name))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """Watches ``files`` and reports the ones that changed.
+
+    ``interval`` is the number of seconds between checks when polling.
+    Set ``polling`` to avoid inotify. Files in directories that inotify
+    cannot watch, such as directories that do not exist yet, are polled.
+    """
+
+    # further events this soon after a change are part of the same write
+    settle = 0.05
+
+    def __init__(self, files, interval=1.0, polling=False):
+        self.files = set([os.path.abspath(path) for path in files])
+        self.interval = interval
+        self.stamps = dict((path, stamp([path])) for path in self.files)
+        self.polled = set(self.files)
+        self.inotify = None
+        if not polling:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError):
+                return
+            for directory in sorted(set(
+                    [os.path.dirname(path) for path in self.files])):
+                try:
+                    self.inotify.add_watch(directory)
+                except OSError:
+                    continue
+                self.polled.difference_update(
+                    [path for path in self.files
+                     if os.path.dirname(path) == directory])
+
+    @property
+    def method(self):
+        return 'polling' if self.inotify is None else 'inotify'
+
+    def _changed(self, candidates):
+        changed = []
+        for path in sorted(candidates):
+            current = stamp([path])
+            if current != self.stamps[path]:
+                self.stamps[path] = current
+                changed.append(path)
+        return changed
+
+    def wait(self, timeout=None):
+        """Wait for watched files to change and return their paths.
+
+        Returns an empty list if nothing changed within ``timeout``
+        seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = (None if deadline is None
+                         else max(0, deadline - time.time()))
+            if self.inotify is not None:
+                wait = remaining
+                if self.polled:
+                    wait = (self.interval if remaining is None
+                            else min(self.interval, remaining))
+                touched = set(self.inotify.read(wait))
+                while touched:
+                    more = self.inotify.read(self.settle)
+                    if not more:
+                        break
+                    touched.update(more)
+                candidates = (touched & self.files) | self.polled
+            else:
+                time.sleep(self.interval if remaining is None
+                           else min(self.interval, remaining))
+                candidates = self.files
+            changed = self._changed(candidates)
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+    def __iter__(self):
+        """Yield the lists of files that changed, forever."""
+        while True:
+            yield self.wait()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
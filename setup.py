@@ -30,7 +30,7 @@ setup(
     long_description=long_description,
     entry_points={
         'console_scripts': [
-            'refs = refs.main:main',
+            'refs = refs.client:main',
         ]
     },
     install_requires=[